@@ -1,20 +1,70 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import (Flask, request, abort, jsonify, Response,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 from sqlalchemy.exc import SQLAlchemyError
 from .auth.auth import AuthError, requires_auth
+from .bulk import import_questions, export_questions
+from .http_cache import conditional
+from .metrics import init_metrics, registry, timed
+from .streaming import streamed_questions_response
+from .quiz_sessions import create_session_backend
+from .replicas import init_replicas, reads_from_replica
+from .response_cache import create_response_cache
+from .rate_limit import (create_rate_limiter, create_admission_controller,
+                         parse_rate_limits, parse_admission_limits,
+                         retry_headers)
 
-from models import setup_db, Question, Category
+from models import (setup_db, database_path, Question, Category, paginate_questions,
+                    count_questions, draw_question, search_questions,
+                    category_cache, category_version, iter_questions,
+                    count_category_questions, iter_search_results,
+                    get_question_row, dumps, DATABASE_REPLICA_URLS,
+                    QUIZ_DRAW_STRATEGY, unit_of_work, update_questions,
+                    delete_questions, category_stats, DB_CREATE_TABLES,
+                    draw_adaptive_question, insert_question)
 
-QUESTIONS_PER_PAGE = 10
+QUESTIONS_PER_PAGE = int(os.getenv('QUESTIONS_PER_PAGE', 10))
+MAX_QUESTIONS_PER_PAGE = int(os.getenv('MAX_QUESTIONS_PER_PAGE', 100))
+# relative weights of the quiz questions by difficulty, as "5:2,4:1.5"
+QUIZ_DIFFICULTY_WEIGHTS = {
+    int(difficulty): float(weight) for difficulty, weight in (
+        pair.split(':') for pair in
+        os.getenv('QUIZ_DIFFICULTY_WEIGHTS', '').split(',') if pair)}
+# requests per second and burst of each client on the public routes that
+# query the database hardest, as "quizzes=10:60,search=5:30"
+RATE_LIMITS = parse_rate_limits(
+    os.getenv('RATE_LIMITS', 'quizzes=10:60,search=5:30'))
+# requests of those routes each worker serves at once, at most
+ADMISSION_LIMITS = parse_admission_limits(
+    os.getenv('ADMISSION_LIMITS', 'quizzes=16,search=8'))
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    app.config['QUESTIONS_PER_PAGE'] = QUESTIONS_PER_PAGE
+    app.config['MAX_QUESTIONS_PER_PAGE'] = MAX_QUESTIONS_PER_PAGE
+    app.config['QUIZ_DRAW_STRATEGY'] = QUIZ_DRAW_STRATEGY
+    app.config['QUIZ_DIFFICULTY_WEIGHTS'] = QUIZ_DIFFICULTY_WEIGHTS
+    app.config['RATE_LIMITS'] = RATE_LIMITS
+    app.config['ADMISSION_LIMITS'] = ADMISSION_LIMITS
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get('DATABASE_URL', database_path),
+             app.config.get('DATABASE_POOL'),
+             app.config.get('DATABASE_REPLICA_URLS', DATABASE_REPLICA_URLS),
+             app.config.get('DB_CREATE_TABLES', DB_CREATE_TABLES))
+    quiz_sessions = create_session_backend(app.config)
+    response_cache = create_response_cache(app.config)
+    app.extensions['response_cache'] = response_cache
+    limiter = create_rate_limiter(app.config)
+    app.extensions['rate_limiter'] = limiter
+    admission = create_admission_controller(app.config)
+    app.extensions['admission'] = admission
+    init_metrics(app)
+    init_replicas(app)
 
     cors = CORS(app)
 
@@ -26,24 +76,42 @@ def create_app(test_config=None):
                              'GET,PATCH,POST,DELETE,OPTIONS')
         return response
 
+    def json_response(payload, status=200):
+        # read endpoints serialize with models.dumps rather than jsonify
+        with timed('serialize'):
+            body = dumps(payload)
+        return app.response_class(body, status=status,
+                                  mimetype='application/json')
+
+    def get_page_size():
+        # page size requested with ?per_page=, bounded by the app config
+        per_page = request.args.get(
+            'per_page', app.config['QUESTIONS_PER_PAGE'], type=int)
+        return max(1, min(per_page, app.config['MAX_QUESTIONS_PER_PAGE']))
+
+    def is_paginated():
+        return any(arg in request.args for arg in
+                   ('page', 'per_page', 'after'))
+
     @app.route('/questions', methods=['GET'])
+    @reads_from_replica
+    @conditional(lambda: ['questions', 'categories'])
+    @response_cache.cached(lambda: ['questions', 'categories'])
     def get_questions():
-        error = False
         page = request.args.get('page', 1, type=int)
-        start = (page - 1) * 10
-        end = start + 10
+        after = request.args.get('after', None, type=int)
+        per_page = get_page_size()
 
-        questions = Question.query.all()
+        questions = paginate_questions(per_page, page=page, after=after)
         formatted_questions = [question.format() for question in questions]
-        categories = Category.query.all()
-        categories_dict = {
-            category.id: category.type for category in categories}
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'questions': formatted_questions[start:end],
-            'totalQuestions': len(formatted_questions),
-            'categories': categories_dict
+            'questions': formatted_questions,
+            'totalQuestions': count_questions(),
+            'categories': category_cache.get().categories,
+            'nextCursor': (questions[-1].id
+                           if len(questions) == per_page else None)
         })
 
     @app.route('/questions', methods=['POST'])
@@ -52,14 +120,27 @@ def create_app(test_config=None):
         body = request.get_json()
         if 'searchTerm' in body:
             searchterm = body['searchTerm']
-            search_results = Question.query.filter(
-                Question.question.ilike('%' + searchterm + '%')).all()
+            include_answers = bool(body.get('searchAnswers', False))
+            limiter.hit('search')
+            if request.args.get('stream') == 'true':
+                # the slot is held until the last result is sent
+                release = admission.acquire('search')
+                response = streamed_questions_response(
+                    iter_search_results(searchterm, include_answers),
+                    success=True)
+                response.call_on_close(release)
+                return response
+            with admission.admit('search'):
+                search_results, total = search_questions(
+                    searchterm, get_page_size(),
+                    page=request.args.get('page', 1, type=int),
+                    include_answers=include_answers)
             formatted_results = [result.format()
                                  for result in search_results]
-            return jsonify({
+            return json_response({
                 'success': True,
                 'questions': formatted_results,
-                'totalQuestions': len(formatted_results)
+                'totalQuestions': total
             })
         else:
             quest = body['question']
@@ -67,42 +148,82 @@ def create_app(test_config=None):
             cat = int(body['category'])
             diff = int(body['difficulty'])
             try:
-                new_question = Question(
-                    question=quest, answer=ans, category=cat, difficulty=diff)
-                new_question.insert()
+                # a question already there (up to case and spacing) is
+                # not added again, its id is returned
+                question_id, created = insert_question({
+                    'question': quest,
+                    'answer': ans,
+                    'category': cat,
+                    'difficulty': diff
+                })
             except SQLAlchemyError as e:
                 print(e)
                 error = True
                 abort(422)
             success = False if error else True
             return jsonify({
-                'success': success
+                'success': success,
+                'id': question_id,
+                'created': created
             })
 
+    @app.route('/questions/import', methods=['POST'])
+    @requires_auth('add:questions')
+    def import_questions_file(jwt):
+        # the body is read line by line as it arrives
+        format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        report = import_questions(request.stream, format)
+        return jsonify(dict(report, success=True))
+
+    @app.route('/questions/export', methods=['GET'])
+    @requires_auth('get:questions')
+    @reads_from_replica
+    def export_questions_file(jwt):
+        format = request.args.get('format', 'ndjson')
+        mimetype = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+        return Response(stream_with_context(export_questions(format)),
+                        mimetype=mimetype)
+
     @app.route('/categories')
+    @reads_from_replica
+    @conditional(lambda: ['categories'])
     # return all categories
     def get_categories():
-        categories = Category.query.all()
-        categories_dict = {
-            category.id: category.type for category in categories}
-        return jsonify({
+        # the body is serialized once per categories version
+        return app.response_class(category_cache.get().json,
+                                  mimetype='application/json')
+
+    @app.route('/categories/stats')
+    @reads_from_replica
+    @conditional(lambda: ['questions', 'categories'])
+    def get_category_stats():
+        # counts kept in the category_stats table, questions are not read
+        stats = category_stats.get()
+        return json_response({
             'success': True,
-            'categories': categories_dict
+            'categories': {
+                category_id: {
+                    'type': category_type,
+                    'totalQuestions': stats.total(category_id),
+                    'difficulties': stats.counts.get(category_id, {})
+                } for category_id, category_type in
+                category_cache.get().categories.items()},
+            'totalQuestions': stats.total()
         })
 
     @app.route('/questions/<int:question_id>', methods=['GET'])
     @requires_auth('get:questions')
+    @reads_from_replica
     def get_question(jwt, question_id):
         error = False
         body = request.get_json()
         try:
-            question = Question.query.filter_by(
-                id=question_id).one_or_none().format()
+            question = get_question_row(question_id).format()
         except:
             error = True
             abort(422)
         success = False if error else True
-        return jsonify({
+        return json_response({
             'question': question,
             'success': success
         })
@@ -117,17 +238,19 @@ def create_app(test_config=None):
         cat = int(body['category'])
         diff = int(body['difficulty'])
         try:
-            question = Question.query.filter_by(id=question_id).one_or_none()
-            question.question = quest
-            question.answer = ans
-            question.category = cat
-            question.difficulty = diff
-            question.update()
-
+            # a single UPDATE, without loading the question first
+            updated = update_questions([question_id], {
+                'question': quest,
+                'answer': ans,
+                'category': cat,
+                'difficulty': diff
+            })
         except SQLAlchemyError as e:
             print(e)
             error = True
             abort(422)
+        if not updated:
+            abort(422)
         success = False if error else True
         return jsonify({
             'success': success
@@ -138,46 +261,173 @@ def create_app(test_config=None):
     def delete_question(jwt, question_id):
         error = False
         try:
-            Question.query.filter_by(id=question_id).one_or_none().delete()
-        except:
+            deleted = delete_questions([question_id])
+        except SQLAlchemyError as e:
+            print(e)
             error = True
             abort(422)
+        if not deleted:
+            abort(422)
         success = False if error else True
         return jsonify({
             'success': success
         })
 
+    def question_changes(body):
+        # the fields of a question to change, raises ValueError
+        changes = {}
+        for field in ('question', 'answer'):
+            if field in body:
+                changes[field] = str(body[field])
+        for field in ('category', 'difficulty'):
+            if field in body:
+                changes[field] = int(body[field])
+        if not changes:
+            raise ValueError('nothing to change')
+        return changes
+
+    def question_ids(ids):
+        if not isinstance(ids, list) or not ids:
+            raise ValueError('ids must be a list of question ids')
+        return [int(question_id) for question_id in ids]
+
+    @app.route('/questions', methods=['PATCH'])
+    @requires_auth('patch:questions')
+    def edit_questions(jwt):
+        # either the same changes for every id in "ids", or changes per
+        # question in "questions", committed together
+        body = request.get_json()
+        try:
+            if 'questions' in body:
+                edits = [(question_ids([edit['id']]), question_changes(edit))
+                         for edit in body['questions']]
+            else:
+                edits = [(question_ids(body.get('ids')),
+                          question_changes(body))]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            abort(422)
+        try:
+            with unit_of_work():
+                updated = sum(update_questions(ids, changes)
+                              for ids, changes in edits)
+        except SQLAlchemyError as e:
+            print(e)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'updated': updated
+        })
+
+    @app.route('/questions', methods=['DELETE'])
+    @requires_auth('delete:questions')
+    def delete_questions_by_ids(jwt):
+        body = request.get_json()
+        try:
+            ids = question_ids(body.get('ids'))
+        except (AttributeError, TypeError, ValueError):
+            abort(422)
+        try:
+            deleted = delete_questions(ids)
+        except SQLAlchemyError as e:
+            print(e)
+            abort(422)
+        return jsonify({
+            'success': True,
+            'deleted': deleted
+        })
+
     @app.route('/categories/<int:category_id>/questions')
+    @reads_from_replica
+    @conditional(lambda category_id: [category_version(category_id)])
+    @response_cache.cached(lambda category_id: [
+        category_version(category_id)], when=is_paginated)
     def get_categorized_questions(category_id):
-        cat_questions = Question.query.filter_by(
-            category=category_id).all()
+        if not is_paginated():
+            # the whole category, written out as it is read
+            return streamed_questions_response(
+                iter_questions(category_id), success=True,
+                currentCategory=category_id)
+
+        per_page = get_page_size()
+        cat_questions = paginate_questions(
+            per_page, page=request.args.get('page', 1, type=int),
+            after=request.args.get('after', None, type=int),
+            category=category_id)
         formatted_questions = [question.format()
                                for question in cat_questions]
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': formatted_questions,
-            'totalQuestions': len(formatted_questions),
-            'currentCategory': category_id
+            'totalQuestions': count_category_questions(category_id),
+            'currentCategory': category_id,
+            'nextCursor': (cat_questions[-1].id
+                           if len(cat_questions) == per_page else None)
         })
 
     @app.route('/quizzes', methods=['POST'])
+    @limiter.limit('quizzes')
+    @admission.admitted('quizzes')
+    @reads_from_replica
     def play_quiz():
         body = request.get_json()
-        category_id = body['quiz_category']['id']
-        if category_id == 0:
-            cat_questions = Question.query.all()
-        else:
-            cat_questions = Question.query.filter_by(
-                category=category_id).all()
+        category_id = int(body['quiz_category']['id'])
         prev_questions = body['previous_questions']
-        formatted_questions = [
-            q.format() for q in cat_questions if q.id not in prev_questions]
-        random.shuffle(formatted_questions)
+        question = draw_question(
+            category_id, prev_questions,
+            weights=app.config['QUIZ_DIFFICULTY_WEIGHTS'],
+            strategy=app.config['QUIZ_DRAW_STRATEGY'])
+        return json_response({
+            'success': True,
+            'question': question.format() if question else None
+        })
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @limiter.limit('quizzes')
+    def create_quiz_session():
+        body = request.get_json()
+        category_id = int(body['quiz_category']['id'])
+        session = quiz_sessions.create(category_id,
+                                       adaptive=bool(body.get('adaptive')))
         return jsonify({
             'success': True,
-            'question': formatted_questions[0] if formatted_questions else None
+            'session_id': session.id
         })
 
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    @limiter.limit('quizzes')
+    @admission.admitted('quizzes')
+    def next_quiz_question(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+        body = request.get_json(silent=True) or {}
+        if not session.adaptive:
+            question = draw_question(
+                session.category, session,
+                weights=app.config['QUIZ_DIFFICULTY_WEIGHTS'],
+                strategy=app.config['QUIZ_DRAW_STRATEGY'])
+        else:
+            # the answer to the previous question moves the score, which
+            # picks the difficulty of the next one
+            if 'correct' in body:
+                quiz_sessions.record_answer(session, bool(body['correct']))
+            question = draw_adaptive_question(
+                session.category, session, session.difficulty())
+        if question is not None:
+            quiz_sessions.add_used(session, question.id)
+        payload = {
+            'success': True,
+            'question': question.format() if question else None
+        }
+        if session.adaptive:
+            payload['score'] = round(session.score, 3)
+        return json_response(payload)
+
+    @app.route('/metrics')
+    def metrics():
+        return app.response_class(registry.render(),
+                                  mimetype='text/plain; version=0.0.4')
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -194,6 +444,22 @@ def create_app(test_config=None):
             "message": "Unprocessable Entity"
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too many requests"
+        }), 429, retry_headers(error)
+
+    @app.errorhandler(503)
+    def overloaded(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service unavailable"
+        }), 503, retry_headers(error)
+
     @app.errorhandler(AuthError)
     def authorization_error(error):
         return jsonify({
@@ -0,0 +1,777 @@
+'''
+ASGI serving mode, run with
+
+    uvicorn app.asgi:application --workers 2
+
+The public read endpoints (GET /categories, GET /questions, search with
+POST /questions, GET /categories/<id>/questions and POST /quizzes) are
+served on the event loop from an asyncpg connection pool, with the same
+JSON bodies, ETags, Server-Timing header, rate limits and admission
+control as the Flask routes, and quiz questions drawn by the same
+QUIZ_DRAW_STRATEGY and QUIZ_DIFFICULTY_WEIGHTS. Every other request, and
+every request when the database is not Postgres or asyncpg is not
+installed, is handed to the Flask app created by create_app() in a
+thread. The JWKS
+keys are fetched at startup and refreshed by a background task, so token
+checks never wait on Auth0.
+'''
+import asyncio
+import calendar
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from flask_cors.core import get_cors_headers, get_cors_options
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from . import app as flask_app
+from .auth.auth import jwks_store
+from .http_cache import HTTP_CACHE_MAX_AGE, HTTP_CACHE_S_MAXAGE
+from .metrics import RequestMetrics, SLOW_QUERY_SECONDS, record_request
+from .rate_limit import (MemoryBuckets, Overloaded, RateLimited,
+                         retry_headers)
+from .streaming import astream_questions
+from models import (DATABASE_POOL, VERSION_CHECK_INTERVAL, STREAM_BATCH_SIZE,
+                    QUIZ_DRAW_PROBES, QUIZ_DRAW_STRATEGY, QuestionIndex,
+                    accepts, category_version, dumps, search_tsquery,
+                    tokenize)
+
+
+# connections kept open by each worker's asyncpg pool
+ASYNC_POOL_MIN_SIZE = int(os.getenv('ASYNC_POOL_MIN_SIZE', 2))
+ASYNC_POOL_MAX_SIZE = int(os.getenv('ASYNC_POOL_MAX_SIZE', 10))
+
+QUESTION_COLUMNS = 'id, question, answer, category, difficulty'
+
+logger = logging.getLogger('trivia.metrics')
+
+
+def http_date(value):
+    return email.utils.formatdate(calendar.timegm(value.utctimetuple()),
+                                  usegmt=True)
+
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+
+def arg_int(args, name, default=None):
+    # request.args.get(name, default, type=int)
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        return default
+
+
+'''
+AsyncRequest
+    what the native handlers need of an HTTP scope: the method, path,
+    query arguments, headers and the buffered body, which is replayed
+    to Flask when the request is handed over
+'''
+
+
+class AsyncRequest:
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope['query_string'].decode('latin-1')
+        self.args = dict(reversed(parse_qsl(self.query_string,
+                                            keep_blank_values=True)))
+        self.headers = {name.decode('latin-1'): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.body = None
+        self.metrics = RequestMetrics()
+
+    @property
+    def full_path(self):
+        # as werkzeug's Request.full_path, which the ETags are made of
+        return self.path + '?' + self.query_string
+
+    async def read_body(self):
+        if self.body is None:
+            chunks = []
+            more_body = True
+            while more_body:
+                message = await self.receive()
+                chunks.append(message.get('body', b''))
+                more_body = message.get('more_body', False)
+            self.body = b''.join(chunks)
+        return self.body
+
+    async def get_json(self):
+        # request.get_json(), None when Flask would not parse the body
+        content_type = self.headers.get('content-type', '')
+        if content_type.split(';')[0].strip() != 'application/json':
+            return None
+        try:
+            return json.loads(await self.read_body())
+        except ValueError:
+            return None
+
+    def replay(self):
+        # the receive callable handed to Flask
+        if self.body is None:
+            return self.receive
+        sent = []
+
+        async def receive():
+            if sent:
+                return await self.receive()
+            sent.append(True)
+            return {'type': 'http.request', 'body': self.body,
+                    'more_body': False}
+        return receive
+
+
+'''
+AsyncDatabase
+    the asyncpg pool of a worker along with its view of the content
+    versions, categories, counts and quiz index, which follow the
+    content_versions table exactly like their counterparts in models.py
+'''
+
+
+class AsyncDatabase:
+
+    def __init__(self, pool, interval=VERSION_CHECK_INTERVAL):
+        self.pool = pool
+        self.interval = interval
+        self.versions = {}
+        self.checked = None
+        self.categories = (None, None, None)
+        self.counts = {}
+        self.id_range = (None, None, None)
+        self.question_index = QuestionIndex()
+        self.search_vector = False
+        self._versions_lock = asyncio.Lock()
+        self._index_lock = asyncio.Lock()
+
+    async def query(self, metrics, method, statement, *args):
+        start = time.perf_counter()
+        try:
+            return await getattr(self.pool, method)(statement, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.queries += 1
+            metrics.db_time += elapsed
+            if elapsed >= SLOW_QUERY_SECONDS:
+                # without the arguments, like the Flask app's log
+                logger.warning('slow query (%.3fs): %s', elapsed, statement)
+
+    async def start(self):
+        self.search_vector = bool(await self.pool.fetchval(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_name = 'questions' "
+            "AND column_name = 'search_vector'"))
+
+    def invalidate(self):
+        self.checked = None
+
+    async def get_version(self, name, metrics):
+        '''returns (version, updated_at) like ContentVersions.get()'''
+        if self.checked is None or \
+                time.monotonic() - self.checked >= self.interval:
+            async with self._versions_lock:
+                if self.checked is None or \
+                        time.monotonic() - self.checked >= self.interval:
+                    rows = await self.query(
+                        metrics, 'fetch',
+                        'SELECT name, version, updated_at '
+                        'FROM content_versions')
+                    self.versions = {row['name']: (row['version'],
+                                                   row['updated_at'])
+                                     for row in rows}
+                    self.checked = time.monotonic()
+        return self.versions.get(name, (0, None))
+
+    async def get_categories(self, metrics):
+        '''returns the categories and the GET /categories body'''
+        version = (await self.get_version('categories', metrics))[0]
+        if self.categories[0] != version:
+            rows = await self.query(
+                metrics, 'fetch',
+                'SELECT id, type FROM categories ORDER BY id')
+            categories = {row['id']: row['type'] for row in rows}
+            self.categories = (version, categories, dumps({
+                'success': True,
+                'categories': categories
+            }))
+        return self.categories[1], self.categories[2]
+
+    async def count(self, metrics, category=None):
+        name = 'questions' if category is None else \
+            category_version(category)
+        version = (await self.get_version(name, metrics))[0]
+        cached = self.counts.get(category)
+        if cached is None or cached[0] != version:
+            # from the category stats, like count_questions()
+            if category is None:
+                total = await self.query(
+                    metrics, 'fetchval',
+                    'SELECT coalesce(sum(question_count), 0) '
+                    'FROM category_stats')
+            else:
+                total = await self.query(
+                    metrics, 'fetchval',
+                    'SELECT coalesce(sum(question_count), 0) '
+                    'FROM category_stats WHERE category = $1', category)
+            cached = (version, total)
+            self.counts[category] = cached
+        return cached[1]
+
+    async def paginate(self, metrics, per_page, page=1, after=None,
+                       category=None):
+        '''paginate_questions() on the pool'''
+        conditions, args = [], []
+        if category is not None:
+            args.append(category)
+            conditions.append('category = $%d' % len(args))
+        if after is not None:
+            args.append(after)
+            conditions.append('id > $%d' % len(args))
+        statement = 'SELECT ' + QUESTION_COLUMNS + ' FROM questions'
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        args.append(per_page)
+        statement += ' ORDER BY id LIMIT $%d' % len(args)
+        if after is None:
+            args.append((max(page, 1) - 1) * per_page)
+            statement += ' OFFSET $%d' % len(args)
+        rows = await self.query(metrics, 'fetch', statement, *args)
+        return [dict(row) for row in rows]
+
+    async def iter_category(self, metrics, category):
+        '''yields the questions of a category by STREAM_BATCH_SIZE'''
+        after = None
+        while True:
+            batch = await self.paginate(metrics, STREAM_BATCH_SIZE,
+                                        after=after, category=category)
+            if batch:
+                yield batch
+            if len(batch) < STREAM_BATCH_SIZE:
+                return
+            after = batch[-1]['id']
+
+    async def search(self, metrics, terms, per_page, page=1,
+                     include_answers=False):
+        '''search_questions() on the search_vector column'''
+        query = search_tsquery(terms, include_answers)
+        rows = await self.query(
+            metrics, 'fetch',
+            'SELECT ' + QUESTION_COLUMNS + ' FROM questions, '
+            "to_tsquery('english', $1) AS query "
+            'WHERE search_vector @@ query '
+            'ORDER BY ts_rank_cd(search_vector, query) DESC, id '
+            'LIMIT $2 OFFSET $3',
+            query, per_page, (max(page, 1) - 1) * per_page)
+        total = await self.query(
+            metrics, 'fetchval',
+            'SELECT count(*) FROM questions '
+            "WHERE search_vector @@ to_tsquery('english', $1)", query)
+        return [dict(row) for row in rows], total
+
+    async def draw(self, metrics, category=0, exclude=(), weights=None,
+                   strategy=QUIZ_DRAW_STRATEGY):
+        '''draw_question() on the pool'''
+        if strategy == 'sql':
+            return await self.probe(metrics, category, exclude, weights) or \
+                await self.scan(metrics, category, exclude, weights)
+        return await self.draw_indexed(metrics, category, exclude, weights)
+
+    async def get_question(self, metrics, question_id):
+        row = await self.query(
+            metrics, 'fetchrow',
+            'SELECT ' + QUESTION_COLUMNS + ' FROM questions WHERE id = $1',
+            question_id)
+        return dict(row) if row is not None else None
+
+    async def get_id_range(self, metrics):
+        '''question_id_range() on the pool'''
+        version = (await self.get_version('questions', metrics))[0]
+        if self.id_range[0] != version:
+            row = await self.query(metrics, 'fetchrow',
+                                   'SELECT min(id), max(id) FROM questions')
+            self.id_range = (version, row[0], row[1])
+        return self.id_range[1:]
+
+    async def probe(self, metrics, category, exclude, weights, rounds=2):
+        '''probe_question() on the pool'''
+        low, high = await self.get_id_range(metrics)
+        if low is None:
+            return None
+        statement = 'SELECT ' + QUESTION_COLUMNS + ' FROM questions ' \
+            'WHERE id = ANY($1::integer[])'
+        args = []
+        if category:
+            statement += ' AND category = $2'
+            args.append(category)
+        for _ in range(rounds):
+            probes = [random.randint(low, high)
+                      for _ in range(QUIZ_DRAW_PROBES)]
+            rows = {row['id']: row for row in await self.query(
+                metrics, 'fetch', statement, probes, *args)}
+            for question_id in probes:
+                row = rows.get(question_id)
+                if row is not None and question_id not in exclude and \
+                        accepts(row['difficulty'], weights):
+                    return dict(row)
+        return None
+
+    async def scan(self, metrics, category, exclude, weights):
+        '''scan_question() on the pool, by STREAM_BATCH_SIZE ids'''
+        statement = 'SELECT id, difficulty FROM questions WHERE id > $1'
+        if category:
+            statement += ' AND category = $3'
+        statement += ' ORDER BY id LIMIT $2'
+        chosen, chosen_key, after = None, -1.0, 0
+        while True:
+            rows = await self.query(
+                metrics, 'fetch', statement, after, STREAM_BATCH_SIZE,
+                *([category] if category else []))
+            for question_id, difficulty in rows:
+                weight = weights.get(difficulty, 1) if weights else 1
+                if question_id in exclude or weight <= 0:
+                    continue
+                key = random.random() ** (1.0 / weight)
+                if key > chosen_key:
+                    chosen, chosen_key = question_id, key
+            if len(rows) < STREAM_BATCH_SIZE:
+                break
+            after = rows[-1]['id']
+        if chosen is None:
+            return None
+        return await self.get_question(metrics, chosen)
+
+    async def draw_indexed(self, metrics, category, exclude, weights,
+                           tries=16):
+        '''draw_indexed_question() with the worker's own QuestionIndex'''
+        index = self.question_index
+        for _ in range(tries):
+            version = (await self.get_version('questions', metrics))[0]
+            if index.buckets is None or index.version != version:
+                async with self._index_lock:
+                    await self.refresh_index(metrics, version)
+            question_id = index.sample(index.select(category), exclude)
+            if question_id is None:
+                return None
+            question = await self.get_question(metrics, question_id)
+            if question is None:
+                # deleted by another worker since the index was loaded
+                index.version = None
+                self.invalidate()
+            elif accepts(question['difficulty'], weights):
+                return question
+        return await self.scan(metrics, category, exclude, weights)
+
+    async def refresh_index(self, metrics, version):
+        '''QuestionIndex.refresh() on the pool'''
+        index = self.question_index
+        versions = dict(self.versions)
+        if index.buckets is None or index.category_versions is None:
+            rows = await self.query(
+                metrics, 'fetch',
+                'SELECT id, category, difficulty FROM questions')
+            # building the buckets of a large table would hold up the
+            # other requests of the loop
+            await asyncio.get_event_loop().run_in_executor(
+                None, index.build, rows, version)
+            index.track(versions)
+        elif index.version != version:
+            # only the questions written since, like reload_changed()
+            reloaded, moved, ids = [], [], set()
+            for name, category, since, category_version in index.changed(
+                    versions):
+                logged = None
+                if index.logged(since, category_version):
+                    logged = index.logged_ids(
+                        since, category_version, await self.query(
+                            metrics, 'fetch',
+                            'SELECT version, question_id '
+                            'FROM question_changes WHERE category = $1 '
+                            'AND version > $2 AND version <= $3',
+                            category, since, category_version))
+                if logged is None:
+                    reloaded.append((name, category_version, await self.query(
+                        metrics, 'fetch',
+                        'SELECT id, difficulty FROM questions '
+                        'WHERE category = $1 ORDER BY id', category)))
+                else:
+                    moved.append((name, category_version))
+                    ids |= logged
+            index.update(version, reloaded)
+            if moved:
+                rows = await self.query(
+                    metrics, 'fetch',
+                    'SELECT id, category, difficulty FROM questions '
+                    'WHERE id = ANY($1::integer[])', sorted(ids))
+                index.move(version, moved, ids, rows)
+
+
+class Response:
+    __slots__ = ('body', 'status', 'headers', 'stream')
+
+    def __init__(self, body=b'', status=200, headers=None, stream=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+        self.stream = stream
+
+
+def error_response(status, message, error):
+    '''the body and Retry-After header of Flask's 429 and 503 handlers'''
+    headers = retry_headers(error)
+    headers['Content-Type'] = 'application/json'
+    return Response(dumps({
+        'success': False,
+        'error': status,
+        'message': message
+    }), status=status, headers=headers)
+
+
+def json_response(request, payload):
+    with timed_request(request, 'serialize'):
+        body = dumps(payload)
+    return Response(body, headers={'Content-Type': 'application/json'})
+
+
+@contextmanager
+def timed_request(request, name):
+    '''timed() for the native handlers, which run outside Flask'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = request.metrics.timings
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+'''
+TriviaASGI(wsgi_app)
+    the ASGI application: native handlers for the hot read paths, the
+    Flask app for everything else
+'''
+
+
+class TriviaASGI:
+
+    def __init__(self, wsgi_app, database_url=None):
+        self.wsgi_app = wsgi_app
+        self.config = wsgi_app.config
+        self.flask = WsgiToAsgi(wsgi_app)
+        # the options CORS(app) applies to every route of the Flask app
+        self.cors_options = get_cors_options(wsgi_app)
+        self.database_url = database_url or \
+            wsgi_app.config['SQLALCHEMY_DATABASE_URI']
+        self.database = None
+        self.key_refresher = None
+        self.routes = [
+            ('GET', re.compile(r'/categories$'), 'get_categories',
+             self.get_categories),
+            ('GET', re.compile(r'/questions$'), 'get_questions',
+             self.get_questions),
+            ('POST', re.compile(r'/questions$'), 'add_or_search_questions',
+             self.search_questions),
+            ('GET', re.compile(r'/categories/(\d+)/questions$'),
+             'get_categorized_questions', self.get_categorized_questions),
+            ('POST', re.compile(r'/quizzes$'), 'play_quiz',
+             self.play_quiz),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http' or self.database is None:
+            return await self.flask(scope, receive, send)
+
+        request = AsyncRequest(scope, receive)
+        for method, pattern, endpoint, handler in self.routes:
+            match = pattern.match(request.path)
+            if match and request.method == method:
+                response = await handler(request, *match.groups())
+                if response is not None:
+                    return await self.send(request, endpoint, response,
+                                           send)
+                break
+        await self.flask(scope, request.replay(), send)
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            # have this worker read the versions a write just bumped
+            self.database.invalidate()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        if not jwks_store.static:
+            self.key_refresher = asyncio.ensure_future(self.refresh_keys())
+        url = self.database_url or ''
+        if asyncpg is None or not re.match(r'postgres(ql)?://', url):
+            return
+        settings = dict(DATABASE_POOL, **(self.config.get('DATABASE_POOL') or
+                                          {}))
+        options = {}
+        if settings['pooler'] == 'pgbouncer':
+            # prepared statements do not survive pgbouncer's transaction
+            # mode, and neither do session settings
+            options['statement_cache_size'] = 0
+        elif settings['statement_timeout']:
+            options['server_settings'] = {
+                'statement_timeout': str(settings['statement_timeout'])}
+        pool = await asyncpg.create_pool(
+            re.sub(r'^postgres(ql)?\+\w+://', 'postgresql://', url),
+            min_size=ASYNC_POOL_MIN_SIZE, max_size=ASYNC_POOL_MAX_SIZE,
+            **options)
+        self.database = AsyncDatabase(pool)
+        await self.database.start()
+
+    async def shutdown(self):
+        if self.key_refresher is not None:
+            self.key_refresher.cancel()
+        if self.database is not None:
+            await self.database.pool.close()
+            self.database = None
+
+    async def refresh_keys(self):
+        # fetch the keys in a thread ahead of their expiry, so that
+        # requires_auth finds them cached
+        loop = asyncio.get_event_loop()
+        while True:
+            await loop.run_in_executor(None, jwks_store.refresh)
+            await asyncio.sleep(max(
+                jwks_store.expires - time.monotonic() -
+                jwks_store.refresh_margin,
+                jwks_store.min_refetch_interval))
+
+    async def rate_limited(self, request, name):
+        '''the 429 response when the client is over the limit of `name`'''
+        limiter = self.wsgi_app.extensions['rate_limiter']
+        if name not in limiter.limits:
+            return None
+        peer = request.scope.get('client')
+        client = limiter.client(peer[0] if peer else None,
+                                request.headers.get('x-forwarded-for'),
+                                request.headers.get('authorization'))
+        # the same buckets as the Flask routes; the shared ones are a
+        # round trip to Redis, taken off the event loop
+        if isinstance(limiter.buckets, MemoryBuckets):
+            wait = limiter.check(name, client)
+        else:
+            wait = await asyncio.get_event_loop().run_in_executor(
+                None, limiter.check, name, client)
+        if not wait:
+            return None
+        return error_response(429, 'Too many requests', RateLimited(wait))
+
+    def admit(self, name):
+        # the slots of the Flask routes, so that both serving modes shed
+        # the same load
+        return self.wsgi_app.extensions['admission'].admit(name)
+
+    def page_size(self, request):
+        per_page = arg_int(request.args, 'per_page',
+                           self.config['QUESTIONS_PER_PAGE'])
+        return max(1, min(per_page, self.config['MAX_QUESTIONS_PER_PAGE']))
+
+    async def conditional(self, request, names, view):
+        '''the http_cache.conditional() decorator'''
+        metrics = request.metrics
+        versions = [await self.database.get_version(name, metrics)
+                    for name in names]
+        digest = hashlib.sha1(request.full_path.encode())
+        for version, _ in versions:
+            digest.update(b':%d' % version)
+        etag = digest.hexdigest()
+        modified = [updated_at for _, updated_at in versions if updated_at]
+        last_modified = max(modified) if modified else None
+
+        if_none_match = request.headers.get('if-none-match', '').strip()
+        if if_none_match:
+            not_modified = if_none_match == '*' or etag in re.findall(
+                r'(?<!W/)"([^"]*)"', if_none_match)
+        else:
+            since = parse_http_date(
+                request.headers.get('if-modified-since'))
+            not_modified = last_modified is not None and \
+                since is not None and \
+                last_modified.replace(microsecond=0) <= since
+        response = Response(status=304) if not_modified else \
+            await view()
+        response.headers['ETag'] = '"%s"' % etag
+        if last_modified is not None:
+            response.headers['Last-Modified'] = http_date(last_modified)
+        response.headers['Cache-Control'] = \
+            'public, max-age=%d, s-maxage=%d' % (
+                self.config.get('HTTP_CACHE_MAX_AGE', HTTP_CACHE_MAX_AGE),
+                self.config.get('HTTP_CACHE_S_MAXAGE', HTTP_CACHE_S_MAXAGE))
+        return response
+
+    async def get_categories(self, request):
+        async def view():
+            _, body = await self.database.get_categories(request.metrics)
+            return Response(body,
+                            headers={'Content-Type': 'application/json'})
+        return await self.conditional(request, ['categories'], view)
+
+    async def get_questions(self, request):
+        async def view():
+            metrics = request.metrics
+            per_page = self.page_size(request)
+            questions = await self.database.paginate(
+                metrics, per_page, page=arg_int(request.args, 'page', 1),
+                after=arg_int(request.args, 'after'))
+            categories, _ = await self.database.get_categories(metrics)
+            return json_response(request, {
+                'success': True,
+                'questions': questions,
+                'totalQuestions': await self.database.count(metrics),
+                'categories': categories,
+                'nextCursor': (questions[-1]['id']
+                               if len(questions) == per_page else None)
+            })
+        return await self.conditional(request, ['questions', 'categories'],
+                                      view)
+
+    async def search_questions(self, request):
+        body = await request.get_json()
+        if not isinstance(body, dict) or 'searchTerm' not in body or \
+                not isinstance(body['searchTerm'], str) or \
+                request.args.get('stream') == 'true':
+            # new questions, streamed results and errors are Flask's
+            return None
+        terms = tokenize(body['searchTerm'])
+        if terms and not self.database.search_vector:
+            return None
+        limited = await self.rate_limited(request, 'search')
+        if limited is not None:
+            return limited
+        metrics = request.metrics
+        per_page = self.page_size(request)
+        page = arg_int(request.args, 'page', 1)
+        try:
+            with self.admit('search'):
+                if terms:
+                    questions, total = await self.database.search(
+                        metrics, terms, per_page, page=page,
+                        include_answers=bool(body.get('searchAnswers',
+                                                      False)))
+                else:
+                    questions = await self.database.paginate(
+                        metrics, per_page, page=page)
+                    total = await self.database.count(metrics)
+        except Overloaded as error:
+            return error_response(503, 'Service unavailable', error)
+        return json_response(request, {
+            'success': True,
+            'questions': questions,
+            'totalQuestions': total
+        })
+
+    async def get_categorized_questions(self, request, category_id):
+        category_id = int(category_id)
+
+        async def view():
+            metrics = request.metrics
+            if not any(arg in request.args for arg in
+                       ('page', 'per_page', 'after')):
+                return Response(
+                    headers={'Content-Type': 'application/json'},
+                    stream=astream_questions(
+                        self.database.iter_category(metrics, category_id),
+                        success=True, currentCategory=category_id))
+
+            per_page = self.page_size(request)
+            questions = await self.database.paginate(
+                metrics, per_page, page=arg_int(request.args, 'page', 1),
+                after=arg_int(request.args, 'after'), category=category_id)
+            return json_response(request, {
+                'success': True,
+                'questions': questions,
+                'totalQuestions': await self.database.count(
+                    metrics, category_id),
+                'currentCategory': category_id,
+                'nextCursor': (questions[-1]['id']
+                               if len(questions) == per_page else None)
+            })
+        return await self.conditional(
+            request, [category_version(category_id)], view)
+
+    async def play_quiz(self, request):
+        body = await request.get_json()
+        try:
+            category_id = int(body['quiz_category']['id'])
+            exclude = set(body['previous_questions'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        limited = await self.rate_limited(request, 'quizzes')
+        if limited is not None:
+            return limited
+        try:
+            with self.admit('quizzes'):
+                question = await self.database.draw(
+                    request.metrics, category_id, exclude,
+                    weights=self.config['QUIZ_DIFFICULTY_WEIGHTS'],
+                    strategy=self.config['QUIZ_DRAW_STRATEGY'])
+        except Overloaded as error:
+            return error_response(503, 'Service unavailable', error)
+        return json_response(request, {
+            'success': True,
+            'question': question
+        })
+
+    async def send(self, request, endpoint, response, send):
+        headers = dict(response.headers)
+        headers['Access-Control-Allow-Headers'] = \
+            'Content-Type,Authorization,true'
+        headers['Access-Control-Allow-Methods'] = \
+            'GET,PATCH,POST,DELETE,OPTIONS'
+        # the headers flask_cors would add, from the same options
+        headers.update(get_cors_headers(
+            self.cors_options, {'Origin': request.headers.get('origin')},
+            request.method).items())
+        if response.stream is None:
+            headers['Content-Length'] = str(len(response.body))
+        headers['Server-Timing'] = request.metrics.server_timing()
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers.items()]
+        })
+        if response.stream is None:
+            await send({'type': 'http.response.body',
+                        'body': response.body})
+        else:
+            async for chunk in response.stream:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body'})
+        record_request(endpoint, response.status, request.metrics)
+
+
+application = TriviaASGI(flask_app)
@@ -1,14 +1,34 @@
+import hashlib
 import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from ..metrics import registry, timed
+
 
 AUTH0_DOMAIN = 'udacitytrivia.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'trivia'
 
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+# used when the JWKS response carries no cache-control max-age
+JWKS_DEFAULT_TTL = 3600
+# refresh in the background this many seconds before the keys expire
+JWKS_REFRESH_MARGIN = 60
+# an unknown kid triggers at most one refetch per this many seconds
+JWKS_MIN_REFETCH_INTERVAL = 30
+
+# verified tokens kept in memory, and for how long at most
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 300))
+
 
 # AuthError Exception
 class AuthError(Exception):
@@ -57,31 +77,125 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+# JWKS key store
+class JWKSKeyStore:
+    '''
+    Process-wide cache of the identity provider's signing keys, indexed
+    by kid. Keys are kept for the cache-control max-age of the JWKS
+    response and refreshed in a background thread shortly before they
+    expire; expired keys keep being served while the provider cannot be
+    reached. Requests only wait for a fetch when there are no keys yet
+    or the kid is unknown, at most once per min_refetch_interval. A
+    store loaded from a file or fixture never goes to the network.
+    '''
+
+    def __init__(self, url=JWKS_URL, default_ttl=JWKS_DEFAULT_TTL,
+                 refresh_margin=JWKS_REFRESH_MARGIN,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 opener=urlopen):
+        self.url = url
+        self.default_ttl = default_ttl
+        self.refresh_margin = refresh_margin
+        self.min_refetch_interval = min_refetch_interval
+        self.opener = opener
+        self.keys = {}
+        self.expires = 0
+        self.static = False
+        self._last_fetch = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load(self, jwks, ttl=None):
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        self.keys = keys
+        self.expires = time.monotonic() + (
+            self.default_ttl if ttl is None else ttl)
+
+    def load_file(self, path):
+        with open(path) as jwks_file:
+            self.load(json.load(jwks_file))
+        self.static = True
 
+    def fetch(self):
+        self._last_fetch = time.monotonic()
+        response = self.opener(self.url)
+        jwks = json.loads(response.read())
+        cache_control = response.headers.get('Cache-Control') or ''
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        self.load(jwks, int(max_age.group(1)) if max_age else None)
+
+    def refresh(self):
+        requested = time.monotonic()
+        with self._lock:
+            try:
+                if self._last_fetch is not None and \
+                        self._last_fetch >= requested:
+                    # another thread fetched while we waited for the lock
+                    return
+                self.fetch()
+            except Exception as e:
+                # keep serving the keys we have until the provider is back
+                print(e)
+            finally:
+                self._refreshing = False
+
+    def may_fetch(self, now):
+        return self._last_fetch is None or \
+            now - self._last_fetch >= self.min_refetch_interval
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or not self.may_fetch(time.monotonic()):
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def get_key(self, kid):
+        if self.static:
+            return self.keys.get(kid)
+
+        now = time.monotonic()
+        if not self.keys:
+            if self.may_fetch(now):
+                self.refresh()
+        elif now >= self.expires - self.refresh_margin:
+            # expiring or expired keys are served until new ones arrive
+            self.refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None and self.may_fetch(now):
+            # the provider may have rotated its keys, look once more
+            self.refresh()
+            key = self.keys.get(kid)
+        return key
+
+
+jwks_store = JWKSKeyStore()
+if os.getenv('JWKS_FILE'):
+    jwks_store.load_file(os.getenv('JWKS_FILE'))
+
+
+def verify_decode_jwt(token):
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # CHOOSE OUR KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # GET THE PUBLIC KEY FROM THE CACHED AUTH0 JWKS
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             # USE THE KEY TO VALIDATE THE JWT
@@ -117,12 +231,102 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+# Verified token cache
+class VerifiedTokenCache:
+    '''
+    Bounded LRU cache of verified JWT payloads, keyed by a digest of the
+    token. An entry lives for at most `ttl` seconds and never past the
+    token's own exp claim, so an expired token is always re-verified
+    (and rejected) by verify_decode_jwt.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def peek(self, token):
+        # the payload if cached, without counting or reordering
+        entry = self._entries.get(self.digest(token))
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def put(self, token, payload):
+        expires = time.time() + self.ttl
+        if 'exp' in payload:
+            expires = min(expires, payload['exp'])
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (expires, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+token_cache = VerifiedTokenCache()
+
+
+registry.add_collector(lambda: [
+    ('trivia_token_cache_hits', {}, token_cache.hits),
+    ('trivia_token_cache_misses', {}, token_cache.misses)
+])
+
+
+def verify_decode_jwt_cached(token):
+    with timed('auth'):
+        payload = token_cache.get(token)
+        if payload is None:
+            payload = verify_decode_jwt(token)
+            token_cache.put(token, payload)
+    return payload
+
+
+def token_subject(authorization):
+    '''
+    the subject of the bearer token in an Authorization header value if
+    the token was already verified and is still cached, else None; never
+    verifies the token nor fetches keys, so it costs a request nothing
+    '''
+    header_parts = (authorization or '').split(' ')
+    if len(header_parts) != 2 or header_parts[0].lower() != 'bearer':
+        return None
+    payload = token_cache.peek(header_parts[1])
+    return payload.get('sub') if payload else None
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            payload = verify_decode_jwt_cached(token)
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
@@ -0,0 +1,220 @@
+import csv
+import io
+import json
+import os
+
+from sqlalchemy import func, text
+
+from models import (db, Question, bump_version, category_version,
+                    adjust_stats, stat_deltas, category_cache, log_changes,
+                    invalidate_question_caches, question_fingerprint)
+
+
+# rows inserted per transaction by import_questions()
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+# rows fetched per round trip by export_questions()
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+# errors listed in an import report, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+# fingerprints looked up per query, below SQLite's 999 parameters
+FINGERPRINT_LOOKUP_SIZE = 500
+
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+IMPORTED_FIELDS = QUESTION_FIELDS + ('fingerprint',)
+
+
+def read_ndjson(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            try:
+                line = line.decode('utf-8')
+            except UnicodeDecodeError:
+                yield line_number, ValueError('invalid UTF-8')
+                continue
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, ValueError('invalid JSON')
+
+
+def read_csv(lines):
+    # the bytes that are not UTF-8 are kept as lone surrogates, so that the
+    # row they are in is refused rather than the whole import
+    lines = (line.decode('utf-8', 'surrogateescape')
+             if isinstance(line, bytes) else line for line in lines)
+    reader = csv.DictReader(lines)
+    while True:
+        # the header is line 1
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            # DictReader only copies the line number of the rows it returns
+            yield reader.reader.line_num, ValueError('invalid CSV: %s' % e)
+            continue
+        try:
+            for value in row.values():
+                if isinstance(value, str):
+                    value.encode('utf-8')
+        except UnicodeEncodeError:
+            yield reader.line_num, ValueError('invalid UTF-8')
+            continue
+        yield reader.line_num, row
+
+
+def validate_row(row, categories):
+    '''returns the insertable values of a row, raises ValueError'''
+    if isinstance(row, ValueError):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError('expected an object')
+    missing = [field for field in QUESTION_FIELDS if row.get(field) in
+               (None, '')]
+    if missing:
+        raise ValueError('missing ' + ', '.join(missing))
+    try:
+        category = int(row['category'])
+        difficulty = int(row['difficulty'])
+    except (TypeError, ValueError):
+        raise ValueError('category and difficulty must be integers')
+    if category not in categories:
+        raise ValueError('unknown category %d' % category)
+    if not 1 <= difficulty <= 5:
+        raise ValueError('difficulty must be between 1 and 5')
+    return {
+        'question': str(row['question']),
+        'answer': str(row['answer']),
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
+def insert_batch(batch):
+    '''
+    inserts the rows of a batch whose fingerprint is new, in the table and
+    earlier in the batch, and returns how many were inserted
+    '''
+    for values in batch:
+        values['fingerprint'] = question_fingerprint(values['question'],
+                                                     values['answer'])
+    if db.engine.dialect.name == 'postgresql':
+        # COPY is several times faster than a multi-row INSERT, but has
+        # no ON CONFLICT: the rows go through a temporary table
+        db.session.execute(text(
+            'CREATE TEMPORARY TABLE questions_import (position integer, '
+            'question text, answer text, category integer, '
+            'difficulty integer, fingerprint varchar(32)) ON COMMIT DROP'))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for position, values in enumerate(batch):
+            writer.writerow([position] + [values[field] for field in
+                                          IMPORTED_FIELDS])
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            'COPY questions_import (position, question, answer, category, '
+            'difficulty, fingerprint) FROM STDIN WITH CSV', buffer)
+        inserted = [tuple(row) for row in db.session.execute(text(
+            'INSERT INTO questions (question, answer, category, difficulty, '
+            'fingerprint) '
+            'SELECT question, answer, category, difficulty, fingerprint '
+            'FROM questions_import ORDER BY position '
+            'ON CONFLICT (fingerprint) DO NOTHING '
+            'RETURNING id, category, difficulty'))]
+    else:
+        # SQLite has a single writer: the fingerprints already there are
+        # looked up, and the other rows inserted
+        rows = {}
+        for values in batch:
+            rows.setdefault(values['fingerprint'], values)
+        fingerprints = list(rows)
+        last_id = db.session.query(func.max(Question.id)).scalar() or 0
+        for start in range(0, len(fingerprints), FINGERPRINT_LOOKUP_SIZE):
+            for fingerprint, in db.session.query(Question.fingerprint).filter(
+                    Question.fingerprint.in_(
+                        fingerprints[start:start + FINGERPRINT_LOOKUP_SIZE])):
+                del rows[fingerprint]
+        if rows:
+            db.session.execute(Question.__table__.insert().prefix_with(
+                'OR IGNORE', dialect='sqlite'), list(rows.values()))
+        # the only writer, whose rows come after the last id
+        inserted = [tuple(row) for row in db.session.query(
+            Question.id, Question.category, Question.difficulty).filter(
+                Question.id > last_id)]
+    names = ['questions'] + [category_version(category) for category in
+                             {category for _, category, _ in inserted}]
+    bump_version(*names)
+    log_changes(names, [(category, question_id)
+                        for question_id, category, _ in inserted])
+    adjust_stats(stat_deltas(added=[(category, difficulty)
+                                    for _, category, difficulty in inserted]))
+    db.session.commit()
+    invalidate_question_caches()
+    return len(inserted)
+
+
+'''
+import_questions(lines, format='ndjson', batch_size=IMPORT_BATCH_SIZE)
+    validates and inserts the questions read from an iterable of NDJSON
+    or CSV lines, one transaction per batch, skipping the questions
+    already there or earlier in the lines (up to case and spacing).
+    Returns a report with the number of inserted, duplicate and failed
+    rows and the first errors by line.
+'''
+
+
+def import_questions(lines, format='ndjson', batch_size=IMPORT_BATCH_SIZE):
+    rows = read_csv(lines) if format == 'csv' else read_ndjson(lines)
+    categories = category_cache.get().categories
+    report = {'inserted': 0, 'duplicates': 0, 'failed': 0, 'errors': []}
+    batch = []
+    for line_number, row in rows:
+        try:
+            batch.append(validate_row(row, categories))
+        except ValueError as e:
+            report['failed'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({'line': line_number,
+                                         'error': str(e)})
+            continue
+        if len(batch) >= batch_size:
+            inserted = insert_batch(batch)
+            report['inserted'] += inserted
+            report['duplicates'] += len(batch) - inserted
+            batch = []
+    if batch:
+        inserted = insert_batch(batch)
+        report['inserted'] += inserted
+        report['duplicates'] += len(batch) - inserted
+    return report
+
+
+'''
+export_questions(format='ndjson')
+    yields every question as NDJSON or CSV lines, ordered by id, fetching
+    EXPORT_BATCH_SIZE rows at a time instead of loading the whole table
+'''
+
+
+def export_questions(format='ndjson'):
+    rows = db.session.query(
+        Question.id, Question.question, Question.answer, Question.category,
+        Question.difficulty).order_by(Question.id).yield_per(
+            EXPORT_BATCH_SIZE)
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('id',) + QUESTION_FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(row._asdict()) + '\n'
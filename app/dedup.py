@@ -0,0 +1,223 @@
+'''
+Near-duplicate detection of the questions, run offline with
+
+    python manage.py find_duplicates --threshold 0.8
+
+Questions with the same text up to case and spacing are already refused
+by the unique fingerprint index. This job finds the ones that are almost
+the same: each question gets a MinHash signature of the character
+shingles of its text, the signatures are cut into bands, and questions
+sharing a band are candidates whose similarity is estimated from their
+signatures. The band keys, signatures and candidate pairs are kept in a
+SQLite file on disk, so that memory only ever holds a batch of rows,
+whatever the size of the table.
+
+The questions repeated exactly, which the unique fingerprint index would
+refuse, are deleted by
+
+    python manage.py delete_duplicates
+
+before the migration adding that index is run.
+'''
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import zlib
+from array import array
+
+from models import db, Question, delete_questions, question_fingerprint
+
+
+# characters per shingle
+DEDUP_SHINGLE_SIZE = int(os.getenv('DEDUP_SHINGLE_SIZE', 5))
+# bands of rows of the MinHash signatures: with 16 bands of 4 rows, pairs
+# of similarity 0.5 are found half of the time, of 0.8 almost always
+DEDUP_BANDS = int(os.getenv('DEDUP_BANDS', 16))
+DEDUP_ROWS = int(os.getenv('DEDUP_ROWS', 4))
+# questions read from the database per round trip
+DEDUP_BATCH_SIZE = int(os.getenv('DEDUP_BATCH_SIZE', 1000))
+# questions sharing a band key beyond this many are only compared with
+# the oldest of them, instead of with each other
+DEDUP_MAX_BUCKET = int(os.getenv('DEDUP_MAX_BUCKET', 100))
+# questions deleted per statement, below SQLite's 999 parameters
+DELETE_BATCH_SIZE = 500
+
+MASK64 = (1 << 64) - 1
+
+
+def shingles(question, answer, size=DEDUP_SHINGLE_SIZE):
+    # the CRC-32 of every `size` characters of the words of the text
+    text = ' '.join(re.findall(r'\w+', ('%s | %s' % (
+        question or '', answer or '')).casefold()))
+    if not text:
+        return set()
+    return {zlib.crc32(text[start:start + size].encode('utf-8'))
+            for start in range(max(len(text) - size + 1, 1))}
+
+
+'''
+MinHasher(bands, rows)
+    MinHash signatures of bands * rows values, each the minimum of a
+    multiply-shift hash of the shingles, and their band keys
+'''
+
+
+class MinHasher:
+
+    def __init__(self, bands=DEDUP_BANDS, rows=DEDUP_ROWS, seed=0):
+        rng = random.Random(seed)
+        self.bands = bands
+        self.rows = rows
+        self.coefficients = [(rng.getrandbits(64) | 1, rng.getrandbits(64))
+                             for _ in range(bands * rows)]
+
+    def signature(self, hashes):
+        return array('I', [min(((a * value + b) & MASK64) >> 32
+                                for value in hashes)
+                           for a, b in self.coefficients])
+
+    def band_keys(self, signature):
+        # a signed 64 bit key per band, as SQLite stores integers
+        return [int.from_bytes(hashlib.blake2b(
+            signature[band * self.rows:(band + 1) * self.rows].tobytes(),
+            digest_size=8).digest(), 'little', signed=True)
+            for band in range(self.bands)]
+
+
+def similarity(signature, other):
+    # share of equal values, an estimate of the Jaccard similarity
+    return sum(1 for value, other_value in zip(signature, other)
+               if value == other_value) / float(len(signature))
+
+
+def read_questions(batch_size=DEDUP_BATCH_SIZE):
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Question.id, Question.question, Question.answer).filter(
+                Question.id > last_id).order_by(Question.id).limit(
+                    batch_size).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+'''
+near_duplicates(threshold=0.8)
+    yields (id, duplicate_of, similarity) for every question whose
+    estimated similarity to an older question is at least `threshold`,
+    ordered by id
+'''
+
+
+def near_duplicates(threshold=0.8, hasher=None, batch_size=DEDUP_BATCH_SIZE,
+                    max_bucket=DEDUP_MAX_BUCKET):
+    hasher = hasher or MinHasher()
+    with tempfile.TemporaryDirectory(prefix='trivia-dedup-') as directory:
+        store = sqlite3.connect(os.path.join(directory, 'dedup.db'))
+        try:
+            # a scratch file, thrown away if anything fails
+            store.execute('PRAGMA journal_mode = OFF')
+            store.execute('PRAGMA synchronous = OFF')
+            store.execute('CREATE TABLE signatures '
+                          '(id INTEGER PRIMARY KEY, signature BLOB)')
+            store.execute('CREATE TABLE bands (band INTEGER, key INTEGER, '
+                          'id INTEGER)')
+            store.execute('CREATE TABLE pairs (id INTEGER, '
+                          'duplicate_of INTEGER, '
+                          'PRIMARY KEY (id, duplicate_of)) WITHOUT ROWID')
+            for rows in read_questions(batch_size):
+                signatures, bands = [], []
+                for question_id, question, answer in rows:
+                    hashes = shingles(question, answer)
+                    if not hashes:
+                        continue
+                    signature = hasher.signature(hashes)
+                    signatures.append((question_id, signature.tobytes()))
+                    bands.extend((band, key, question_id) for band, key in
+                                 enumerate(hasher.band_keys(signature)))
+                store.executemany('INSERT INTO signatures VALUES (?, ?)',
+                                  signatures)
+                store.executemany('INSERT INTO bands VALUES (?, ?, ?)', bands)
+                store.commit()
+                # the session's snapshot is not needed between batches
+                db.session.commit()
+
+            # the questions sharing a band key are candidates, all pairs of
+            # them in the usual small buckets, each with the oldest in the
+            # larger ones
+            store.execute('CREATE INDEX ix_bands ON bands (band, key, id)')
+            store.execute('CREATE TABLE buckets AS SELECT band, key, '
+                          'count(*) AS size, min(id) AS oldest FROM bands '
+                          'GROUP BY band, key HAVING count(*) > 1')
+            store.execute(
+                'INSERT OR IGNORE INTO pairs SELECT newer.id, older.id '
+                'FROM buckets '
+                'JOIN bands newer ON newer.band = buckets.band '
+                'AND newer.key = buckets.key '
+                'JOIN bands older ON older.band = buckets.band '
+                'AND older.key = buckets.key AND older.id < newer.id '
+                'WHERE buckets.size <= ?', (max_bucket,))
+            store.execute(
+                'INSERT OR IGNORE INTO pairs SELECT newer.id, buckets.oldest '
+                'FROM buckets '
+                'JOIN bands newer ON newer.band = buckets.band '
+                'AND newer.key = buckets.key AND newer.id > buckets.oldest '
+                'WHERE buckets.size > ?', (max_bucket,))
+            store.commit()
+
+            for question_id, duplicate_of, signature, other in store.execute(
+                    'SELECT pairs.id, pairs.duplicate_of, a.signature, '
+                    'b.signature FROM pairs '
+                    'JOIN signatures a ON a.id = pairs.id '
+                    'JOIN signatures b ON b.id = pairs.duplicate_of '
+                    'ORDER BY pairs.id, pairs.duplicate_of'):
+                score = similarity(array('I', signature), array('I', other))
+                if score >= threshold:
+                    yield question_id, duplicate_of, round(score, 3)
+        finally:
+            store.close()
+
+
+'''
+delete_exact_duplicates()
+    deletes every question whose fingerprint is that of an older one,
+    and returns how many were deleted
+'''
+
+
+def delete_exact_duplicates(batch_size=DEDUP_BATCH_SIZE):
+    # only the id and texts are read, so that it runs on a table that has
+    # no fingerprint column yet
+    with tempfile.TemporaryDirectory(prefix='trivia-dedup-') as directory:
+        store = sqlite3.connect(os.path.join(directory, 'dedup.db'))
+        try:
+            store.execute('PRAGMA journal_mode = OFF')
+            store.execute('PRAGMA synchronous = OFF')
+            store.execute('CREATE TABLE fingerprints '
+                          '(id INTEGER PRIMARY KEY, fingerprint TEXT)')
+            for rows in read_questions(batch_size):
+                store.executemany(
+                    'INSERT INTO fingerprints VALUES (?, ?)',
+                    [(question_id, question_fingerprint(question, answer))
+                     for question_id, question, answer in rows])
+                store.commit()
+                db.session.commit()
+            store.execute('CREATE INDEX ix_fingerprints '
+                          'ON fingerprints (fingerprint, id)')
+            duplicates = [row[0] for row in store.execute(
+                'SELECT id FROM fingerprints WHERE EXISTS ('
+                'SELECT 1 FROM fingerprints AS older '
+                'WHERE older.fingerprint = fingerprints.fingerprint '
+                'AND older.id < fingerprints.id) ORDER BY id')]
+        finally:
+            store.close()
+    deleted = 0
+    for start in range(0, len(duplicates), DELETE_BATCH_SIZE):
+        deleted += delete_questions(
+            duplicates[start:start + DELETE_BATCH_SIZE])
+    return deleted
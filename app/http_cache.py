@@ -0,0 +1,66 @@
+import hashlib
+import os
+from functools import wraps
+from flask import request, current_app
+
+from models import content_versions
+
+
+# Cache-Control of conditional responses: browsers revalidate every time,
+# a CDN may serve a response for HTTP_CACHE_S_MAXAGE seconds
+HTTP_CACHE_MAX_AGE = int(os.getenv('HTTP_CACHE_MAX_AGE', 0))
+HTTP_CACHE_S_MAXAGE = int(os.getenv('HTTP_CACHE_S_MAXAGE', 10))
+
+
+def versions_etag(names):
+    '''
+    returns the strong ETag of the current request given the content
+    versions it depends on, and the time those were last modified
+    '''
+    versions = [content_versions.get(name) for name in names]
+    digest = hashlib.sha1(request.full_path.encode())
+    for version, _ in versions:
+        digest.update(b':%d' % version)
+    modified = [updated_at for _, updated_at in versions if updated_at]
+    return digest.hexdigest(), max(modified) if modified else None
+
+
+def set_cache_headers(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get(
+        'HTTP_CACHE_MAX_AGE', HTTP_CACHE_MAX_AGE)
+    response.cache_control.s_maxage = current_app.config.get(
+        'HTTP_CACHE_S_MAXAGE', HTTP_CACHE_S_MAXAGE)
+    return response
+
+
+def conditional(versions):
+    '''
+    Decorator for read endpoints whose body only changes with the content
+    versions returned by `versions(**view_args)`. Answers If-None-Match
+    and If-Modified-Since with 304 before the view runs, and adds ETag,
+    Last-Modified and Cache-Control to full responses.
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = versions_etag(versions(**kwargs))
+            not_modified = etag in request.if_none_match if \
+                request.if_none_match else (
+                    last_modified is not None and
+                    request.if_modified_since is not None and
+                    last_modified.replace(microsecond=0) <=
+                    request.if_modified_since.replace(tzinfo=None))
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return set_cache_headers(response, etag, last_modified)
+
+        return wrapper
+    return conditional_decorator
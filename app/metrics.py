@@ -0,0 +1,263 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db, TimedQueuePool, replica_set
+
+
+# statements slower than this many seconds are logged with their SQL
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', 0.5))
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger('trivia.metrics')
+
+
+'''
+RequestMetrics
+    what the current request spent its time on, kept in flask.g
+'''
+
+
+class RequestMetrics:
+    __slots__ = ('started', 'queries', 'db_time', 'timings')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.timings = {}
+
+    def server_timing(self):
+        total = time.perf_counter() - self.started
+        parts = ['db;dur=%.2f;desc="%d queries"' % (self.db_time * 1000,
+                                                     self.queries)]
+        parts += ['%s;dur=%.2f' % (name, seconds * 1000)
+                  for name, seconds in sorted(self.timings.items())]
+        parts.append('total;dur=%.2f' % (total * 1000))
+        return ', '.join(parts)
+
+
+def current_metrics():
+    if has_request_context():
+        return g.get('metrics')
+    return None
+
+
+@contextmanager
+def timed(name):
+    '''adds the time spent in the block to the request's `name` timing'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.timings[name] = metrics.timings.get(name, 0.0) + \
+                time.perf_counter() - start
+
+
+'''
+Registry
+    process-wide counters and histograms rendered in the Prometheus text
+    format by GET /metrics. Other modules add gauges with add_collector().
+'''
+
+
+class Registry:
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=REQUEST_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts, total, observations = self.histograms.get(
+                key, ([0] * len(buckets), 0.0, 0))
+            counts = [count + (value <= bound)
+                      for count, bound in zip(counts, buckets)]
+            self.histograms[key] = (counts, total + value, observations + 1)
+
+    def add_collector(self, collector):
+        '''collector() returns (name, labels, value) gauges'''
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        for (name, labels), value in counters:
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), (counts, total, observations) in histograms:
+            for bound, count in zip(REQUEST_BUCKETS, counts):
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', str(bound)),)),
+                    count))
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(labels + (('le', '+Inf'),)),
+                observations))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                           total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                             observations))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                lines.append('%s%s %s' % (
+                    name, format_labels(tuple(sorted(labels.items()))),
+                    value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value)
+                             for key, value in labels)
+
+
+registry = Registry()
+
+
+def process_started():
+    # when this process started on the monotonic clock, from its start
+    # time in clock ticks since boot on Linux, or else now
+    now = time.monotonic()
+    try:
+        with open('/proc/self/stat') as stat:
+            ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+        started = ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return now
+    return started if 0 <= now - started < 3600 else now
+
+
+# when this worker started and was ready to serve, and how long its first
+# request took: together, the time to first request of a new worker
+startup = {'started': process_started(), 'ready': None,
+           'first_request': None}
+
+
+def mark_worker_started():
+    '''measures the startup from now, e.g. right after a fork'''
+    startup.update(started=time.monotonic(), ready=None, first_request=None)
+
+
+def mark_worker_ready():
+    if startup['ready'] is None:
+        startup['ready'] = time.monotonic() - startup['started']
+
+
+def startup_gauges():
+    gauges = []
+    if startup['ready'] is not None:
+        gauges.append(('trivia_worker_startup_seconds', {},
+                       round(startup['ready'], 3)))
+    if startup['first_request'] is not None:
+        gauges.append(('trivia_worker_first_request_seconds', {},
+                       round(startup['first_request'], 3)))
+    return gauges
+
+
+def pool_gauges():
+    '''connection pool usage of the current app's engine'''
+    if not has_app_context():
+        return []
+    pool = db.engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return []
+    return [
+        ('trivia_db_pool_size', {}, pool.size()),
+        ('trivia_db_pool_checked_out', {}, pool.checkedout()),
+        ('trivia_db_pool_overflow', {}, max(pool.overflow(), 0)),
+        ('trivia_db_pool_saturation', {}, round(pool.saturation(), 3)),
+        ('trivia_db_pool_checkouts_total', {}, pool.checkouts),
+        ('trivia_db_pool_wait_seconds_total', {}, pool.wait_time),
+        ('trivia_db_pool_timeouts_total', {}, pool.timeouts)
+    ]
+
+
+def replica_gauges():
+    '''whether each replica was usable when last checked'''
+    return [('trivia_db_replica_up', {'replica': bind},
+             int(replica_set.versions.get(bind) is not None))
+            for bind in replica_set.binds]
+
+
+registry.add_collector(pool_gauges)
+registry.add_collector(replica_gauges)
+registry.add_collector(startup_gauges)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # on the execution context, which a failed statement does not outlive
+    context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.perf_counter() - context._query_start
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.queries += 1
+        metrics.db_time += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        # not the parameters, which hold questions, answers and search
+        # terms
+        logger.warning('slow query (%.3fs) on %s: %s', elapsed,
+                       request.path if has_request_context() else '-',
+                       statement)
+
+
+def init_metrics(app):
+    '''
+    records query count, DB time and the timed() sections of every
+    request, sends them back in a Server-Timing header and adds them to
+    the registry
+    '''
+    mark_worker_ready()
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics = RequestMetrics()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        metrics = current_metrics()
+        if metrics is None:
+            return response
+        response.headers['Server-Timing'] = metrics.server_timing()
+        record_request(request.endpoint or 'none', response.status_code,
+                       metrics)
+        return response
+
+
+def record_request(endpoint, status, metrics):
+    '''adds a finished request to the registry'''
+    labels = {'endpoint': endpoint}
+    registry.inc('trivia_requests_total', dict(labels, status=status))
+    duration = time.perf_counter() - metrics.started
+    if startup['first_request'] is None:
+        startup['first_request'] = duration
+        logger.info('worker ready in %.3fs, first request took %.3fs',
+                    startup['ready'] or 0, duration)
+    registry.observe('trivia_request_duration_seconds', labels, duration)
+    registry.inc('trivia_db_queries_total', labels, metrics.queries)
+    registry.inc('trivia_db_seconds_total', labels, metrics.db_time)
+    for name, seconds in metrics.timings.items():
+        registry.inc('trivia_%s_seconds_total' % name, labels, seconds)
@@ -0,0 +1,57 @@
+"""full-text search vector for questions
+
+Revision ID: 3c9a1f0e5b21
+Revises: 7ee21e6de6da
+Create Date: 2026-10-18 09:12:44.316502
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9a1f0e5b21'
+down_revision = '7ee21e6de6da'
+branch_labels = None
+depends_on = None
+
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce({row}question, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({row}answer, '')), 'B')")
+
+
+def upgrade():
+    # tsvector and GIN are Postgres only, other databases fall back to
+    # the in-process search index in models.py
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('ALTER TABLE questions ADD COLUMN search_vector tsvector')
+    op.execute('UPDATE questions SET search_vector = ' +
+               SEARCH_VECTOR.format(row=''))
+    op.execute('CREATE INDEX ix_questions_search_vector '
+               'ON questions USING gin (search_vector)')
+    op.execute('''
+        CREATE FUNCTION questions_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := ''' + SEARCH_VECTOR.format(row='NEW.') + ''';
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER questions_search_vector_update
+        BEFORE INSERT OR UPDATE OF question, answer ON questions
+        FOR EACH ROW EXECUTE PROCEDURE questions_search_vector_update()
+    ''')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('DROP TRIGGER questions_search_vector_update ON questions')
+    op.execute('DROP FUNCTION questions_search_vector_update()')
+    op.execute('DROP INDEX ix_questions_search_vector')
+    op.execute('ALTER TABLE questions DROP COLUMN search_vector')
@@ -0,0 +1,70 @@
+"""question category indexes and foreign key
+
+Revision ID: 5e2b8d4c7a19
+Revises: a41d7c2e9f03
+Create Date: 2026-10-18 13:41:09.520377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2b8d4c7a19'
+down_revision = 'a41d7c2e9f03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index('ix_questions_category_id', 'questions',
+                        ['category', 'id'])
+        op.create_index('ix_questions_category_difficulty_id', 'questions',
+                        ['category', 'difficulty', 'id'])
+        # SQLite cannot add a constraint to an existing table
+        return
+    # the database restored from trivia.psql already has a foreign key on
+    # questions.category (named category, with ON UPDATE CASCADE and ON
+    # DELETE SET NULL), which is kept rather than doubled
+    add_foreign_key = not any(
+        foreign_key['constrained_columns'] == ['category']
+        for foreign_key in sa.inspect(op.get_bind()).get_foreign_keys(
+            'questions'))
+    # each statement commits on its own: the indexes are built without
+    # blocking writes, NOT VALID only holds its lock for the catalog
+    # change, and VALIDATE then scans the rows in its own transaction
+    # under a lock that lets writes through
+    with op.get_context().autocommit_block():
+        op.create_index('ix_questions_category_id', 'questions',
+                        ['category', 'id'], postgresql_concurrently=True)
+        op.create_index('ix_questions_category_difficulty_id', 'questions',
+                        ['category', 'difficulty', 'id'],
+                        postgresql_concurrently=True)
+        if add_foreign_key:
+            op.execute('ALTER TABLE questions ADD CONSTRAINT '
+                       'questions_category_fkey FOREIGN KEY (category) '
+                       'REFERENCES categories (id) '
+                       'ON UPDATE CASCADE ON DELETE SET NULL NOT VALID')
+            op.execute('ALTER TABLE questions '
+                       'VALIDATE CONSTRAINT questions_category_fkey')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        op.drop_index('ix_questions_category_difficulty_id', 'questions')
+        op.drop_index('ix_questions_category_id', 'questions')
+        return
+    # only the foreign key the upgrade added, not the one it found
+    drop_foreign_key = any(
+        foreign_key['name'] == 'questions_category_fkey'
+        for foreign_key in sa.inspect(op.get_bind()).get_foreign_keys(
+            'questions'))
+    with op.get_context().autocommit_block():
+        if drop_foreign_key:
+            op.drop_constraint('questions_category_fkey', 'questions',
+                               type_='foreignkey')
+        op.drop_index('ix_questions_category_difficulty_id', 'questions',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_questions_category_id', 'questions',
+                      postgresql_concurrently=True)
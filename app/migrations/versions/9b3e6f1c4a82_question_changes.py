@@ -0,0 +1,36 @@
+"""question ids written by each category version
+
+Revision ID: 9b3e6f1c4a82
+Revises: e4a7c19b2d58
+Create Date: 2026-10-18 21:07:33.184620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3e6f1c4a82'
+down_revision = 'e4a7c19b2d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('question_changes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('category', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('question_id', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_question_changes_category_version',
+                    'question_changes', ['category', 'version'])
+    # nothing is logged for the versions already there: the workers read
+    # their categories again once, on the next write
+
+
+def downgrade():
+    op.drop_index('ix_question_changes_category_version',
+                  table_name='question_changes')
+    op.drop_table('question_changes')
@@ -0,0 +1,57 @@
+"""content version stamps
+
+Revision ID: a41d7c2e9f03
+Revises: 3c9a1f0e5b21
+Create Date: 2026-10-18 11:03:27.845113
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41d7c2e9f03'
+down_revision = '3c9a1f0e5b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    version_table = op.create_table('content_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(version_table, [
+        {'name': 'categories', 'version': 1,
+         'updated_at': datetime.datetime.utcnow()}
+    ])
+
+    # on Postgres, also bump the stamp when categories are edited by hand
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('''
+        CREATE FUNCTION categories_bump_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE content_versions
+            SET version = version + 1, updated_at = now() at time zone 'utc'
+            WHERE name = 'categories';
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER categories_bump_version
+        AFTER INSERT OR UPDATE OR DELETE ON categories
+        FOR EACH STATEMENT EXECUTE PROCEDURE categories_bump_version()
+    ''')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP TRIGGER categories_bump_version ON categories')
+        op.execute('DROP FUNCTION categories_bump_version()')
+    op.drop_table('content_versions')
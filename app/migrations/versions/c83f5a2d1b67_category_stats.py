@@ -0,0 +1,41 @@
+"""question counts per category and difficulty
+
+Revision ID: c83f5a2d1b67
+Revises: 5e2b8d4c7a19
+Create Date: 2026-10-18 16:12:48.301952
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c83f5a2d1b67'
+down_revision = '5e2b8d4c7a19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('category_stats',
+    sa.Column('category', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('difficulty', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('question_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('category', 'difficulty')
+    )
+    # the questions already there, counted once
+    op.execute('''
+        INSERT INTO category_stats (category, difficulty, question_count)
+        SELECT category, difficulty, count(*) FROM questions
+        WHERE category IS NOT NULL AND difficulty IS NOT NULL
+        GROUP BY category, difficulty
+    ''')
+    # workers reload their counts
+    op.execute('''
+        UPDATE content_versions SET version = version + 1
+        WHERE name = 'questions' OR name LIKE 'questions:%'
+    ''')
+
+
+def downgrade():
+    op.drop_table('category_stats')
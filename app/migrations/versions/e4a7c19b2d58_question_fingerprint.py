@@ -0,0 +1,81 @@
+"""fingerprint of the question text, unique
+
+Revision ID: e4a7c19b2d58
+Revises: c83f5a2d1b67
+Create Date: 2026-10-18 19:41:07.552318
+
+"""
+import hashlib
+import logging
+
+from alembic import op
+from alembic.util import CommandError
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7c19b2d58'
+down_revision = 'c83f5a2d1b67'
+branch_labels = None
+depends_on = None
+
+log = logging.getLogger('alembic.runtime.migration')
+
+# rows fingerprinted per round trip
+BATCH_SIZE = 5000
+
+
+def question_fingerprint(question, answer):
+    # models.question_fingerprint() as of this revision, frozen here so
+    # that replaying the migration always writes the same values
+    if question is None or answer is None:
+        return None
+    text = '\x1f'.join(' '.join(str(value).casefold().split())
+                       for value in (question, answer))
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def upgrade():
+    op.add_column('questions', sa.Column('fingerprint', sa.String(length=32),
+                                         nullable=True))
+    # the fingerprints are computed here rather than in SQL, to match the
+    # app's exactly, a batch of rows at a time
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.text(
+            'SELECT id, question, answer FROM questions WHERE id > :last_id '
+            'ORDER BY id LIMIT :limit'),
+            last_id=last_id, limit=BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        connection.execute(sa.text(
+            'UPDATE questions SET fingerprint = :fingerprint '
+            'WHERE id = :question_id'),
+            [{'question_id': question_id,
+              'fingerprint': question_fingerprint(question, answer)}
+             for question_id, question, answer in rows])
+        last_id = rows[-1][0]
+    # the questions repeated already are left to
+    # `python manage.py delete_duplicates`, which deletes them where it
+    # can be reviewed and backed up first, rather than in a migration that
+    # cannot put them back
+    duplicates = connection.execute(sa.text(
+        'SELECT count(fingerprint) - count(DISTINCT fingerprint) '
+        'FROM questions')).scalar()
+    if duplicates:
+        log.error('%d questions repeat an older one, delete them with '
+                  '`python manage.py delete_duplicates` and upgrade again',
+                  duplicates)
+        # undone by hand where the DDL is not transactional (SQLite)
+        with op.batch_alter_table('questions') as batch_op:
+            batch_op.drop_column('fingerprint')
+        raise CommandError('%d duplicate questions' % duplicates)
+    op.create_index('ix_questions_fingerprint', 'questions', ['fingerprint'],
+                    unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_questions_fingerprint', table_name='questions')
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.drop_column('fingerprint')
@@ -0,0 +1,260 @@
+import bisect
+import os
+import secrets
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# 'redis' to share the sessions between workers, which a deployment with
+# more than one worker needs (gunicorn warns otherwise)
+QUIZ_SESSION_BACKEND = os.getenv('QUIZ_SESSION_BACKEND', 'memory')
+QUIZ_SESSION_TTL = int(os.getenv('QUIZ_SESSION_TTL', 3600))
+# sessions kept by either backend before the least recently used are
+# evicted
+QUIZ_SESSION_MAX = int(os.getenv('QUIZ_SESSION_MAX', 10000))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# weight of the latest answer in the running score of an adaptive quiz
+QUIZ_ADAPTIVE_RATE = float(os.getenv('QUIZ_ADAPTIVE_RATE', 0.3))
+# question difficulties, the bands an adaptive quiz moves between
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+
+
+'''
+QuizSession
+    a quiz in progress: its category, the sorted array of question ids
+    already played and, for an adaptive quiz, the running score of the
+    answers reported so far, from 0 (all wrong) to 1 (all right)
+'''
+
+
+class QuizSession:
+    __slots__ = ('id', 'category', 'used', 'expires', 'adaptive', 'score',
+                 'answered')
+
+    def __init__(self, id, category, used=(), expires=0, adaptive=False,
+                 score=0.5, answered=0):
+        self.id = id
+        self.category = category
+        self.used = array('l', sorted(used))
+        self.expires = expires
+        self.adaptive = adaptive
+        self.score = score
+        self.answered = answered
+
+    def __len__(self):
+        return len(self.used)
+
+    def __iter__(self):
+        return iter(self.used)
+
+    def __contains__(self, question_id):
+        position = bisect.bisect_left(self.used, question_id)
+        return position < len(self.used) and \
+            self.used[position] == question_id
+
+    def add(self, question_id):
+        if question_id not in self:
+            bisect.insort(self.used, question_id)
+
+    def record(self, correct):
+        '''
+        adds the answer to the last question played to the score of an
+        adaptive quiz, returns False if there is nothing to answer
+        '''
+        if not self.adaptive or self.answered >= len(self.used):
+            return False
+        self.answered += 1
+        self.score += QUIZ_ADAPTIVE_RATE * (float(correct) - self.score)
+        return True
+
+    def difficulty(self):
+        '''the difficulty band of the next question, from the score'''
+        return MIN_DIFFICULTY + int(
+            self.score * (MAX_DIFFICULTY - MIN_DIFFICULTY) + 0.5)
+
+
+'''
+MemorySessionBackend
+    keeps sessions in this process, expiring them after `ttl` seconds of
+    inactivity and evicting the least recently used beyond `maxsize`
+'''
+
+
+class MemorySessionBackend:
+
+    def __init__(self, ttl=QUIZ_SESSION_TTL, maxsize=QUIZ_SESSION_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, category, adaptive=False):
+        session = QuizSession(secrets.token_urlsafe(16), category,
+                              expires=time.monotonic() + self.ttl,
+                              adaptive=adaptive)
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if session.expires < time.monotonic():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            session.expires = time.monotonic() + self.ttl
+            return session
+
+    def add_used(self, session, question_id):
+        with self._lock:
+            session.add(question_id)
+
+    def record_answer(self, session, correct):
+        with self._lock:
+            return session.record(correct)
+
+
+# registers a new session in the index of sessions by last use, dropping
+# the expired ones and evicting the least recently used beyond the cap
+CREATE_SCRIPT = '''
+local now, ttl, maxsize = tonumber(ARGV[1]), tonumber(ARGV[2]),
+    tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - ttl)
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+local excess = redis.call('ZCARD', KEYS[1]) - maxsize
+if excess > 0 then
+    local evicted = redis.call('ZRANGE', KEYS[1], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    for _, session_id in ipairs(evicted) do
+        redis.call('DEL', ARGV[5] .. session_id,
+                   ARGV[5] .. session_id .. ':used')
+    end
+end
+'''
+
+# QuizSession.record() on the hash of the session, atomic so that
+# concurrent answers are all counted; the score is returned as a string
+# since Redis truncates Lua numbers to integers
+RECORD_SCRIPT = '''
+local answered = tonumber(redis.call('HGET', KEYS[1], 'answered'))
+if not answered or answered >= redis.call('STRLEN', KEYS[2]) / 4 then
+    return false
+end
+local score = tonumber(redis.call('HGET', KEYS[1], 'score'))
+score = score + tonumber(ARGV[1]) * (tonumber(ARGV[2]) - score)
+redis.call('HSET', KEYS[1], 'score', tostring(score),
+           'answered', answered + 1)
+return {tostring(score), answered + 1}
+'''
+
+
+'''
+RedisSessionBackend
+    keeps sessions in Redis (or any server speaking its protocol and Lua)
+    so that every worker sees them; the category and score are stored in
+    a hash, the used ids appended to a packed array of 4 bytes each, and
+    both keys expire after `ttl` seconds of inactivity. At most `maxsize`
+    sessions are kept, the least recently used evicted first.
+'''
+
+
+class RedisSessionBackend:
+
+    def __init__(self, client, ttl=QUIZ_SESSION_TTL, prefix='quiz:session:',
+                 maxsize=QUIZ_SESSION_MAX):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.maxsize = maxsize
+        self.index = prefix + 'index'
+        self.create_script = client.register_script(CREATE_SCRIPT)
+        self.record_script = client.register_script(RECORD_SCRIPT)
+
+    def create(self, category, adaptive=False):
+        session = QuizSession(secrets.token_urlsafe(16), category,
+                              adaptive=adaptive)
+        key = self.prefix + session.id
+        pipe = self.client.pipeline()
+        pipe.hset(key, 'category', category)
+        if adaptive:
+            pipe.hset(key, 'score', session.score)
+            pipe.hset(key, 'answered', 0)
+        pipe.expire(key, self.ttl)
+        self.create_script(keys=[self.index],
+                           args=[time.time(), self.ttl, self.maxsize,
+                                 session.id, self.prefix], client=pipe)
+        pipe.execute()
+        return session
+
+    def get(self, session_id):
+        key = self.prefix + session_id
+        pipe = self.client.pipeline()
+        pipe.hmget(key, 'category', 'score', 'answered')
+        pipe.get(key + ':used')
+        pipe.expire(key, self.ttl)
+        pipe.expire(key + ':used', self.ttl)
+        pipe.zadd(self.index, {session_id: time.time()}, xx=True)
+        (category, score, answered), used = pipe.execute()[:2]
+        if category is None:
+            return None
+        used = used or b''
+        session = QuizSession(session_id, int(category), set(struct.unpack(
+            '<%dI' % (len(used) // 4), used)))
+        if score is not None:
+            session.adaptive = True
+            session.score = float(score)
+            session.answered = int(answered)
+        return session
+
+    def add_used(self, session, question_id):
+        key = self.prefix + session.id + ':used'
+        pipe = self.client.pipeline()
+        pipe.append(key, struct.pack('<I', question_id))
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+        session.add(question_id)
+
+    def record_answer(self, session, correct):
+        if not session.adaptive:
+            return False
+        key = self.prefix + session.id
+        recorded = self.record_script(
+            keys=[key, key + ':used'],
+            args=[QUIZ_ADAPTIVE_RATE, 1 if correct else 0])
+        if not recorded:
+            return False
+        session.score = float(recorded[0])
+        session.answered = int(recorded[1])
+        return True
+
+
+def create_session_backend(config):
+    backend = config.get('QUIZ_SESSION_BACKEND', QUIZ_SESSION_BACKEND)
+    ttl = config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL)
+    if backend == 'memory':
+        return MemorySessionBackend(
+            ttl, config.get('QUIZ_SESSION_MAX', QUIZ_SESSION_MAX))
+    if backend == 'redis':
+        if redis is None:
+            raise RuntimeError('the redis package is required for the '
+                               'redis quiz session backend')
+        client = redis.Redis.from_url(config.get('REDIS_URL', REDIS_URL))
+        return RedisSessionBackend(
+            client, ttl, maxsize=config.get('QUIZ_SESSION_MAX',
+                                            QUIZ_SESSION_MAX))
+    # an already configured backend object, e.g. in tests
+    return backend
@@ -0,0 +1,343 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, has_app_context, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from .auth.auth import token_subject
+from .metrics import registry
+from .quiz_sessions import REDIS_URL
+from models import TimedQueuePool
+
+
+# 'redis' to share the buckets of each client between workers
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+# clients the in-process backend keeps buckets for before evicting the
+# least recently seen
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv('RATE_LIMIT_MAX_CLIENTS', 100000))
+# proxies in front of the app appending to X-Forwarded-For, by default 1
+# on Heroku (where DYNO is set) for its router; with 0 the client is the
+# address of the peer
+RATE_LIMIT_PROXIES = int(os.getenv('RATE_LIMIT_PROXIES',
+                                   1 if os.getenv('DYNO') else 0))
+# seconds a request may wait for database connections before its route
+# admits fewer requests at once
+ADMISSION_MAX_POOL_WAIT = float(os.getenv('ADMISSION_MAX_POOL_WAIT', 0.05))
+
+SHARED_ERRORS = (OSError,) + ((redis.RedisError,) if redis else ())
+
+logger = logging.getLogger('trivia.rate_limit')
+
+
+def parse_rate_limits(value):
+    # "quizzes=10:60,search=5" as {'quizzes': (10.0, 60), 'search':
+    # (5.0, 5)}: requests per second and burst by route
+    limits = {}
+    for pair in value.split(','):
+        if pair:
+            name, limit = pair.split('=')
+            rate, _, burst = limit.partition(':')
+            limits[name.strip()] = (float(rate),
+                                    int(burst or max(1, float(rate))))
+    return limits
+
+
+def parse_admission_limits(value):
+    # "quizzes=16,search=8": requests served at once by route
+    return {name.strip(): int(limit) for name, limit in (
+        pair.split('=') for pair in value.split(',') if pair)}
+
+
+class RateLimited(TooManyRequests):
+
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+class Overloaded(ServiceUnavailable):
+
+    def __init__(self, retry_after=1):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+'''
+MemoryBuckets
+    token buckets of the clients of this worker, the least recently seen
+    evicted beyond `maxsize`
+'''
+
+
+class MemoryBuckets:
+
+    def __init__(self, maxsize=RATE_LIMIT_MAX_CLIENTS, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rate, burst):
+        '''
+        takes a token from the bucket of `key`, which holds up to `burst`
+        tokens and refills at `rate` per second; returns 0, or the seconds
+        until a token is available when the bucket is empty
+        '''
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# the same refill and take as MemoryBuckets, atomic in Redis; the wait is
+# returned as a string since Redis truncates Lua numbers to integers
+TAKE_SCRIPT = '''
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+'''
+
+
+'''
+RedisBuckets
+    token buckets in Redis (or any server speaking its protocol and Lua),
+    shared by the workers; they expire once full again
+'''
+
+
+class RedisBuckets:
+
+    def __init__(self, client, prefix='trivia:ratelimit:', clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+        self.script = client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self.script(keys=[self.prefix + key],
+                                 args=[rate, burst, repr(self.clock())]))
+
+
+'''
+RateLimiter
+    limits the requests each client makes to a route to a rate and a
+    burst, the client being the subject of a bearer token verified by an
+    earlier request or else its address
+'''
+
+
+class RateLimiter:
+
+    def __init__(self, buckets, limits, proxies=RATE_LIMIT_PROXIES):
+        self.buckets = buckets
+        self.limits = dict(limits)
+        self.proxies = proxies
+        self._warned_forwarded = False
+
+    def client(self, address, forwarded_for=None, authorization=None):
+        subject = token_subject(authorization) if authorization else None
+        if subject:
+            return 'sub:' + subject
+        if forwarded_for and not self.proxies and \
+                not self._warned_forwarded:
+            # every client behind the proxy would share one bucket
+            self._warned_forwarded = True
+            logger.warning('X-Forwarded-For received with '
+                           'RATE_LIMIT_PROXIES=0, all the clients behind '
+                           'the proxy share the rate limits of %s', address)
+        if self.proxies and forwarded_for:
+            # the last proxies appended the addresses they were called
+            # from, anything before can be made up by the client
+            hops = [hop.strip() for hop in forwarded_for.split(',')]
+            if len(hops) >= self.proxies:
+                address = hops[-self.proxies]
+        return 'ip:%s' % address
+
+    def check(self, name, client):
+        '''0, or the seconds `client` has to wait to call route `name`'''
+        rate, burst = self.limits[name]
+        try:
+            wait = self.buckets.take('%s:%s' % (name, client), rate, burst)
+        except SHARED_ERRORS as e:
+            # rather serve the clients than refuse them all
+            logger.warning('shared rate limiter unavailable: %s', e)
+            return 0
+        if wait:
+            registry.inc('trivia_requests_shed_total',
+                         {'route': name, 'reason': 'rate_limit'})
+        return wait
+
+    def hit(self, name):
+        '''
+        raises RateLimited if the client of this request is over the
+        limit of route `name`
+        '''
+        if name not in self.limits:
+            return
+        wait = self.check(name, self.client(
+            request.remote_addr, request.headers.get('X-Forwarded-For'),
+            request.headers.get('Authorization')))
+        if wait:
+            raise RateLimited(wait)
+
+    def limit(self, name):
+        def limit_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                self.hit(name)
+                return f(*args, **kwargs)
+
+            return wrapper
+        return limit_decorator
+
+
+'''
+AdmissionController
+    bounds the requests of each route a worker serves at once. The bound
+    starts at the route's limit and is cut by `backoff` after each request
+    that waited more than `max_wait` seconds for database connections,
+    then grows back by one every `bound` requests that did not, so that
+    a saturated pool sheds the guarded routes with 503 first. At least
+    `min_limit` requests are admitted, which keep measuring the wait.
+'''
+
+
+class AdmissionController:
+
+    def __init__(self, limits, max_wait=ADMISSION_MAX_POOL_WAIT,
+                 min_limit=1, backoff=0.75):
+        self.maximum = dict(limits)
+        self.bounds = {name: float(limit) for name, limit in limits.items()}
+        self.in_flight = dict.fromkeys(limits, 0)
+        self.max_wait = max_wait
+        self.min_limit = min_limit
+        self.backoff = backoff
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self, name):
+        if not self.maximum.get(name):
+            yield
+            return
+        with self._lock:
+            admitted = self.in_flight[name] < int(self.bounds[name])
+            if admitted:
+                self.in_flight[name] += 1
+        if not admitted:
+            registry.inc('trivia_requests_shed_total',
+                         {'route': name, 'reason': 'overload'})
+            raise Overloaded()
+        waited = TimedQueuePool.thread_wait()
+        try:
+            yield
+        finally:
+            waited = TimedQueuePool.thread_wait() - waited
+            with self._lock:
+                self.in_flight[name] -= 1
+                bound = self.bounds[name]
+                if waited > self.max_wait:
+                    bound = max(self.min_limit, bound * self.backoff)
+                else:
+                    bound = min(self.maximum[name], bound + 1.0 / bound)
+                self.bounds[name] = bound
+
+    def acquire(self, name):
+        '''
+        takes a slot of route `name` as admit() does, for a response
+        streamed after the view returned, and returns the function giving
+        it back
+        '''
+        slot = self.admit(name)
+        slot.__enter__()
+        return lambda: slot.__exit__(None, None, None)
+
+    def admitted(self, name):
+        def admitted_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.admit(name):
+                    return f(*args, **kwargs)
+
+            return wrapper
+        return admitted_decorator
+
+
+def retry_headers(error):
+    # the Retry-After header of a RateLimited or Overloaded error
+    seconds = getattr(error, 'retry_after', None)
+    if not seconds:
+        return {}
+    return {'Retry-After': str(max(1, int(math.ceil(seconds))))}
+
+
+def create_rate_limiter(config):
+    backend = config.get('RATE_LIMIT_BACKEND', RATE_LIMIT_BACKEND)
+    if backend == 'memory':
+        buckets = MemoryBuckets(config.get('RATE_LIMIT_MAX_CLIENTS',
+                                           RATE_LIMIT_MAX_CLIENTS))
+    elif backend == 'redis':
+        if redis is None:
+            raise RuntimeError('the redis package is required for the '
+                               'redis rate limiter backend')
+        buckets = RedisBuckets(
+            redis.Redis.from_url(config.get('REDIS_URL', REDIS_URL)))
+    else:
+        # already configured buckets, e.g. in tests
+        buckets = backend
+    return RateLimiter(buckets, config.get('RATE_LIMITS', {}),
+                       config.get('RATE_LIMIT_PROXIES', RATE_LIMIT_PROXIES))
+
+
+def create_admission_controller(config):
+    return AdmissionController(
+        config.get('ADMISSION_LIMITS', {}),
+        config.get('ADMISSION_MAX_POOL_WAIT', ADMISSION_MAX_POOL_WAIT))
+
+
+def admission_gauges():
+    '''requests in flight and current bound of the admission control'''
+    if not has_app_context():
+        return []
+    admission = current_app.extensions.get('admission')
+    if admission is None:
+        return []
+    gauges = []
+    for name in sorted(admission.maximum):
+        gauges.append(('trivia_admission_in_flight', {'route': name},
+                       admission.in_flight[name]))
+        gauges.append(('trivia_admission_limit', {'route': name},
+                       int(admission.bounds[name])))
+    return gauges
+
+
+registry.add_collector(admission_gauges)
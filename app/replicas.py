@@ -0,0 +1,60 @@
+import os
+import time
+from functools import wraps
+from flask import g, request
+from sqlalchemy.exc import DBAPIError
+
+from models import db, content_versions, replica_set
+
+
+# seconds during which a client that wrote reads from the primary
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+STICKY_COOKIE = 'trivia_primary'
+
+
+def wrote_recently():
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def reads_from_replica(f):
+    '''
+    Decorator for read-only endpoints: their SELECTs go to a replica that
+    has caught up with the primary, unless the client wrote in the last
+    REPLICA_STICKY_SECONDS. If the replica fails, it is set aside and the
+    view runs again on the primary.
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not replica_set.binds:
+            return f(*args, **kwargs)
+        if wrote_recently():
+            # read-your-writes, with the versions the primary has now
+            content_versions.invalidate()
+            return f(*args, **kwargs)
+        g.read_replica = replica_set.choose()
+        if g.read_replica is None:
+            return f(*args, **kwargs)
+        try:
+            return f(*args, **kwargs)
+        except DBAPIError as e:
+            print(e)
+            replica_set.mark_failed(g.read_replica)
+            g.read_replica = None
+            db.session.rollback()
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+def init_replicas(app):
+    '''sets the sticky cookie on the responses of requests that wrote'''
+    @app.after_request
+    def stick_to_primary(response):
+        if replica_set.binds and g.get('wrote_content'):
+            response.set_cookie(
+                STICKY_COOKIE, str(int(time.time()) + REPLICA_STICKY_SECONDS),
+                max_age=REPLICA_STICKY_SECONDS, httponly=True)
+        return response
@@ -0,0 +1,273 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import current_app, has_app_context, request
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from .metrics import registry
+from .quiz_sessions import REDIS_URL
+from models import content_versions
+
+
+# responses kept by each worker, 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 512))
+# larger bodies are not cached
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 262144))
+# 'redis' to share the cached responses between workers
+RESPONSE_CACHE_SHARED = os.getenv('RESPONSE_CACHE_SHARED', '')
+# the keys change with the content versions, the TTL only bounds how long
+# superseded responses stay in the shared tier
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+# seconds a request waits for another one rendering the same response
+RESPONSE_CACHE_LOCK_TIMEOUT = float(os.getenv('RESPONSE_CACHE_LOCK_TIMEOUT',
+                                              5))
+
+SHARED_ERRORS = (OSError,) + ((redis.RedisError,) if redis else ())
+
+logger = logging.getLogger('trivia.response_cache')
+
+
+'''
+LocalTier
+    bounded LRU of packed responses in this worker
+'''
+
+
+class LocalTier:
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+'''
+SharedTier
+    packed responses in Redis (or any server speaking its protocol),
+    with the lock that lets a single worker render a missing response
+'''
+
+
+class SharedTier:
+
+    def __init__(self, client, ttl=RESPONSE_CACHE_TTL,
+                 prefix='trivia:response:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def lock(self, key, timeout):
+        return bool(self.client.set(self.prefix + 'lock:' + key, b'1',
+                                    nx=True, px=int(timeout * 1000)))
+
+    def unlock(self, key):
+        self.client.delete(self.prefix + 'lock:' + key)
+
+
+def pack(response):
+    return response.mimetype.encode() + b'\n' + response.get_data()
+
+
+def unpack(value):
+    mimetype, body = value.split(b'\n', 1)
+    return current_app.response_class(body, mimetype=mimetype.decode())
+
+
+'''
+ResponseCache
+    response bodies by path, query arguments and content versions, looked
+    up in the local tier, then in the shared tier. Only one request per
+    key renders a missing response at a time: in this worker the others
+    wait for it, in other workers they wait on the shared lock and read
+    the shared tier.
+'''
+
+
+class ResponseCache:
+
+    def __init__(self, local, shared=None,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 lock_timeout=RESPONSE_CACHE_LOCK_TIMEOUT):
+        self.local = local
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.lookups = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def count(self, tier, result):
+        with self._lock:
+            self.lookups[tier, result] = self.lookups.get(
+                (tier, result), 0) + 1
+        registry.inc('trivia_response_cache_lookups_total',
+                     {'tier': tier, 'result': result})
+
+    def hit_ratio(self, tier):
+        hits = self.lookups.get((tier, 'hit'), 0)
+        total = hits + self.lookups.get((tier, 'miss'), 0)
+        return hits / total if total else 0.0
+
+    def fetch(self, key, render):
+        '''
+        returns the cached value of `key`, or the one `render()` returns,
+        which is cached unless it is None
+        '''
+        value = self.local.get(key)
+        self.count('local', 'miss' if value is None else 'hit')
+        if value is not None:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = threading.Event()
+        if not leader:
+            flight.wait(self.lock_timeout)
+            value = self.local.get(key)
+            return value if value is not None else render()
+        try:
+            value = self.fetch_shared(key, render)
+            if value is not None:
+                self.local.set(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.set()
+
+    def fetch_shared(self, key, render):
+        if self.shared is None:
+            return render()
+        locked = False
+        try:
+            value = self.shared.get(key)
+            if value is None:
+                locked = self.shared.lock(key, self.lock_timeout)
+            if value is None and not locked:
+                # another worker is rendering it
+                deadline = time.monotonic() + self.lock_timeout
+                while value is None and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                    value = self.shared.get(key)
+        except SHARED_ERRORS as e:
+            logger.warning('shared response cache unavailable: %s', e)
+            return render()
+        self.count('shared', 'miss' if value is None else 'hit')
+        if value is not None:
+            return value
+        try:
+            value = render()
+        finally:
+            try:
+                if value is not None:
+                    self.shared.set(key, value)
+                if locked:
+                    self.shared.unlock(key)
+            except SHARED_ERRORS as e:
+                logger.warning('shared response cache unavailable: %s', e)
+        return value
+
+    def cached(self, versions, when=None):
+        '''
+        Decorator for read endpoints whose body only changes with the
+        content versions returned by `versions(**view_args)`. Caches
+        200 responses that are not streamed and fit in max_bytes, of the
+        requests for which `when()`, if given, is true.
+        '''
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.local.maxsize or (when and not when()):
+                    return f(*args, **kwargs)
+                key = '%s?%s#%s' % (
+                    request.path, urlencode(sorted(request.args.items(
+                        multi=True))),
+                    ','.join('%s:%d' % (name, content_versions.get(name)[0])
+                             for name in versions(**kwargs)))
+                rendered = []
+
+                def render():
+                    response = current_app.make_response(f(*args, **kwargs))
+                    rendered.append(response)
+                    if response.status_code != 200 or \
+                            response.is_streamed or \
+                            response.calculate_content_length() > \
+                            self.max_bytes:
+                        return None
+                    return pack(response)
+
+                value = self.fetch(key, render)
+                # the response this request rendered, or the cached one
+                return rendered[0] if rendered else unpack(value)
+
+            return wrapper
+        return cached_decorator
+
+
+def create_response_cache(config):
+    local = LocalTier(config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE))
+    shared = config.get('RESPONSE_CACHE_SHARED', RESPONSE_CACHE_SHARED)
+    if shared == 'redis':
+        if redis is None:
+            raise RuntimeError('the redis package is required for the '
+                               'shared response cache')
+        shared = SharedTier(
+            redis.Redis.from_url(config.get('REDIS_URL', REDIS_URL)),
+            config.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL))
+    # otherwise an already configured tier object, e.g. in tests
+    return ResponseCache(
+        local, shared or None,
+        config.get('RESPONSE_CACHE_MAX_BYTES', RESPONSE_CACHE_MAX_BYTES),
+        config.get('RESPONSE_CACHE_LOCK_TIMEOUT',
+                   RESPONSE_CACHE_LOCK_TIMEOUT))
+
+
+def response_cache_gauges():
+    '''size and hit ratios of the current app's response cache'''
+    if not has_app_context():
+        return []
+    cache = current_app.extensions.get('response_cache')
+    if cache is None:
+        return []
+    gauges = [('trivia_response_cache_entries', {}, len(cache.local)),
+              ('trivia_response_cache_hit_ratio', {'tier': 'local'},
+               round(cache.hit_ratio('local'), 3))]
+    if cache.shared is not None:
+        gauges.append(('trivia_response_cache_hit_ratio', {'tier': 'shared'},
+                       round(cache.hit_ratio('shared'), 3)))
+    return gauges
+
+
+registry.add_collector(response_cache_gauges)
@@ -0,0 +1,55 @@
+from flask import Response, stream_with_context
+
+from models import dumps
+
+
+# bytes buffered before a chunk of a streamed response is sent
+STREAM_CHUNK_SIZE = 16384
+
+
+def stream_questions(questions, **fields):
+    '''
+    yields a JSON object made of `fields`, the `questions` array written
+    one question at a time, and the resulting totalQuestions, so memory
+    does not grow with the number of questions
+    '''
+    head = dumps(fields)[1:-1]
+    chunk = bytearray(b'{' + head + (b',' if head else b'') +
+                      b'"questions":[')
+    total = 0
+    for question in questions:
+        if total:
+            chunk += b','
+        chunk += dumps(question.format())
+        total += 1
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk = bytearray()
+    yield bytes(chunk) + b'],"totalQuestions":%d}' % total
+
+
+async def astream_questions(batches, **fields):
+    '''
+    stream_questions() for the ASGI server, reading lists of question
+    dicts from the async iterator `batches`
+    '''
+    head = dumps(fields)[1:-1]
+    chunk = bytearray(b'{' + head + (b',' if head else b'') +
+                      b'"questions":[')
+    total = 0
+    async for batch in batches:
+        for question in batch:
+            if total:
+                chunk += b','
+            chunk += dumps(question)
+            total += 1
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk = bytearray()
+    yield bytes(chunk) + b'],"totalQuestions":%d}' % total
+
+
+def streamed_questions_response(questions, **fields):
+    return Response(stream_with_context(stream_questions(questions,
+                                                         **fields)),
+                    mimetype='application/json')
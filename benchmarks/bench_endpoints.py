@@ -0,0 +1,384 @@
+'''
+Latency and throughput benchmark of the trivia API.
+
+Seeds N synthetic questions into a local database, signs tokens with a
+locally generated RSA key instead of Auth0, and drives every public
+endpoint (plus an authenticated one) through the Flask test client,
+through a real gunicorn process and through the ASGI app under uvicorn.
+Prints a JSON report with p50/p95/p99 latency, requests per second, SQL
+queries per request (read from the Server-Timing header) and the peak
+resident memory of each server, so that runs on two commits, or the sync
+and async deployments at equal memory, can be compared:
+
+    python benchmarks/bench_endpoints.py --questions 100000 \
+        --output before.json
+'''
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import Request, urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+KID = 'benchmark'
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+WORDS = ['peanut', 'river', 'planet', 'painter', 'empire', 'goal', 'movie',
+         'element', 'mountain', 'novel', 'battle', 'album', 'ocean', 'tennis']
+
+
+def b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_key(directory):
+    '''generates an RSA key and writes its public half as a JWKS file'''
+    from Crypto.PublicKey import RSA
+
+    key = RSA.generate(2048)
+    jwks_path = os.path.join(directory, 'jwks.json')
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump({'keys': [{'kty': 'RSA', 'kid': KID, 'use': 'sig',
+                             'n': b64(key.n), 'e': b64(key.e)}]}, jwks_file)
+    return key, jwks_path
+
+
+def make_token(key):
+    '''returns a token signed with the key, holding every permission'''
+    from jose import jwt
+    from app.auth.auth import AUTH0_DOMAIN, API_AUDIENCE
+
+    return jwt.encode({
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'sub': 'benchmark',
+        'aud': API_AUDIENCE,
+        'iat': int(time.time()),
+        'exp': int(time.time()) + 24 * 3600,
+        'permissions': ['get:questions', 'post:questions',
+                        'patch:questions', 'delete:questions']
+    }, key.export_key().decode(), algorithm='RS256', headers={'kid': KID})
+
+
+def seed(count, batch_size=10000):
+    from models import db, Question, Category, rebuild_category_stats
+
+    db.create_all()
+    if Question.query.count() == count:
+        return
+    db.session.execute(Question.__table__.delete())
+    db.session.execute(Category.__table__.delete())
+    for type in CATEGORIES:
+        db.session.add(Category(type))
+    db.session.flush()
+    categories = [category.id for category in Category.query]
+    rng = random.Random(0)
+    for start in range(0, count, batch_size):
+        db.session.execute(Question.__table__.insert(), [{
+            'question': 'Which %s %s question %d?' % (
+                rng.choice(WORDS), rng.choice(WORDS), number),
+            'answer': rng.choice(WORDS),
+            'category': rng.choice(categories),
+            'difficulty': rng.randint(1, 5)
+        } for number in range(start, min(start + batch_size, count))])
+    db.session.commit()
+    rebuild_category_stats()
+
+
+def scenarios(count, token):
+    '''(name, method, path, json body, headers) of each benchmarked call'''
+    auth = {'Authorization': 'Bearer ' + token}
+    pages = max(count // 10, 1)
+    return [
+        ('categories', lambda: ('GET', '/categories', None, {})),
+        ('questions_page', lambda: (
+            'GET', '/questions?page=%d' % random.randint(1, pages), None, {})),
+        ('category_page', lambda: (
+            'GET', '/categories/%d/questions?page=%d' % (
+                random.randint(1, len(CATEGORIES)), random.randint(1, 50)),
+            None, {})),
+        ('search', lambda: (
+            'POST', '/questions', {'searchTerm': random.choice(WORDS)}, {})),
+        ('quiz', lambda: ('POST', '/quizzes', {
+            'quiz_category': {'id': random.randint(0, len(CATEGORIES))},
+            'previous_questions': [random.randint(1, count)
+                                   for _ in range(10)]
+        }, {})),
+        ('question_auth', lambda: (
+            'GET', '/questions/%d' % random.randint(1, count), None, auth)),
+    ]
+
+
+def summarize(latencies, elapsed, queries=None, errors=0):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'requests': 0, 'errors': errors}
+
+    def percentile(p):
+        return round(latencies[min(int(len(latencies) * p),
+                                   len(latencies) - 1)] * 1000, 3)
+
+    summary = {
+        'requests': len(latencies),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'rps': round(len(latencies) / elapsed, 1),
+        'errors': errors
+    }
+    if queries is not None:
+        summary['queries_per_request'] = round(
+            sum(queries) / len(queries), 2)
+    return summary
+
+
+def bench_test_client(app, count, token, requests):
+    from sqlalchemy import event
+    from models import db
+
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def count_statement(*args):
+        statements.append(1)
+
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    client = app.test_client()
+    results = {}
+    for name, make_call in scenarios(count, token):
+        latencies = []
+        queries = []
+        started = time.perf_counter()
+        for _ in range(requests):
+            method, path, body, headers = make_call()
+            del statements[:]
+            start = time.perf_counter()
+            res = client.open(path, method=method, json=body,
+                              headers=headers)
+            res.get_data()
+            latencies.append(time.perf_counter() - start)
+            queries.append(len(statements))
+            assert res.status_code == 200, (path, res.status_code)
+        results[name] = summarize(latencies,
+                                  time.perf_counter() - started, queries)
+    event.remove(engine, 'before_cursor_execute', count_statement)
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    '''returns the seconds until url answered'''
+    started = time.time()
+    while time.time() < started + timeout:
+        try:
+            urlopen(url).read()
+            return time.time() - started
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start: ' + url)
+
+
+def tree_rss(pid):
+    '''resident memory in MB of a process and all of its descendants'''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as stat:
+                    # the parent pid follows the parenthesized command
+                    parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        pids.extend(children.get(pid, []))
+        try:
+            with open('/proc/%d/status' % pid) as status:
+                total += int(re.search(r'VmRSS:\s+(\d+)',
+                                       status.read()).group(1))
+        except (OSError, AttributeError):
+            continue
+    return round(total / 1024.0, 1)
+
+
+def drive(base_url, make_call, requests, concurrency):
+    latencies = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            method, path, body, headers = make_call()
+            data = None
+            if body is not None:
+                data = json.dumps(body).encode()
+                headers = dict(headers, **{'Content-Type':
+                                           'application/json'})
+            request = Request(base_url + path, data=data, method=method,
+                              headers=headers)
+            start = time.perf_counter()
+            try:
+                response = urlopen(request)
+                response.read()
+            except OSError as e:
+                with lock:
+                    errors.append(e)
+                continue
+            elapsed = time.perf_counter() - start
+            timing = re.search(r'"(\d+) queries"',
+                               response.headers.get('Server-Timing', ''))
+            with lock:
+                latencies.append(elapsed)
+                if timing:
+                    queries.append(int(timing.group(1)))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - started,
+                     queries or None, errors=len(errors))
+
+
+def bench_server(command, env, count, token, requests, concurrency):
+    '''
+    returns the results of every scenario, the peak memory and the time
+    to the first response
+    '''
+    port = free_port()
+    server = subprocess.Popen(
+        [part.format(port=port) for part in command], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = 'http://127.0.0.1:%d' % port
+    try:
+        startup = wait_for(base_url + '/categories')
+        results = {}
+        rss = tree_rss(server.pid)
+        for name, make_call in scenarios(count, token):
+            results[name] = drive(base_url, make_call, requests, concurrency)
+            rss = max(rss, tree_rss(server.pid))
+        return results, rss, round(startup, 3)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--questions', type=int, default=10000,
+                        help='synthetic questions to seed (10^3 to 10^6)')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='concurrent clients against gunicorn')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn workers')
+    parser.add_argument('--uvicorn-workers', type=int,
+                        help='uvicorn workers, as many as gunicorn workers '
+                             'by default')
+    parser.add_argument('--database-url',
+                        help='database to seed, a temporary SQLite file '
+                             'by default')
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'uvicorn',
+                                           'both', 'all'],
+                        default='both',
+                        help='both is the test client and gunicorn, all '
+                             'adds uvicorn')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='trivia-bench-')
+    database_url = args.database_url or \
+        'sqlite:///' + os.path.join(directory, 'bench.db')
+    key, jwks_path = make_key(directory)
+    # read when the app is imported below, and by the gunicorn workers
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['JWKS_FILE'] = jwks_path
+    # every request comes from this address, which the rate limits of
+    # /quizzes and search would soon refuse
+    os.environ['RATE_LIMITS'] = ''
+
+    from app import create_app
+    token = make_token(key)
+    app = create_app({'DATABASE_URL': database_url})
+    with app.app_context():
+        seed(args.questions)
+
+    report = {
+        'commit': git_commit(),
+        'questions': args.questions,
+        'requests_per_endpoint': args.requests,
+        'database': database_url.split(':', 1)[0],
+        'results': {}
+    }
+    if args.mode in ('client', 'both'):
+        report['results']['test_client'] = bench_test_client(
+            app, args.questions, token, args.requests)
+    env = dict(os.environ, DATABASE_URL=database_url, JWKS_FILE=jwks_path)
+    if args.mode in ('gunicorn', 'both', 'all'):
+        # with the preloading gunicorn.conf.py of the Procfile
+        report['results']['gunicorn'], rss, startup = bench_server(
+            ['gunicorn', '-c', 'gunicorn.conf.py', '-w', str(args.workers),
+             '-b', '127.0.0.1:{port}', 'app:app'], env, args.questions,
+            token, args.requests, args.concurrency)
+        report.setdefault('rss_mb', {})['gunicorn'] = rss
+        report.setdefault('startup_seconds', {})['gunicorn'] = startup
+        report['gunicorn_workers'] = args.workers
+        report['concurrency'] = args.concurrency
+    if args.mode in ('uvicorn', 'all'):
+        # the native async routes only run on Postgres, other databases
+        # measure the Flask app behind the ASGI adapter
+        workers = args.uvicorn_workers or args.workers
+        report['results']['uvicorn'], rss, startup = bench_server(
+            ['uvicorn', '--workers', str(workers), '--host', '127.0.0.1',
+             '--port', '{port}', '--no-access-log', 'app.asgi:application'],
+            env, args.questions, token, args.requests, args.concurrency)
+        report.setdefault('rss_mb', {})['uvicorn'] = rss
+        report.setdefault('startup_seconds', {})['uvicorn'] = startup
+        report['uvicorn_workers'] = workers
+        report['concurrency'] = args.concurrency
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
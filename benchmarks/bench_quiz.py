@@ -0,0 +1,128 @@
+'''
+Draw time of the adaptive quiz against the size of the question pool.
+
+Builds the in-memory question index from N synthetic (id, category,
+difficulty) rows and plays quiz sessions of --session-length questions,
+drawing each one at the difficulty the session asks for. Prints a JSON report with the build time and the mean
+and p99 time of a draw for every pool size, to check that a draw only
+grows with the logarithm of the pool (its bisections), not with the pool.
+
+Neither the app nor a database is needed: the index comes from models
+and the sessions from app/quiz_sessions.py, loaded without running
+app/__init__.py, which would create the app and connect to DATABASE_URL.
+Run it with:
+
+    python benchmarks/bench_quiz.py --questions 1000 10000 100000 1000000
+'''
+import argparse
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CATEGORIES = 6
+
+
+def build_index(size, rng):
+    from models import QuestionIndex
+
+    # ids with gaps, like a table some questions were deleted from
+    rows = [(question_id, rng.randint(1, CATEGORIES), rng.randint(1, 5))
+            for question_id in rng.sample(range(1, size * 2), size)]
+    index = QuestionIndex()
+    started = time.perf_counter()
+    index.build(rows, 1)
+    elapsed = time.perf_counter() - started
+    # the version check reads the content versions, a dict lookup in a
+    # worker, but a query without one
+    index.refresh = lambda: None
+    return index, elapsed
+
+
+def load_quiz_sessions():
+    # only needs the standard library, unlike the app package
+    spec = importlib.util.spec_from_file_location(
+        'quiz_sessions', os.path.join(ROOT, 'app', 'quiz_sessions.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def play(index, sessions, length, rng):
+    QuizSession = load_quiz_sessions().QuizSession
+
+    latencies = []
+    for number in range(sessions):
+        session = QuizSession(str(number), rng.randint(0, CATEGORIES),
+                              adaptive=True)
+        for _ in range(length):
+            started = time.perf_counter()
+            question_id = index.draw_nearest(
+                session.category, session, session.difficulty())
+            latencies.append(time.perf_counter() - started)
+            if question_id is None:
+                break
+            session.add(question_id)
+            session.record(rng.random() < 0.6)
+    return latencies
+
+
+def summarize(latencies, build):
+    latencies = sorted(latencies)
+    return {
+        'draws': len(latencies),
+        'build_ms': round(build * 1000, 1),
+        'mean_us': round(sum(latencies) / len(latencies) * 1e6, 2),
+        'p99_us': round(latencies[min(int(len(latencies) * 0.99),
+                                      len(latencies) - 1)] * 1e6, 2)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--questions', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='pool sizes to measure')
+    parser.add_argument('--sessions', type=int, default=200,
+                        help='quiz sessions played on each pool')
+    parser.add_argument('--session-length', type=int, default=50,
+                        help='questions drawn per session')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    report = {
+        'commit': git_commit(),
+        'sessions': args.sessions,
+        'session_length': args.session_length,
+        'results': {}
+    }
+    for size in args.questions:
+        index, build = build_index(size, rng)
+        latencies = play(index, args.sessions, args.session_length, rng)
+        report['results'][str(size)] = summarize(latencies, build)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
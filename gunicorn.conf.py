@@ -0,0 +1,53 @@
+'''
+gunicorn settings of the Procfile: the app is imported and its caches
+are warmed once in the master, then shared copy-on-write by the forked
+workers. Workers and bind address follow WEB_CONCURRENCY and PORT.
+'''
+import gc
+import os
+
+# the tables come from the migrations (manage.py db upgrade), not from a
+# create_all() in every worker
+os.environ.setdefault('DB_CREATE_TABLES', 'false')
+
+preload_app = True
+
+
+def when_ready(server):
+    # the master, after it imported the app and before the first fork
+    from app import app
+    from app.auth.auth import jwks_store
+    from app.quiz_sessions import QUIZ_SESSION_BACKEND
+    from models import warm_caches, dispose_engines
+
+    if server.cfg.workers > 1 and app.config.get(
+            'QUIZ_SESSION_BACKEND', QUIZ_SESSION_BACKEND) == 'memory':
+        # a session lives in the worker that created it
+        server.log.warning(
+            'quiz sessions are kept in each of the %d workers, so their '
+            'next questions fail on the other workers; set '
+            'QUIZ_SESSION_BACKEND=redis', server.cfg.workers)
+    with app.app_context():
+        warm_caches(app.config['QUIZ_DRAW_STRATEGY'])
+        dispose_engines(app)
+    if not jwks_store.static:
+        jwks_store.refresh()
+    # what was loaded so far is never collected, so the collector does
+    # not write to (and copy) the pages the workers share (Python 3.7+)
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import app
+    from app.metrics import mark_worker_started
+    from models import dispose_engines
+
+    mark_worker_started()
+    dispose_engines(app)
+
+
+def post_worker_init(worker):
+    from app.metrics import mark_worker_ready
+
+    mark_worker_ready()
@@ -1,8 +1,13 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
+import csv
+import sys
+
 from app import app
-from models import db
+from app.bulk import import_questions, export_questions
+from app.dedup import near_duplicates, delete_exact_duplicates
+from models import db, rebuild_category_stats
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +15,53 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def import_file(path, format=None):
+    """Import questions from an NDJSON or CSV file"""
+    format = format or ('csv' if path.endswith('.csv') else 'ndjson')
+    with open(path, 'rb') as questions_file:
+        report = import_questions(questions_file, format)
+    for error in report['errors']:
+        print('line %(line)d: %(error)s' % error)
+    print('%(inserted)d inserted, %(duplicates)d duplicates, '
+          '%(failed)d failed' % report)
+
+
+@manager.command
+def export_file(path=None, format='ndjson'):
+    """Export all questions as NDJSON or CSV"""
+    out = open(path, 'w') if path else sys.stdout
+    for chunk in export_questions(format):
+        out.write(chunk)
+    if path:
+        out.close()
+
+
+@manager.command
+def find_duplicates(threshold=0.8, path=None):
+    """List the questions almost the same as an older one, as CSV"""
+    out = open(path, 'w') if path else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(('id', 'duplicate_of', 'similarity'))
+    for row in near_duplicates(float(threshold)):
+        writer.writerow(row)
+    if path:
+        out.close()
+
+
+@manager.command
+def delete_duplicates():
+    """Delete the questions repeating an older one, before the migration
+    adding the unique fingerprint index"""
+    print('%d duplicate questions deleted' % delete_exact_duplicates())
+
+
+@manager.command
+def rebuild_stats():
+    """Count the questions per category and difficulty again"""
+    rebuild_category_stats()
+    print('category stats rebuilt')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -1,26 +1,235 @@
+import bisect
+import datetime
+from array import array
+import hashlib
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import (Column, String, Integer, DateTime, ForeignKey,
+                        Index, bindparam, create_engine, event, func,
+                        inspect, literal_column, orm, select)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, IntegrityError, TimeoutError
+from sqlalchemy.ext import baked
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.expression import Select
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 
+'''
+RoutingSession
+    session that sends the SELECTs of a request to the read replica in
+    g.read_replica, if any. Writes, flushes and the content versions
+    always go to the primary.
+'''
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('read_replica') if has_app_context() else None
+        if replica is not None and not self._flushing and \
+                isinstance(clause, Select) and \
+                (mapper is None or mapper.class_ is not ContentVersion):
+            return db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 database_path = os.getenv("DATABASE_URL")
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# relative weight of a search term found in the answer only
+ANSWER_MATCH_WEIGHT = 0.4
+# rows fetched per round trip when streaming a listing
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 500))
+# seconds between two reads of the content_versions table by a worker
+VERSION_CHECK_INTERVAL = float(os.getenv("VERSION_CHECK_INTERVAL", 2))
+# 'sql' draws quiz questions by probing random ids in the database,
+# 'index' from the in-memory QuestionIndex
+QUIZ_DRAW_STRATEGY = os.getenv("QUIZ_DRAW_STRATEGY", "sql")
+# random ids looked up by each probe query of the 'sql' strategy
+QUIZ_DRAW_PROBES = 32
+# versions of each category whose written question ids are kept for the
+# workers' QuestionIndex; a worker further behind reads the category again
+QUESTION_CHANGES_KEPT = int(os.getenv("QUESTION_CHANGES_KEPT", 1000))
+# ids per IN list, below SQLite's 999 parameters
+ID_LOOKUP_SIZE = 500
+# comma separated URLs of read replicas of DATABASE_URL
+DATABASE_REPLICA_URLS = os.getenv("DATABASE_REPLICA_URLS")
+# seconds between two checks of a replica's health and lag
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 2))
+# create missing tables and wire Flask-Migrate when the app is set up;
+# 'false' in production, where the migrations create the tables
+DB_CREATE_TABLES = os.getenv("DB_CREATE_TABLES", "true") == "true"
+
+# connection pool of each worker, overridden by setup_db(pool=...). With
+# pooler='pgbouncer' connections are left to the external pooler.
+DATABASE_POOL = {
+    'size': int(os.getenv("DB_POOL_SIZE", 5)),
+    'overflow': int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    # seconds a checkout waits for a connection before giving up
+    'timeout': float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    # seconds after which a connection is replaced, -1 to keep it
+    'recycle': int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    'pre_ping': os.getenv("DB_POOL_PRE_PING", "true") == "true",
+    # milliseconds a Postgres statement may run, 0 for no limit
+    'statement_timeout': int(os.getenv("DB_STATEMENT_TIMEOUT", 0)),
+    'pooler': os.getenv("DB_POOLER")
+}
+
+'''
+TimedQueuePool
+    QueuePool that records how long checkouts wait for a connection and
+    how many give up, exported by app.metrics along with the saturation
+'''
+
+
+class TimedQueuePool(QueuePool):
+    # seconds each thread waited for connections of any pool, read by the
+    # admission control around a request
+    thread_waits = threading.local()
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kw):
+        super().__init__(creator, pool_size=pool_size,
+                         max_overflow=max_overflow, **kw)
+        self.max_overflow = max_overflow
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time += waited
+            TimedQueuePool.thread_waits.seconds = \
+                TimedQueuePool.thread_wait() + waited
+
+    @staticmethod
+    def thread_wait():
+        return getattr(TimedQueuePool.thread_waits, 'seconds', 0.0)
+
+    def saturation(self):
+        # share of all the connections the pool may open that are in use
+        return self.checkedout() / float(self.size() + self.max_overflow)
+
+
+def engine_options(database_path, pool):
+    '''returns the create_engine() arguments of a pool configuration'''
+    options = {'pool_pre_ping': pool['pre_ping']}
+    if pool['pooler'] == 'pgbouncer':
+        # pgbouncer in transaction mode already pools server connections
+        options['poolclass'] = NullPool
+    elif not (database_path or '').startswith('sqlite'):
+        # SQLite connections cannot move between threads, keep its default
+        options.update(poolclass=TimedQueuePool,
+                       pool_size=pool['size'],
+                       max_overflow=pool['overflow'],
+                       pool_timeout=pool['timeout'],
+                       pool_recycle=pool['recycle'])
+    if pool['statement_timeout'] and pool['pooler'] != 'pgbouncer' and \
+            (database_path or '').startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' % pool['statement_timeout']}
+    return options
+
 
 '''
-setup_db(app)
-    binds a flask application and a SQLAlchemy service
+setup_db(app, database_path, pool=None, replicas=DATABASE_REPLICA_URLS,
+         create_tables=DB_CREATE_TABLES)
+    binds a flask application and a SQLAlchemy service, with the pool
+    settings of DATABASE_POOL updated by `pool` and the read replicas at
+    the `replicas` URLs (a list or a comma separated string). With
+    `create_tables`, missing tables are created and `flask db` is wired.
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, pool=None,
+             replicas=DATABASE_REPLICA_URLS, create_tables=DB_CREATE_TABLES):
+    if isinstance(replicas, str):
+        replicas = [url.strip() for url in replicas.split(',')
+                    if url.strip()]
+    binds = {'replica_%d' % number: url
+             for number, url in enumerate(replicas or [])}
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = binds
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    replica_set.configure(sorted(binds))
+    pool = dict(DATABASE_POOL, **(pool or {}))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path,
+                                                            pool)
     db.app = app
     db.init_app(app)
-    Migrate(app, db)
-    db.create_all()
+    if pool['pooler'] == 'pgbouncer' and pool['statement_timeout'] and \
+            (database_path or '').startswith('postgres'):
+        set_local_statement_timeout(db.get_engine(app),
+                                    pool['statement_timeout'])
+    if create_tables:
+        # imported here, alembic is only needed to manage the schema
+        from flask_migrate import Migrate
+        Migrate(app, db)
+        db.create_all()
+        ensure_category_stats()
+
+
+def dispose_engines(app):
+    # pooled connections must not be shared with forked processes
+    db.get_engine(app).dispose()
+    for bind in app.config['SQLALCHEMY_BINDS']:
+        db.get_engine(app, bind).dispose()
+
+
+def set_local_statement_timeout(engine, milliseconds):
+    # pgbouncer rejects startup options and hands server connections to
+    # other clients between transactions, so the timeout is set again
+    # at the start of every transaction
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('SET LOCAL statement_timeout = %d' % milliseconds)
+
+
+'''
+question_fingerprint(question, answer)
+    hash of the case-folded, whitespace-collapsed question and answer,
+    the same for questions that only differ by case or spacing
+'''
+
+
+def question_fingerprint(question, answer):
+    if question is None or answer is None:
+        return None
+    text = '\x1f'.join(' '.join(str(value).casefold().split())
+                       for value in (question, answer))
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def default_fingerprint(context):
+    # column default of the inserts that do not set a fingerprint
+    values = context.get_current_parameters()
+    return question_fingerprint(values.get('question'), values.get('answer'))
 
 
 '''
@@ -31,12 +240,27 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # listings by category and quiz draws by category and difficulty,
+        # both ordered by id
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty_id',
+              'category', 'difficulty', 'id'),
+        # one question per fingerprint; NULL, and so never a duplicate,
+        # only for a question or an answer that is NULL
+        Index('ix_questions_fingerprint', 'fingerprint', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(Integer)
-    difficulty = Column(Integer)
+    # the old values are loaded before a change, for the category stats
+    category = orm.column_property(
+        Column(Integer, ForeignKey('categories.id', onupdate='CASCADE',
+                                   ondelete='SET NULL')),
+        active_history=True)
+    difficulty = orm.column_property(Column(Integer), active_history=True)
+    fingerprint = Column(String(32), default=default_fingerprint)
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -46,14 +270,44 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        # for the id of the change
+        db.session.flush()
+        commit_write(self.versions(), stat_deltas(added=[self.stat_key()]),
+                     self.changes())
 
     def update(self):
-        db.session.commit()
+        commit_write(self.versions(), stat_deltas(
+            removed=[self.stat_key(committed=True)],
+            added=[self.stat_key()]), self.changes())
 
     def delete(self):
+        changes = self.changes()
         db.session.delete(self)
-        db.session.commit()
+        commit_write(self.versions(), stat_deltas(
+            removed=[self.stat_key(committed=True)]), changes)
+
+    def stat_key(self, committed=False):
+        # (category, difficulty) as stored, or as it will be written
+        state = inspect(self)
+        key = []
+        for name in ('category', 'difficulty'):
+            history = state.attrs[name].load_history()
+            values = (history.deleted if committed else history.added) or \
+                history.unchanged
+            key.append(values[0] if values else None)
+        return tuple(key)
+
+    def categories(self):
+        # the categories touched by a write, including the one the
+        # question is moved out of
+        return {self.category} | set(
+            inspect(self).attrs.category.history.deleted)
+
+    def versions(self):
+        return question_versions(self.categories())
+
+    def changes(self):
+        return [(category, self.id) for category in self.categories()]
 
     def format(self):
         return {
@@ -65,6 +319,133 @@ class Question(db.Model):
         }
 
 
+@event.listens_for(Question, 'before_update')
+def refresh_fingerprint(mapper, connection, target):
+    # a question edited through the model keeps a fingerprint of its text
+    state = inspect(target)
+    if state.attrs.question.history.has_changes() or \
+            state.attrs.answer.history.has_changes():
+        target.fingerprint = question_fingerprint(target.question,
+                                                  target.answer)
+
+
+'''
+insert_question(values)
+    inserts a question unless one with the same fingerprint exists
+    (INSERT ... ON CONFLICT DO NOTHING, INSERT OR IGNORE in SQLite), and
+    returns the id of the new or existing question and whether it was
+    inserted
+'''
+
+
+def insert_question(values):
+    table = Question.__table__
+    values = dict(values, fingerprint=question_fingerprint(
+        values['question'], values['answer']))
+    if db.engine.dialect.name == 'postgresql':
+        question_id = db.session.execute(
+            postgresql.insert(table).values(**values)
+            .on_conflict_do_nothing(index_elements=['fingerprint'])
+            .returning(table.c.id)).scalar()
+    else:
+        result = db.session.execute(
+            table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+            .values(**values))
+        question_id = result.inserted_primary_key[0] \
+            if result.rowcount else None
+    if question_id is None:
+        question_id = db.session.query(Question.id).filter(
+            Question.fingerprint == values['fingerprint']).scalar()
+        # nothing written, but the statement opened a write transaction
+        commit_write([])
+        return question_id, False
+    commit_write(question_versions([values['category']]),
+                 stat_deltas(added=[(values['category'],
+                                     values['difficulty'])]),
+                 [(values['category'], question_id)])
+    return question_id, True
+
+
+'''
+update_questions(ids, values) / delete_questions(ids)
+    change or delete the questions with the given ids in one statement,
+    without loading them, and return the number of affected rows. The
+    versions of the categories the questions were in (and are moved to)
+    are bumped and the category stats adjusted; on Postgres RETURNING
+    gives the old categories and difficulties, elsewhere they are
+    selected first. A change of the text that would make two questions
+    the same raises an IntegrityError.
+'''
+
+
+def update_questions(ids, values):
+    table = Question.__table__
+    if 'question' in values and 'answer' in values:
+        values = dict(values, fingerprint=question_fingerprint(
+            values['question'], values['answer']))
+    statement = table.update().where(table.c.id.in_(ids)).values(**values)
+    if db.engine.dialect.name == 'postgresql':
+        # UPDATE ... FROM questions old RETURNING the category and
+        # difficulty before the update
+        old = table.alias('old')
+        rows = [tuple(row) for row in db.session.execute(
+            statement.where(table.c.id == old.c.id)
+            .returning(old.c.id, old.c.category, old.c.difficulty))]
+    else:
+        rows = [tuple(row) for row in db.session.query(
+            Question.id, Question.category, Question.difficulty).filter(
+                Question.id.in_(ids))]
+        db.session.execute(statement)
+    removed = [(category, difficulty) for _, category, difficulty in rows]
+    if ('question' in values) != ('answer' in values):
+        # the other half of the text is the stored one
+        fingerprints = [{
+            'question_id': question_id,
+            'new_fingerprint': question_fingerprint(question, answer)
+        } for question_id, question, answer in db.session.query(
+            Question.id, Question.question, Question.answer).filter(
+                Question.id.in_(ids))]
+        if fingerprints:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('question_id'))
+                .values(fingerprint=bindparam('new_fingerprint')),
+                fingerprints)
+    added = [(values.get('category', category),
+              values.get('difficulty', difficulty))
+             for category, difficulty in removed]
+    changes = [(category, question_id) for question_id, category, _ in rows]
+    changes += [(values['category'], question_id)
+                for question_id, _, _ in rows if 'category' in values]
+    commit_write(question_versions([key[0] for key in removed + added])
+                 if removed else [],
+                 stat_deltas(removed=removed, added=added), changes)
+    return len(removed)
+
+
+def delete_questions(ids):
+    table = Question.__table__
+    statement = table.delete().where(table.c.id.in_(ids))
+    if db.engine.dialect.name == 'postgresql':
+        rows = [tuple(row) for row in db.session.execute(
+            statement.returning(table.c.id, table.c.category,
+                                table.c.difficulty))]
+    else:
+        rows = [tuple(row) for row in db.session.query(
+            Question.id, Question.category, Question.difficulty).filter(
+                Question.id.in_(ids))]
+        db.session.execute(statement)
+    removed = [(category, difficulty) for _, category, difficulty in rows]
+    commit_write(question_versions([key[0] for key in removed])
+                 if removed else [], stat_deltas(removed=removed),
+                 [(category, question_id) for question_id, category, _ in rows])
+    return len(removed)
+
+
+def question_versions(categories):
+    return ['questions'] + [category_version(category)
+                            for category in set(categories)]
+
+
 '''
 Category
 
@@ -80,8 +461,1135 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        commit_write(['categories'])
+
+    def update(self):
+        commit_write(['categories'])
+
+    def delete(self):
+        db.session.delete(self)
+        commit_write(['categories'])
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+'''
+CategoryStat
+    the number of questions per category and difficulty, changed in the
+    same transaction as every write to questions so that totals are read
+    without counting the questions table
+'''
+
+
+class CategoryStat(db.Model):
+    __tablename__ = 'category_stats'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    question_count = Column(Integer, nullable=False, default=0)
+
+
+def stat_deltas(removed=(), added=()):
+    '''the count changes of removed and added (category, difficulty) keys'''
+    deltas = Counter(added)
+    deltas.subtract(removed)
+    return deltas
+
+
+def adjust_stats(deltas):
+    table = CategoryStat.__table__
+    # in a fixed order, like the version bumps
+    for (category, difficulty), delta in sorted(
+            (key, delta) for key, delta in deltas.items()
+            if delta and None not in key):
+        row = (table.c.category == category) & \
+            (table.c.difficulty == difficulty)
+        update = table.update().where(row).values(
+            question_count=table.c.question_count + delta)
+        if db.session.execute(update).rowcount:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(
+                    category=category, difficulty=difficulty,
+                    question_count=delta))
+        except IntegrityError:
+            # created concurrently by another worker
+            db.session.execute(update)
+
+
+def rebuild_category_stats():
+    '''
+    counts the questions again, after they were written without the
+    models (SQL scripts, restored dumps, test fixtures)
+    '''
+    table = CategoryStat.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(
+        ['category', 'difficulty', 'question_count'],
+        select([Question.category, Question.difficulty, func.count()])
+        .where(Question.category.isnot(None) &
+               Question.difficulty.isnot(None))
+        .group_by(Question.category, Question.difficulty)))
+    categories = [row[0] for row in db.session.query(CategoryStat.category)]
+    commit_write(question_versions(categories))
+
+
+def ensure_category_stats():
+    # a category_stats table created empty next to existing questions,
+    # by create_all() rather than its migration
+    if not db.session.query(CategoryStat.query.exists()).scalar() and \
+            db.session.query(Question.query.exists()).scalar():
+        rebuild_category_stats()
+    db.session.remove()
+
+
+'''
+ContentVersion
+    a version stamp per kind of content, bumped in the same transaction
+    as every write to it, so that each worker can tell when its cached
+    copy is stale
+'''
+
+
+class ContentVersion(db.Model):
+    __tablename__ = 'content_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+
+
+def category_version(category):
+    return 'questions:%d' % category
+
+
+'''
+QuestionChange
+    the ids of the questions written by each bump of a category version,
+    so that the QuestionIndex of a worker only reads those questions
+    again; a NULL id stands for a write whose ids are unknown, after
+    which the whole category is read again
+'''
+
+
+class QuestionChange(db.Model):
+    __tablename__ = 'question_changes'
+    __table_args__ = (
+        Index('ix_question_changes_category_version', 'category', 'version'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    category = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    question_id = Column(Integer)
+
+
+def log_changes(names, changes):
+    '''
+    records the (category, question id) `changes` of a write at the
+    versions bump_version() just gave its `names`, in the same
+    transaction, and forgets those older than QUESTION_CHANGES_KEPT
+    versions of each category
+    '''
+    categories = sorted(int(name.split(':', 1)[1]) for name in set(names)
+                        if name.startswith('questions:'))
+    if not categories:
+        return
+    versions = dict(db.session.query(
+        ContentVersion.name, ContentVersion.version).filter(
+            ContentVersion.name.in_(
+                [category_version(category) for category in categories])))
+    ids = {category: set() for category in categories}
+    for category, question_id in changes:
+        if category in ids:
+            ids[category].add(question_id)
+    table = QuestionChange.__table__
+    db.session.execute(table.insert(), [
+        {'category': category,
+         'version': versions[category_version(category)],
+         'question_id': question_id}
+        for category in categories
+        for question_id in sorted(ids[category]) or [None]])
+    db.session.execute(
+        table.delete().where(
+            (table.c.category == bindparam('changed_category')) &
+            (table.c.version <= bindparam('kept_after'))),
+        [{'changed_category': category,
+          'kept_after': versions[category_version(category)] -
+          QUESTION_CHANGES_KEPT} for category in categories])
+
+
+def bump_version(*names):
+    if has_app_context():
+        # read by app.replicas to send the client's next reads to the
+        # primary
+        g.wrote_content = True
+    now = datetime.datetime.utcnow()
+    table = ContentVersion.__table__
+    for name in names:
+        result = db.session.execute(
+            table.update().where(table.c.name == name).values(
+                version=table.c.version + 1, updated_at=now))
+        if result.rowcount:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(
+                    name=name, version=1, updated_at=now))
+        except IntegrityError:
+            # created concurrently by another worker
+            db.session.execute(
+                table.update().where(table.c.name == name).values(
+                    version=table.c.version + 1, updated_at=now))
+
+
+'''
+unit_of_work()
+    context manager grouping the writes made inside it into a single
+    transaction: the model insert(), update() and delete() methods and
+    update_questions() / delete_questions() only record the versions
+    and category stats they touch, which are bumped once, in a fixed
+    order, right before the one commit. Rolls back if the block raises.
+    Nested blocks join the outermost one.
+'''
+
+
+@contextmanager
+def unit_of_work():
+    info = db.session.info
+    if 'pending_versions' in info:
+        yield
+        return
+    info['pending_versions'] = set()
+    info['pending_stats'] = Counter()
+    info['pending_changes'] = set()
+    try:
+        yield
+        names = info.pop('pending_versions')
+        if names:
+            # the same order in every transaction, so that concurrent
+            # ones wait on each other's version rows instead of deadlocking
+            bump_version(*sorted(names))
+        log_changes(names, info.pop('pending_changes'))
+        adjust_stats(info.pop('pending_stats'))
+        db.session.commit()
+    except BaseException:
+        info.pop('pending_versions', None)
+        info.pop('pending_stats', None)
+        info.pop('pending_changes', None)
+        db.session.rollback()
+        raise
+    content_versions.invalidate()
+
+
+def commit_write(names, stats=None, changes=()):
+    # commits a write with its version bumps, the (category, question id)
+    # changes behind them and its category stats changes, or defers them
+    # to the enclosing unit_of_work()
+    pending = db.session.info.get('pending_versions')
+    if pending is not None:
+        pending.update(names)
+        db.session.info['pending_stats'].update(stats or {})
+        db.session.info['pending_changes'].update(changes)
+        return
+    bump_version(*names)
+    log_changes(names, changes)
+    adjust_stats(stats or {})
+    db.session.commit()
+    content_versions.invalidate()
+
+
+'''
+ContentVersions
+    this worker's view of the content_versions table, read again at most
+    every VERSION_CHECK_INTERVAL seconds (or right after a local write)
+'''
+
+
+class ContentVersions:
+
+    def __init__(self, interval=VERSION_CHECK_INTERVAL):
+        self.interval = interval
+        self.versions = {}
+        self.checked = None
+
+    def refresh(self):
+        self.versions = {
+            name: (version, updated_at) for name, version, updated_at in
+            db.session.query(ContentVersion.name, ContentVersion.version,
+                             ContentVersion.updated_at)}
+        self.checked = time.monotonic()
+
+    def invalidate(self):
+        self.checked = None
+
+    def current(self):
+        '''returns the version and update time of every content'''
+        if self.checked is None or \
+                time.monotonic() - self.checked >= self.interval:
+            self.refresh()
+        return self.versions
+
+    def get(self, name):
+        '''returns (version, updated_at) of the content, (0, None) if
+        it was never written'''
+        return self.current().get(name, (0, None))
+
+
+content_versions = ContentVersions()
+
+
+'''
+ReplicaSet
+    the read replica binds of the app. A replica is checked at most every
+    REPLICA_CHECK_INTERVAL seconds by reading its content_versions table.
+    It is only chosen while it has every version this worker has seen on
+    the primary, so replicas that lag, and replicas that failed their
+    last check or query, are skipped for the primary.
+'''
+
+
+class ReplicaSet:
+
+    def __init__(self, interval=REPLICA_CHECK_INTERVAL):
+        self.interval = interval
+        self.binds = []
+        self.versions = {}
+        self.checked = {}
+        self._lock = threading.Lock()
+
+    def configure(self, binds):
+        self.binds = binds
+        self.versions = {}
+        self.checked = {}
+
+    def check(self, bind):
+        table = ContentVersion.__table__
+        try:
+            with db.get_engine(bind=bind).connect() as connection:
+                versions = dict(connection.execute(
+                    select([table.c.name, table.c.version])).fetchall())
+        except DBAPIError as e:
+            print(e)
+            versions = None
+        with self._lock:
+            self.versions[bind] = versions
+            self.checked[bind] = time.monotonic()
+
+    def mark_failed(self, bind):
+        with self._lock:
+            self.versions[bind] = None
+            self.checked[bind] = time.monotonic()
+
+    def is_current(self, bind, primary):
+        checked = self.checked.get(bind)
+        if checked is None or time.monotonic() - checked >= self.interval:
+            self.check(bind)
+        versions = self.versions.get(bind)
+        return versions is not None and all(
+            versions.get(name, 0) >= version
+            for name, (version, _) in primary.items())
+
+    def choose(self):
+        '''returns a replica bind that has caught up, None for the
+        primary'''
+        if not self.binds:
+            return None
+        primary = content_versions.current()
+        current = [bind for bind in self.binds
+                   if self.is_current(bind, primary)]
+        return random.choice(current) if current else None
+
+
+replica_set = ReplicaSet()
+
+
+'''
+CategoryCache
+    the categories, loaded once and shared by all requests of the worker
+    until the 'categories' version changes, along with the ready-made
+    JSON body of GET /categories
+'''
+
+
+class CategoryCache:
+
+    def __init__(self):
+        self.version = None
+        self.categories = None
+        self.json = None
+        self._lock = threading.Lock()
+
+    def load(self, version):
+        categories = {category.id: category.type
+                      for category in Category.query.order_by(Category.id)}
+        self.json = dumps({
+            'success': True,
+            'categories': categories
+        })
+        self.categories = categories
+        self.version = version
+
+    def get(self):
+        version = content_versions.get('categories')[0]
+        if self.version != version:
+            with self._lock:
+                if self.version != version:
+                    self.load(version)
+        return self
+
+
+category_cache = CategoryCache()
+
+
+'''
+QuestionRow
+    read-only question as selected by the read paths below: the columns
+    only, without ORM hydration or identity map bookkeeping. Writes go
+    through the Question model.
+'''
+
+
+class QuestionRow:
+    __slots__ = ('id', 'question', 'answer', 'category', 'difficulty')
+
+    def __init__(self, id, question, answer, category, difficulty):
+        self.id = id
+        self.question = question
+        self.answer = answer
+        self.category = category
+        self.difficulty = difficulty
+
+    def format(self):
+        return {
+            'id': self.id,
+            'question': self.question,
+            'answer': self.answer,
+            'category': self.category,
+            'difficulty': self.difficulty
+        }
+
+
+def query_questions(session=None):
+    return (session or db.session).query(
+        Question.id, Question.question, Question.answer, Question.category,
+        Question.difficulty)
+
+
+# the hot read queries are built and compiled to SQL once per shape and
+# then only bound to new parameters
+bakery = baked.bakery()
+
+
+def get_question_row(question_id):
+    query = bakery(query_questions)
+    query += lambda q: q.filter(Question.id == bindparam('id'))
+    row = query(db.session()).params(id=question_id).first()
+    return QuestionRow(*row) if row is not None else None
+
+
+'''
+dumps(obj)
+    serializes to JSON bytes with sorted keys like jsonify, using orjson
+    when it is installed
+'''
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(
+            obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+
+
+'''
+paginate_questions(per_page, page=1, after=None, category=None)
+    returns one page of questions ordered by id, with the LIMIT/OFFSET
+    pushed into SQL. When `after` (the id of the last question of the
+    previous page) is given, a keyset query is used instead of OFFSET.
+'''
+
+
+def paginate_questions(per_page, page=1, after=None, category=None):
+    query = bakery(query_questions)
+    query += lambda q: q.order_by(Question.id)
+    params = {'limit': per_page}
+    if category is not None:
+        query += lambda q: q.filter(
+            Question.category == bindparam('category'))
+        params['category'] = category
+    if after is not None:
+        query += lambda q: q.filter(Question.id > bindparam('after'))
+        params['after'] = after
+    else:
+        query += lambda q: q.offset(bindparam('offset'))
+        params['offset'] = (max(page, 1) - 1) * per_page
+    query += lambda q: q.limit(bindparam('limit'))
+    return [QuestionRow(*row)
+            for row in query(db.session()).params(**params)]
+
+
+'''
+iter_questions(category=None)
+    yields the questions (of a category) ordered by id, fetching
+    STREAM_BATCH_SIZE rows at a time through a server-side cursor
+'''
+
+
+def iter_questions(category=None):
+    query = query_questions().order_by(Question.id)
+    if category is not None:
+        query = query.filter(Question.category == category)
+    return (QuestionRow(*row) for row in query.yield_per(STREAM_BATCH_SIZE))
+
+
+'''
+CategoryStats
+    this worker's copy of the category_stats table, read again when the
+    'questions' version changes
+'''
+
+
+class CategoryStats:
+
+    def __init__(self):
+        self.version = None
+        self.counts = None
+        self._lock = threading.Lock()
+
+    def load(self, version):
+        counts = {}
+        for category, difficulty, question_count in db.session.query(
+                CategoryStat.category, CategoryStat.difficulty,
+                CategoryStat.question_count):
+            if question_count:
+                counts.setdefault(category, {})[difficulty] = question_count
+        self.counts = counts
+        self.version = version
+
+    def get(self):
+        version = content_versions.get('questions')[0]
+        if self.version != version:
+            with self._lock:
+                if self.version != version:
+                    self.load(version)
+        return self
+
+    def total(self, category=None):
+        if category is None:
+            return sum(sum(difficulties.values())
+                       for difficulties in self.counts.values())
+        return sum(self.counts.get(category, {}).values())
+
+
+category_stats = CategoryStats()
+
+
+'''
+count_questions() / count_category_questions(category)
+    the total number of questions, or of a category, from the category
+    stats
+'''
+
+
+def count_questions():
+    return category_stats.get().total()
+
+
+def count_category_questions(category):
+    return category_stats.get().total(category)
+
+
+'''
+QuestionIndex
+    in-memory index of question ids by category and difficulty, each
+    bucket a sorted array. It is loaded lazily with a single
+    id/category/difficulty query; afterwards only the questions logged
+    in question_changes since are read again, and a category only when
+    some of its writes were not logged. A draw costs a bisection per
+    played id in each bucket, whatever the number of questions.
+'''
+
+
+class QuestionIndex:
+
+    def __init__(self):
+        self.buckets = None
+        self.version = None
+        # the version of each category the buckets were read at, None
+        # when they were built from rows given by the caller
+        self.category_versions = None
+        self._lock = threading.Lock()
+
+    def load(self, version):
+        versions = content_versions.current()
+        self.build(db.session.query(
+            Question.id, Question.category, Question.difficulty), version)
+        self.track(versions)
+
+    def track(self, versions):
+        # the buckets were read at these category versions, or later
+        self.category_versions = {
+            name: category_version for name, (category_version, _) in
+            versions.items() if name.startswith('questions:')}
+
+    def build(self, rows, version):
+        # rows of (id, category, difficulty), from any driver
+        buckets = {}
+        for question_id, category, difficulty in rows:
+            buckets.setdefault(category, {}).setdefault(
+                difficulty, []).append(question_id)
+        for by_difficulty in buckets.values():
+            for difficulty, ids in by_difficulty.items():
+                by_difficulty[difficulty] = array('l', sorted(ids))
+        self.buckets = buckets
+        self.version = version
+        self.category_versions = None
+
+    def changed(self, versions):
+        # (name, category, version read at, version) of the categories
+        # written since the buckets were read
+        return [(name, int(name.split(':', 1)[1]),
+                 self.category_versions.get(name), category_version)
+                for name, (category_version, _) in versions.items()
+                if name.startswith('questions:') and
+                self.category_versions.get(name) != category_version]
+
+    @staticmethod
+    def logged(since, version):
+        # whether the changes of the versions after `since` are still kept
+        return since is not None and 0 < version - since <= \
+            QUESTION_CHANGES_KEPT
+
+    @staticmethod
+    def logged_ids(since, version, changes):
+        '''
+        the question ids of the (version, question id) `changes` of a
+        category after version `since`, or None when a version has no
+        change logged or one with an unknown id
+        '''
+        ids, versions = set(), set()
+        for change_version, question_id in changes:
+            if question_id is None:
+                return None
+            versions.add(change_version)
+            ids.add(question_id)
+        if len(versions) != version - since:
+            return None
+        return ids
+
+    def update(self, version, categories):
+        '''
+        replaces the buckets of `categories`, (name, version, rows) with
+        the (id, difficulty) rows of each category in id order
+        '''
+        buckets = dict(self.buckets)
+        for name, category_version, rows in categories:
+            category = int(name.split(':', 1)[1])
+            by_difficulty = {}
+            for question_id, difficulty in rows:
+                by_difficulty.setdefault(difficulty, array('l')).append(
+                    question_id)
+            if by_difficulty:
+                buckets[category] = by_difficulty
+            else:
+                buckets.pop(category, None)
+            self.category_versions[name] = category_version
+        self.buckets = buckets
+        self.version = version
+
+    def move(self, version, categories, ids, rows):
+        '''
+        takes the questions `ids` out of their buckets and puts them back
+        where their (id, category, difficulty) `rows` are now (the ids
+        without a row were deleted), after the changes of `categories`,
+        (name, version) pairs. The buckets changed are copied, draws
+        running meanwhile keep the old ones.
+        '''
+        ids = sorted(ids)
+        buckets = dict(self.buckets)
+        for category, by_difficulty in self.buckets.items():
+            for difficulty, bucket in by_difficulty.items():
+                positions = []
+                for question_id in ids:
+                    position = bisect.bisect_left(bucket, question_id)
+                    if position < len(bucket) and \
+                            bucket[position] == question_id:
+                        positions.append(position)
+                if not positions:
+                    continue
+                bucket = array('l', bucket)
+                for position in reversed(positions):
+                    del bucket[position]
+                if buckets[category] is by_difficulty:
+                    buckets[category] = dict(by_difficulty)
+                if bucket:
+                    buckets[category][difficulty] = bucket
+                else:
+                    del buckets[category][difficulty]
+            if not buckets[category]:
+                del buckets[category]
+        added = {}
+        for question_id, category, difficulty in rows:
+            added.setdefault((category, difficulty), []).append(question_id)
+        for (category, difficulty), new_ids in added.items():
+            by_difficulty = buckets[category] = dict(
+                buckets.get(category, {}))
+            bucket = by_difficulty.get(difficulty, array('l'))
+            new_ids.sort()
+            if not bucket or new_ids[0] > bucket[-1]:
+                # the usual case of new questions, with the highest ids
+                bucket = array('l', bucket)
+                bucket.extend(new_ids)
+            else:
+                bucket = array('l', sorted(list(bucket) + new_ids))
+            by_difficulty[difficulty] = bucket
+        for name, category_version in categories:
+            self.category_versions[name] = category_version
+        self.buckets = buckets
+        self.version = version
+
+    def reload_changed(self, version):
+        # moves the questions written since the last refresh, or reads
+        # again the categories whose changes were not all logged
+        reloaded, moved, ids = [], [], set()
+        for name, category, since, category_version in self.changed(
+                content_versions.current()):
+            logged = None
+            if self.logged(since, category_version):
+                logged = self.logged_ids(since, category_version, (
+                    db.session.query(QuestionChange.version,
+                                     QuestionChange.question_id).filter(
+                        QuestionChange.category == category,
+                        QuestionChange.version > since,
+                        QuestionChange.version <= category_version)))
+            if logged is None:
+                reloaded.append((name, category_version, db.session.query(
+                    Question.id, Question.difficulty).filter(
+                        Question.category == category).order_by(
+                            Question.id)))
+            else:
+                moved.append((name, category_version))
+                ids |= logged
+        self.update(version, reloaded)
+        if not moved:
+            return
+        ids = sorted(ids)
+        rows = []
+        for start in range(0, len(ids), ID_LOOKUP_SIZE):
+            rows.extend(db.session.query(
+                Question.id, Question.category, Question.difficulty).filter(
+                    Question.id.in_(ids[start:start + ID_LOOKUP_SIZE])))
+        self.move(version, moved, ids, rows)
+
+    def invalidate(self):
+        # compares the category versions again on the next draw
+        self.version = None
+        content_versions.invalidate()
+
+    def refresh(self):
+        version = content_versions.get('questions')[0]
+        if self.buckets is None or self.version != version:
+            with self._lock:
+                if self.buckets is None or self.category_versions is None:
+                    self.load(version)
+                elif self.version != version:
+                    self.reload_changed(version)
+
+    def get_buckets(self, category=0, difficulty=None):
+        # arrays of ids matching the category (0 for all) and difficulty
+        self.refresh()
+        return self.select(category, difficulty)
+
+    def select(self, category=0, difficulty=None):
+        buckets = self.buckets
+        categories = buckets.values() if category == 0 else [
+            buckets.get(category, {})]
+        return [ids for by_difficulty in categories
+                for diff, ids in by_difficulty.items()
+                if difficulty is None or diff == difficulty]
+
+    def difficulties(self, category=0):
+        buckets = self.buckets
+        categories = buckets.values() if category == 0 else [
+            buckets.get(category, {})]
+        return {difficulty for by_difficulty in categories
+                for difficulty in by_difficulty}
+
+    def draw(self, category=0, exclude=(), difficulty=None):
+        return self.sample(self.get_buckets(category, difficulty), exclude)
+
+    def draw_nearest(self, category, exclude, difficulty):
+        '''
+        an id of the given difficulty or, once those are all played, of
+        the closest difficulty left, the easier one first on a tie
+        '''
+        self.refresh()
+        exclude = sorted(set(exclude))
+        for nearest in sorted(self.difficulties(category),
+                              key=lambda diff: (abs(diff - difficulty),
+                                                diff)):
+            question_id = self.sample(self.select(category, nearest),
+                                      exclude)
+            if question_id is not None:
+                return question_id
+        return None
+
+    @staticmethod
+    def sample(buckets, exclude=()):
+        '''
+        a uniformly random id of the sorted `buckets` that is not in
+        `exclude`: the excluded ids are located in each bucket by
+        bisection, and the chosen position steps over them
+        '''
+        exclude = sorted(set(exclude))
+        skipped, total = [], 0
+        for ids in buckets:
+            positions = []
+            for question_id in exclude:
+                position = bisect.bisect_left(ids, question_id)
+                if position < len(ids) and ids[position] == question_id:
+                    positions.append(position)
+            skipped.append(positions)
+            total += len(ids) - len(positions)
+        if not total:
+            return None
+        position = random.randrange(total)
+        for ids, positions in zip(buckets, skipped):
+            available = len(ids) - len(positions)
+            if position >= available:
+                position -= available
+                continue
+            for excluded in positions:
+                if excluded > position:
+                    break
+                position += 1
+            return ids[position]
+
+
+question_index = QuestionIndex()
+
+
+'''
+draw_question(category, exclude, difficulty=None, weights=None,
+              strategy=QUIZ_DRAW_STRATEGY)
+    returns a random question of the category (0 for any category) whose
+    id is not in `exclude` (any container supporting len() and `in`).
+    Every question is equally likely unless `weights` maps difficulties
+    to relative weights (1 for the difficulties left out).
+'''
+
+
+def draw_question(category=0, exclude=(), difficulty=None, weights=None,
+                  strategy=QUIZ_DRAW_STRATEGY):
+    if isinstance(exclude, (list, tuple)):
+        exclude = set(exclude)
+    if strategy == 'sql':
+        # the probes only miss often when few questions are left to play
+        return probe_question(category, exclude, difficulty, weights) or \
+            scan_question(category, exclude, difficulty, weights)
+    return draw_indexed_question(category, exclude, difficulty, weights)
+
+
+def accepts(difficulty, weights):
+    # rejection step of the difficulty weighting
+    if not weights:
+        return True
+    return random.random() * max(1, max(weights.values())) < \
+        weights.get(difficulty, 1)
+
+
+def draw_indexed_question(category, exclude, difficulty, weights,
+                          tries=16):
+    # draws from the QuestionIndex, fetching only the chosen row
+    for _ in range(tries):
+        question_id = question_index.draw(category, exclude, difficulty)
+        if question_id is None:
+            return None
+        question = get_question_row(question_id)
+        if question is None:
+            # deleted by another worker since the index was loaded
+            question_index.invalidate()
+        elif accepts(question.difficulty, weights):
+            return question
+    return scan_question(category, exclude, difficulty, weights)
+
+
+'''
+draw_adaptive_question(category, exclude, difficulty)
+    draws from the QuestionIndex a question of the difficulty band an
+    adaptive quiz is in, or of the closest band with questions left
+'''
+
+
+def draw_adaptive_question(category, exclude, difficulty, tries=4):
+    for _ in range(tries):
+        question_id = question_index.draw_nearest(category, exclude,
+                                                  difficulty)
+        if question_id is None:
+            return None
+        question = get_question_row(question_id)
+        if question is not None:
+            return question
+        # deleted by another worker since the index was refreshed
+        question_index.invalidate()
+    return None
+
+
+_id_range = {'value': None, 'version': None}
+
+
+def question_id_range():
+    version = content_versions.get('questions')[0]
+    if _id_range['value'] is None or _id_range['version'] != version:
+        _id_range['value'] = db.session.query(
+            func.min(Question.id), func.max(Question.id)).one()
+        _id_range['version'] = version
+    return _id_range['value']
+
+
+def probe_question(category, exclude, difficulty, weights, rounds=2):
+    '''
+    looks up QUIZ_DRAW_PROBES uniformly random ids between the lowest and
+    highest question id in one query, and returns the first that exists
+    and matches, so that each matching question is equally likely
+    whatever the gaps in the ids. Returns None after `rounds` misses.
+    '''
+    low, high = question_id_range()
+    if low is None:
+        return None
+    query = bakery(query_questions)
+    query += lambda q: q.filter(
+        Question.id.in_(bindparam('ids', expanding=True)))
+    params = {}
+    if category:
+        query += lambda q: q.filter(
+            Question.category == bindparam('category'))
+        params['category'] = category
+    if difficulty is not None:
+        query += lambda q: q.filter(
+            Question.difficulty == bindparam('difficulty'))
+        params['difficulty'] = difficulty
+    for _ in range(rounds):
+        probes = [random.randint(low, high)
+                  for _ in range(QUIZ_DRAW_PROBES)]
+        rows = {row.id: row for row in
+                query(db.session()).params(ids=probes, **params)}
+        for question_id in probes:
+            row = rows.get(question_id)
+            if row is not None and question_id not in exclude and \
+                    accepts(row.difficulty, weights):
+                return QuestionRow(*row)
+    return None
+
+
+def scan_question(category, exclude, difficulty, weights):
+    '''
+    draws by reading the ids of the matching questions once, keeping a
+    single weighted reservoir sample (Efraimidis-Spirakis), so memory
+    does not grow with the table
+    '''
+    query = db.session.query(Question.id, Question.difficulty)
+    if category:
+        query = query.filter(Question.category == category)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    chosen, chosen_key = None, -1.0
+    for question_id, question_difficulty in query.yield_per(
+            STREAM_BATCH_SIZE):
+        weight = weights.get(question_difficulty, 1) if weights else 1
+        if question_id in exclude or weight <= 0:
+            continue
+        key = random.random() ** (1.0 / weight)
+        if key > chosen_key:
+            chosen, chosen_key = question_id, key
+    return get_question_row(chosen) if chosen is not None else None
+
+
+'''
+SearchIndex
+    in-process inverted index of the words of every question and answer,
+    used by search_questions() on databases without the Postgres
+    search_vector column (SQLite, test databases)
+'''
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+class SearchIndex:
+
+    def __init__(self):
+        self.question_postings = None
+        self.answer_postings = None
+        self.words = None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def load(self, version):
+        question_postings = {}
+        answer_postings = {}
+        rows = db.session.query(Question.id, Question.question,
+                                Question.answer)
+        for question_id, question, answer in rows:
+            for word in tokenize(question):
+                question_postings.setdefault(word, set()).add(question_id)
+            for word in tokenize(answer):
+                answer_postings.setdefault(word, set()).add(question_id)
+        self.question_postings = question_postings
+        self.answer_postings = answer_postings
+        self.words = sorted(set(question_postings) | set(answer_postings))
+        self.version = version
+
+    def prefixed(self, prefix):
+        # indexed words starting with the prefix, by binary search
+        start = bisect.bisect_left(self.words, prefix)
+        end = start
+        while end < len(self.words) and self.words[end].startswith(prefix):
+            end += 1
+        return self.words[start:end]
+
+    def search(self, terms, include_answers=False):
+        '''returns the ids matching every term, best matches first'''
+        version = content_versions.get('questions')[0]
+        if self.words is None or self.version != version:
+            with self._lock:
+                if self.words is None or self.version != version:
+                    self.load(version)
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for word in self.prefixed(term):
+                if include_answers:
+                    for question_id in self.answer_postings.get(word, ()):
+                        term_scores[question_id] = ANSWER_MATCH_WEIGHT
+                for question_id in self.question_postings.get(word, ()):
+                    term_scores[question_id] = 1
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {question_id: score + term_scores[question_id]
+                          for question_id, score in scores.items()
+                          if question_id in term_scores}
+        return sorted(scores or (), key=lambda question_id: (
+            -scores[question_id], question_id))
+
+
+search_index = SearchIndex()
+
+
+'''
+search_questions(term, per_page, page=1, include_answers=False)
+    returns one page of the questions matching every word of the term
+    (as a prefix), best ranked first, and the total number of matches.
+    Uses the GIN-indexed search_vector column on Postgres and the
+    in-process SearchIndex elsewhere.
+'''
+
+
+def has_search_vector():
+    if 'value' not in _has_search_vector:
+        _has_search_vector['value'] = (
+            db.engine.dialect.name == 'postgresql' and
+            'search_vector' in [column['name'] for column in
+                                inspect(db.engine).get_columns('questions')])
+    return _has_search_vector['value']
+
+
+_has_search_vector = {}
+
+
+def search_tsquery(terms, include_answers=False):
+    # the question is weighted A and the answer B in search_vector
+    weights = 'AB' if include_answers else 'A'
+    return ' & '.join(term + ':*' + weights for term in terms)
+
+
+def ranked_search(terms, include_answers=False):
+    '''returns the ranked query on Postgres, the ranked ids elsewhere'''
+    if has_search_vector():
+        query = func.to_tsquery('english',
+                                search_tsquery(terms, include_answers))
+        search_vector = literal_column('questions.search_vector')
+        return query_questions().filter(search_vector.op('@@')(query)) \
+            .order_by(func.ts_rank_cd(search_vector, query).desc(),
+                      Question.id)
+    return search_index.search(terms, include_answers)
+
+
+def get_questions_by_ids(ids):
+    by_id = {row.id: QuestionRow(*row) for row in
+             query_questions().filter(Question.id.in_(ids))} if ids else {}
+    return [by_id[question_id] for question_id in ids
+            if question_id in by_id]
+
+
+def search_questions(term, per_page, page=1, include_answers=False):
+    terms = tokenize(term)
+    offset = (max(page, 1) - 1) * per_page
+    if not terms:
+        return paginate_questions(per_page, page=page), count_questions()
+
+    results = ranked_search(terms, include_answers)
+    if isinstance(results, list):
+        return get_questions_by_ids(results[offset:offset + per_page]), \
+            len(results)
+    return [QuestionRow(*row) for row in
+            results.offset(offset).limit(per_page)], results.count()
+
+
+'''
+iter_search_results(term, include_answers=False)
+    yields every question matching the term, best ranked first, fetching
+    STREAM_BATCH_SIZE rows at a time
+'''
+
+
+def iter_search_results(term, include_answers=False):
+    terms = tokenize(term)
+    if not terms:
+        return iter_questions()
+
+    results = ranked_search(terms, include_answers)
+    if not isinstance(results, list):
+        return (QuestionRow(*row)
+                for row in results.yield_per(STREAM_BATCH_SIZE))
+    return (question
+            for start in range(0, len(results), STREAM_BATCH_SIZE)
+            for question in get_questions_by_ids(
+                results[start:start + STREAM_BATCH_SIZE]))
+
+
+'''
+warm_caches(strategy=QUIZ_DRAW_STRATEGY)
+    loads the content versions, the categories and their stats and the
+    ids the quiz draws from, e.g. once in the gunicorn master so that the
+    forked workers share them
+'''
+
+
+def warm_caches(strategy=QUIZ_DRAW_STRATEGY):
+    content_versions.current()
+    category_cache.get()
+    category_stats.get()
+    if strategy == 'index':
+        question_index.get_buckets()
+    else:
+        question_id_range()
+    has_search_vector()
+    db.session.remove()
+
+
+def invalidate_question_caches():
+    # the caches above follow the 'questions' version, have this worker
+    # read the version it just wrote right away
+    content_versions.invalidate()
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import unittest
+import json
+
+import app
+from app.asgi import TriviaASGI
+from app.auth.auth import jwks_store
+from models import db, Question, Category, delete_questions
+
+
+def asgi_requests(application, requests):
+    """
+    Starts the ASGI app and sends it the (method, path, headers, body)
+    requests, returns their status, headers and body
+    """
+    responses = []
+
+    async def run():
+        lifespan_messages = [{'type': 'lifespan.startup'},
+                             {'type': 'lifespan.shutdown'}]
+        lifespan_started = asyncio.Event()
+        requests_done = asyncio.Event()
+
+        async def lifespan_receive():
+            message = lifespan_messages.pop(0)
+            if message['type'] == 'lifespan.shutdown':
+                await requests_done.wait()
+            return message
+
+        async def lifespan_send(message):
+            if message['type'] == 'lifespan.startup.complete':
+                lifespan_started.set()
+
+        lifespan = asyncio.ensure_future(application(
+            {'type': 'lifespan'}, lifespan_receive, lifespan_send))
+        await lifespan_started.wait()
+        for method, path, headers, body in requests:
+            messages = []
+
+            async def receive(body=body):
+                return {'type': 'http.request', 'body': body}
+
+            async def send(message, messages=messages):
+                messages.append(message)
+
+            if body:
+                headers = dict(headers, **{'Content-Length': str(len(body))})
+            path_part, _, query = path.partition('?')
+            await application({
+                'type': 'http', 'method': method, 'path': path_part,
+                'query_string': query.encode(),
+                'headers': [(name.lower().encode(), value.encode())
+                            for name, value in headers.items()],
+                'http_version': '1.1', 'scheme': 'http', 'root_path': '',
+                'server': ('testserver', 80), 'client': ('127.0.0.1', 1)
+            }, receive, send)
+            responses.append((
+                messages[0]['status'],
+                {name.decode().lower(): value.decode()
+                 for name, value in messages[0]['headers']},
+                b''.join(message.get('body', b'')
+                         for message in messages[1:])))
+        requests_done.set()
+        await lifespan
+
+    asyncio.run(run())
+    return responses
+
+
+# a Postgres database the ASGI tests write a question to; the native
+# handlers only serve Postgres, so the tests are skipped without one
+ASGI_DATABASE_URL = os.getenv('ASGI_DATABASE_URL', '')
+
+
+@unittest.skipUnless(ASGI_DATABASE_URL.startswith('postgres'),
+                     'ASGI_DATABASE_URL is not a Postgres database')
+class ASGITestCase(unittest.TestCase):
+    """This class tests the native ASGI handlers against the Flask app"""
+
+    def setUp(self):
+        # the index strategy, to follow the questions added
+        self.app = app.create_app({'DATABASE_URL': ASGI_DATABASE_URL,
+                                   'RATE_LIMITS': {}})
+        self.app.config['QUIZ_DRAW_STRATEGY'] = 'index'
+        self.context = self.app.app_context()
+        self.context.push()
+        # no key fetch from Auth0 at startup
+        self.static_keys = jwks_store.static
+        jwks_store.static = True
+        self.category = Category.query.order_by(Category.id).first().id
+        self.question = Question('ASGI question', 'answer', self.category, 1)
+        self.question.insert()
+        self.added = None
+        self.application = TriviaASGI(self.app)
+        self.fallbacks = []
+        flask = self.application.flask
+
+        async def recording_flask(scope, receive, send):
+            self.fallbacks.append(scope.get('path'))
+            await flask(scope, receive, send)
+        self.application.flask = recording_flask
+
+    def tearDown(self):
+        delete_questions([self.question.id, self.added])
+        jwks_store.static = self.static_keys
+        db.session.remove()
+        self.context.pop()
+
+    def test_asgi_matches_flask(self):
+        others = [question_id for question_id, in db.session.query(
+            Question.id).filter(Question.category == self.category,
+                                Question.id != self.question.id)]
+        requests = [
+            ('GET', '/categories', {}, None),
+            ('GET', '/categories', {'Origin': 'http://localhost:3000'}, None),
+            ('GET', '/questions?page=1', {}, None),
+            ('GET', '/categories/%d/questions' % self.category, {}, None),
+            ('GET', '/categories/%d/questions?per_page=2' % self.category,
+             {'Origin': 'http://localhost:3000'}, None),
+            ('POST', '/questions', {}, {'searchTerm': 'ASGI question'}),
+            # only the new question is left to draw
+            ('POST', '/quizzes', {}, {
+                'quiz_category': {'id': self.category},
+                'previous_questions': others})
+        ]
+        client = self.app.test_client()
+        expected = [client.open(path, method=method, headers=headers,
+                                json=body) for method, path, headers, body
+                    in requests]
+        # then a question added through Flask is drawn from the index once
+        # its category is read again
+        added = [
+            ('POST', '/questions', {}, {
+                'question': 'ASGI question 2', 'answer': 'answer',
+                'category': self.category, 'difficulty': 1}),
+            ('POST', '/quizzes', {}, {
+                'quiz_category': {'id': self.category},
+                'previous_questions': others + [self.question.id]})
+        ]
+        responses = asgi_requests(self.application, [
+            (method, path, dict(headers, **(
+                {'Content-Type': 'application/json'} if body else {})),
+             json.dumps(body).encode() if body else b'')
+            for method, path, headers, body in requests + added])
+        self.assertEqual(self.fallbacks, ['/questions'])
+        for (method, path, _, _), res, (status, headers, body) in zip(
+                requests, expected, responses):
+            self.assertEqual(status, res.status_code, path)
+            self.assertEqual(body, res.get_data(), path)
+            flask_headers = {name.lower(): value
+                             for name, value in res.headers.items()}
+            for each in (headers, flask_headers):
+                each.pop('server-timing')
+            self.assertEqual(headers, flask_headers, path)
+        self.assertEqual(json.loads(body)['question']['id'],
+                         self.question.id)
+        self.added = json.loads(responses[-2][2])['id']
+        self.assertEqual(json.loads(responses[-1][2])['question']['id'],
+                         self.added)
+
+    def test_asgi_quiz_settings(self):
+        others = [question_id for question_id, in db.session.query(
+            Question.id).filter(Question.category == self.category,
+                                Question.id != self.question.id)]
+        request = ('POST', '/quizzes',
+                   {'Content-Type': 'application/json'},
+                   json.dumps({'quiz_category': {'id': self.category},
+                               'previous_questions': others}).encode())
+        # the last question left has a difficulty of weight 0
+        for strategy, weights, drawn in [
+                ('sql', {}, self.question.id), ('sql', {1: 0}, None),
+                ('index', {}, self.question.id), ('index', {1: 0}, None)]:
+            self.app.config['QUIZ_DRAW_STRATEGY'] = strategy
+            self.app.config['QUIZ_DIFFICULTY_WEIGHTS'] = weights
+            (status, _, body), = asgi_requests(self.application, [request])
+            self.assertEqual(status, 200)
+            question = json.loads(body)['question']
+            self.assertEqual(question and question['id'], drawn,
+                             (strategy, weights))
+
+        # every slot of the quizzes is taken
+        admission = self.app.extensions['admission']
+        releases = [admission.acquire('quizzes') for _ in range(
+            int(admission.bounds['quizzes']))]
+        try:
+            (status, headers, body), = asgi_requests(self.application,
+                                                     [request])
+        finally:
+            for release in releases:
+                release()
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '1')
+        self.assertEqual(json.loads(body)['message'], 'Service unavailable')
+        self.assertEqual(self.fallbacks, [])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
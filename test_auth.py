@@ -0,0 +1,102 @@
+import io
+import tempfile
+import time
+import unittest
+import json
+
+from app.auth.auth import JWKSKeyStore, VerifiedTokenCache
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class tests the cached JWKS key store offline"""
+
+    def setUp(self):
+        self.jwks = {'keys': [
+            {'kty': 'RSA', 'kid': 'key-1', 'use': 'sig', 'n': 'n1', 'e': 'AQAB'}
+        ]}
+        self.fetches = 0
+
+        def opener(url):
+            self.fetches += 1
+            response = io.BytesIO(json.dumps(self.jwks).encode())
+            response.headers = {'Cache-Control': 'public, max-age=600'}
+            return response
+
+        self.store = JWKSKeyStore(opener=opener)
+
+    def test_keys_are_cached(self):
+        self.assertEqual(self.store.get_key('key-1')['n'], 'n1')
+        self.assertEqual(self.store.get_key('key-1')['n'], 'n1')
+        self.assertEqual(self.fetches, 1)
+        self.assertGreater(self.store.expires, time.monotonic() + 500)
+
+    def test_unknown_kid_refetches_once(self):
+        self.store.get_key('key-1')
+        self.store.min_refetch_interval = 0
+        self.jwks['keys'][0]['kid'] = 'key-2'
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.fetches, 2)
+
+        self.store.min_refetch_interval = 60
+        self.assertIsNone(self.store.get_key('key-3'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_expired_keys_served_while_provider_is_down(self):
+        self.store.get_key('key-1')
+        self.store.expires = time.monotonic() - 1
+        self.store.min_refetch_interval = 0
+        refreshes = []
+        self.store.refresh_in_background = lambda: refreshes.append(True)
+        self.assertEqual(self.store.get_key('key-1')['n'], 'n1')
+        self.assertEqual((self.fetches, len(refreshes)), (1, 1))
+
+    def test_no_refetch_storm_without_keys(self):
+        def unreachable(url):
+            self.fetches += 1
+            raise OSError('unreachable')
+
+        store = JWKSKeyStore(opener=unreachable, min_refetch_interval=60)
+        self.assertIsNone(store.get_key('key-1'))
+        self.assertIsNone(store.get_key('key-1'))
+        self.assertEqual(self.fetches, 1)
+        store.refresh_in_background()
+        self.assertFalse(store._refreshing)
+
+    def test_load_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as jwks_file:
+            json.dump(self.jwks, jwks_file)
+            jwks_file.flush()
+            self.store.load_file(jwks_file.name)
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertEqual(self.fetches, 0)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """This class tests the verified token cache"""
+
+    def test_hits_and_misses(self):
+        cache = VerifiedTokenCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get('token-a'))
+        cache.put('token-a', {'sub': 'a', 'exp': time.time() + 600})
+        self.assertEqual(cache.get('token-a')['sub'], 'a')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_entries_expire_with_token(self):
+        cache = VerifiedTokenCache(ttl=60)
+        cache.put('token-a', {'sub': 'a', 'exp': time.time() - 1})
+        self.assertIsNone(cache.get('token-a'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = VerifiedTokenCache(maxsize=2, ttl=60)
+        cache.put('token-a', {'sub': 'a'})
+        cache.put('token-b', {'sub': 'b'})
+        cache.get('token-a')
+        cache.put('token-c', {'sub': 'c'})
+        self.assertIsNone(cache.get('token-b'))
+        self.assertEqual(cache.get('token-a')['sub'], 'a')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+import os
+import shutil
+import tempfile
+import unittest
+import json
+
+import app
+from app import metrics
+from models import (db, Question, Category, DATABASE_POOL, TimedQueuePool,
+                    engine_options, content_versions, replica_set,
+                    unit_of_work, update_questions, delete_questions,
+                    CategoryStat, warm_caches, category_cache, category_stats)
+from sqlalchemy.exc import IntegrityError
+from test_support import SQLiteAppTestCase
+
+
+class EngineOptionsTestCase(unittest.TestCase):
+    """This class tests the connection pool configuration"""
+
+    def options(self, database_path, **pool):
+        return engine_options(database_path, dict(DATABASE_POOL, **pool))
+
+    def test_postgres_pool(self):
+        options = self.options('postgresql://localhost/trivia', size=3,
+                               overflow=2, recycle=60, pooler=None,
+                               statement_timeout=5000)
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertEqual(options['pool_recycle'], 60)
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+
+    def test_pgbouncer(self):
+        options = self.options('postgresql://localhost/trivia',
+                               pooler='pgbouncer', statement_timeout=5000)
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('connect_args', options)
+
+    def test_sqlite_keeps_default_pool(self):
+        options = self.options('sqlite:///trivia.db', pooler=None)
+        self.assertNotIn('poolclass', options)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class tests read replica routing with two SQLite files"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.primary = os.path.join(self.directory, 'primary.db')
+        self.replica = os.path.join(self.directory, 'replica.db')
+        self.app = app.create_app({
+            'DATABASE_URL': 'sqlite:///' + self.primary,
+            'DATABASE_REPLICA_URLS': ['sqlite:///' + self.replica]
+        })
+        self.client = self.app.test_client()
+        replica_set.interval = 0
+        content_versions.interval = 0
+        with self.app.app_context():
+            Category('Science').insert()
+            Question('Primary question', 'answer', 1, 1).insert()
+            db.session.remove()
+        # the replica has caught up, plus a row only it has
+        shutil.copy(self.primary, self.replica)
+        with self.app.app_context():
+            db.get_engine(self.app, 'replica_0').execute(
+                "INSERT INTO questions (question, answer, category, "
+                "difficulty) VALUES ('Replica question', 'answer', 1, 1)")
+
+    def tearDown(self):
+        replica_set.configure([])
+        shutil.rmtree(self.directory)
+
+    def questions(self, client=None):
+        res = (client or self.client).get(
+            '/categories/1/questions?per_page=10')
+        self.assertEqual(res.status_code, 200)
+        return [question['question']
+                for question in json.loads(res.data)['questions']]
+
+    def test_reads_from_current_replica(self):
+        self.assertIn('Replica question', self.questions())
+
+    def test_read_your_writes(self):
+        res = self.client.post('/questions', json={
+            'question': 'New question', 'answer': 'answer',
+            'category': 1, 'difficulty': 1})
+        self.assertIn('trivia_primary=', res.headers['Set-Cookie'])
+        self.assertIn('New question', self.questions())
+        # other clients skip the replica until it catches up
+        self.assertNotIn('Replica question',
+                         self.questions(self.app.test_client()))
+
+    def test_failed_replica_falls_back_to_primary(self):
+        with self.app.app_context():
+            db.get_engine(self.app, 'replica_0').execute(
+                'DROP TABLE questions')
+        self.assertEqual(self.questions(), ['Primary question'])
+
+
+class UnitOfWorkTestCase(SQLiteAppTestCase):
+    """This class tests batched writes and their content versions"""
+
+    def setUp(self):
+        super().setUp()
+        for type in ['Science', 'Art', 'Geography']:
+            Category(type).insert()
+        for number in range(6):
+            Question('Question %d' % number, 'answer', number % 3 + 1,
+                     1).insert()
+        content_versions.invalidate()
+
+    def test_update_bumps_old_and_new_categories(self):
+        before = content_versions.get('questions:1')[0]
+        self.assertEqual(update_questions([1, 4, 99], {'category': 3}), 2)
+        content_versions.invalidate()
+        self.assertEqual(content_versions.get('questions:1')[0], before + 1)
+        self.assertEqual(Question.query.filter_by(category=3).count(), 4)
+        self.assertEqual(update_questions([99], {'difficulty': 2}), 0)
+
+    def test_failed_statement_timing(self):
+        slow_query_seconds = metrics.SLOW_QUERY_SECONDS
+        metrics.SLOW_QUERY_SECONDS = 0
+        try:
+            with self.assertLogs('trivia.metrics', 'WARNING') as logs:
+                with self.assertRaises(IntegrityError):
+                    Question('Question 1', 'answer', 1, 1).insert()
+                db.session.rollback()
+                self.assertEqual(Question.query.count(), 6)
+        finally:
+            metrics.SLOW_QUERY_SECONDS = slow_query_seconds
+        self.assertNotIn('query_start', db.session.connection().info)
+        self.assertFalse(any('Question' in line for line in logs.output))
+
+    def test_delete(self):
+        self.assertEqual(delete_questions([2, 3, 99]), 2)
+        self.assertEqual(Question.query.count(), 4)
+
+    def test_rollback(self):
+        before = content_versions.get('questions')[0]
+        with self.assertRaises(RuntimeError):
+            with unit_of_work():
+                Question('Question 7', 'answer', 1, 1).insert()
+                update_questions([1], {'answer': 'changed'})
+                raise RuntimeError
+        content_versions.invalidate()
+        self.assertEqual(content_versions.get('questions')[0], before)
+        self.assertEqual(Question.query.count(), 6)
+        self.assertEqual(Question.query.get(1).answer, 'answer')
+
+    def test_nested_blocks_commit_once(self):
+        before = content_versions.get('questions')[0]
+        with unit_of_work():
+            Question('Question 7', 'answer', 1, 1).insert()
+            with unit_of_work():
+                Question('Question 8', 'answer', 2, 1).insert()
+            delete_questions([1])
+        content_versions.invalidate()
+        self.assertEqual(content_versions.get('questions')[0], before + 1)
+        self.assertEqual(Question.query.count(), 7)
+
+    def test_category_stats_follow_writes(self):
+        question = Question.query.get(2)
+        question.category = 1
+        question.difficulty = 4
+        question.update()
+        Question.query.get(3).delete()
+        update_questions([4, 5], {'difficulty': 3})
+        delete_questions([6])
+        with unit_of_work():
+            Question('Question 7', 'answer', 3, 2).insert()
+        counted = {(category, difficulty): count
+                   for category, difficulty, count in db.session.query(
+                       Question.category, Question.difficulty,
+                       db.func.count()).group_by(Question.category,
+                                                 Question.difficulty)}
+        stats = {(stat.category, stat.difficulty): stat.question_count
+                 for stat in CategoryStat.query if stat.question_count}
+        self.assertEqual(stats, counted)
+
+        data = self.app.test_client().get('/categories/stats').get_json()
+        self.assertEqual(data['totalQuestions'], 5)
+        self.assertEqual(data['categories']['1'], {
+            'type': 'Science', 'totalQuestions': 3,
+            'difficulties': {'1': 1, '3': 1, '4': 1}})
+
+
+class StartupTestCase(unittest.TestCase):
+    """This class tests the production startup"""
+
+    def setUp(self):
+        self.database_file = tempfile.NamedTemporaryFile(suffix='.db')
+        self.database_url = 'sqlite:///' + self.database_file.name
+
+    def tearDown(self):
+        db.session.remove()
+        self.database_file.close()
+
+    def test_tables_are_left_to_the_migrations(self):
+        production = app.create_app({'DATABASE_URL': self.database_url,
+                                     'DB_CREATE_TABLES': False})
+        with production.app_context():
+            self.assertEqual(db.engine.table_names(), [])
+        self.assertNotIn('migrate', production.extensions)
+
+    def test_warm_caches(self):
+        development = app.create_app({'DATABASE_URL': self.database_url})
+        with development.app_context():
+            Category('Science').insert()
+            Question('Question', 'answer', 1, 1).insert()
+            content_versions.invalidate()
+            warm_caches()
+            self.assertEqual(category_cache.categories, {1: 'Science'})
+            self.assertEqual(category_stats.total(), 1)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
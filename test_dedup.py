@@ -0,0 +1,146 @@
+import unittest
+import json
+
+from app.bulk import import_questions
+from app.dedup import MinHasher, near_duplicates, delete_exact_duplicates
+from models import (db, Question, Category, update_questions,
+                    question_fingerprint, insert_question, count_questions,
+                    count_category_questions, rebuild_category_stats)
+from sqlalchemy.exc import IntegrityError
+from test_support import SQLiteAppTestCase
+
+
+class DeduplicationTestCase(SQLiteAppTestCase):
+    """This class tests the question fingerprints and duplicate search"""
+
+    def setUp(self):
+        super().setUp()
+        for type in ['Science', 'Art']:
+            Category(type).insert()
+
+    def test_fingerprint_ignores_case_and_spacing(self):
+        self.assertEqual(
+            question_fingerprint('Who  painted\nthe Mona Lisa?', 'Leonardo'),
+            question_fingerprint('who painted the MONA LISA?', ' leonardo'))
+        self.assertNotEqual(
+            question_fingerprint('Who painted the Mona Lisa', 'Leonardo'),
+            question_fingerprint('Who painted the Mona Lisa?', 'Leonardo'))
+        self.assertNotEqual(question_fingerprint('a b', 'c'),
+                            question_fingerprint('a', 'b c'))
+
+    def test_question_posted_once(self):
+        body = {'question': 'Who painted the Mona Lisa?',
+                'answer': 'Leonardo', 'category': 2, 'difficulty': 2}
+        first = self.client().post('/questions', json=body).get_json()
+        self.assertTrue(first['created'])
+        body.update(question=' who painted the  mona lisa?', category=1)
+        second = self.client().post('/questions', json=body).get_json()
+        self.assertEqual(second, {'success': True, 'id': first['id'],
+                                  'created': False})
+        self.assertEqual(Question.query.count(), 1)
+        self.assertEqual(count_questions(), 1)
+        self.assertEqual(count_category_questions(1), 0)
+
+    def test_text_edits_follow_fingerprint(self):
+        question = Question('Largest planet?', 'Jupiter', 1, 1)
+        question.insert()
+        question_id, created = insert_question({
+            'question': 'Smallest planet?', 'answer': 'Mercury',
+            'category': 1, 'difficulty': 1})
+        self.assertTrue(created)
+        self.assertEqual(question.fingerprint,
+                         question_fingerprint('Largest planet?', 'Jupiter'))
+        update_questions([question.id], {'answer': 'JUPITER '})
+        self.assertEqual(Question.query.get(question.id).fingerprint,
+                         question_fingerprint('Largest planet?', 'Jupiter'))
+        with self.assertRaises(IntegrityError):
+            update_questions([question_id], {'question': 'Largest planet?',
+                                             'answer': 'Jupiter'})
+        db.session.rollback()
+        update_questions([question_id], {'question': 'Largest planet?'})
+        with self.assertRaises(IntegrityError):
+            update_questions([question_id], {'answer': 'jupiter'})
+        db.session.rollback()
+        question = Question.query.get(question_id)
+        question.answer = 'Mars'
+        question.update()
+        self.assertEqual(question.fingerprint,
+                         question_fingerprint('Largest planet?', 'Mars'))
+
+    def test_import_skips_duplicates(self):
+        insert_question({'question': 'Red planet?', 'answer': 'Mars',
+                         'category': 1, 'difficulty': 1})
+        rows = [{'question': question, 'answer': answer, 'category': 2,
+                 'difficulty': 3} for question, answer in [
+            ('RED planet?', 'Mars'), ('Ringed planet?', 'Saturn'),
+            ('Blue planet?', 'Earth'), ('ringed  planet?', 'saturn')]]
+        report = import_questions(
+            [json.dumps(row) for row in rows], batch_size=3)
+        self.assertEqual((report['inserted'], report['duplicates']), (2, 2))
+        self.assertEqual(Question.query.count(), 3)
+        self.assertEqual(count_category_questions(2), 2)
+
+    def test_import_reports_unreadable_lines(self):
+        report = import_questions([
+            b'{"question": "Red planet?", "answer": "Mars", '
+            b'"category": 1, "difficulty": 1}\n',
+            b'{"question": "\xff?", "answer": "Mars"}\n',
+            b'{"question": "Blue planet?", "answer": "Earth", '
+            b'"category": 1, "difficulty": 1}\n'], batch_size=1)
+        self.assertEqual((report['inserted'], report['failed']), (2, 1))
+        self.assertEqual(report['errors'],
+                         [{'line': 2, 'error': 'invalid UTF-8'}])
+        report = import_questions([
+            b'question,answer,category,difficulty\n',
+            b'Ringed planet?,Saturn,2,1\n',
+            b'\xff?,Mars,2,1\n',
+            b'"' + b'x' * 140000 + b'",Mars,2,1\n',
+            b'Hot planet?,Venus,2,1\n'], format='csv', batch_size=1)
+        self.assertEqual((report['inserted'], report['failed']), (2, 2))
+        self.assertEqual([error['line'] for error in report['errors']],
+                         [3, 4])
+        self.assertEqual(report['errors'][0]['error'], 'invalid UTF-8')
+        self.assertTrue(report['errors'][1]['error'].startswith(
+            'invalid CSV'))
+        self.assertEqual(count_category_questions(2), 2)
+
+    def test_near_duplicates(self):
+        for question, answer in [
+                ('Which planet is known as the Red Planet?', 'Mars'),
+                ('Who wrote Hamlet?', 'William Shakespeare'),
+                ('Which planet is known as the red planet', 'Mars'),
+                ('Which planet is called the Red Planet?', 'Mars'),
+                ('What is the boiling point of water?', '100 degrees')]:
+            Question(question, answer, 1, 1).insert()
+        pairs = list(near_duplicates(0.5, MinHasher(32, 2), batch_size=2))
+        self.assertEqual([pair[:2] for pair in pairs],
+                         [(3, 1), (4, 1), (4, 3)])
+        self.assertEqual(pairs[0][2], 1.0)
+        self.assertLess(pairs[1][2], 1.0)
+        # only the oldest question of a bucket too large is compared
+        self.assertEqual(list(near_duplicates(0.5, MinHasher(32, 2),
+                                              max_bucket=1)), pairs[:2])
+
+    def test_delete_exact_duplicates(self):
+        # as in a database from before the unique fingerprint index
+        db.session.execute('DROP INDEX ix_questions_fingerprint')
+        rows = [('Red planet?', 'Mars', 1), ('Blue planet?', 'Earth', 1),
+                ('RED  planet?', 'mars', 2), ('Ringed planet?', 'Saturn', 2),
+                ('red planet?', 'Mars', 1), ('No answer?', None, 2),
+                ('No answer?', None, 2)]
+        db.session.execute(Question.__table__.insert(), [
+            {'question': question, 'answer': answer, 'category': category,
+             'difficulty': 1} for question, answer, category in rows])
+        rebuild_category_stats()
+        self.assertEqual(delete_exact_duplicates(batch_size=2), 2)
+        self.assertEqual([question.id for question in
+                          Question.query.order_by(Question.id)],
+                         [1, 2, 4, 6, 7])
+        self.assertEqual(count_category_questions(1), 2)
+        self.assertEqual(count_category_questions(2), 3)
+        self.assertEqual(delete_exact_duplicates(), 0)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
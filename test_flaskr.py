@@ -68,6 +68,37 @@ class TriviaTestCase(unittest.TestCase):
                                  content_type='application/json')
         self.assertEqual(res.status_code, 405)
 
+    def test_conditional_get(self):
+        res = self.client().get('/categories/1/questions')
+        data = json.loads(res.data)
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn('s-maxage', res.headers['Cache-Control'])
+
+        res = self.client().get('/categories/1/questions',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        with self.app.app_context():
+            Question(question='Test question', answer='Test answer',
+                     category=1, difficulty=1).insert()
+        res = self.client().get('/categories/1/questions',
+                                headers={'If-None-Match': etag})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_request_metrics(self):
+        res = self.client().get('/questions')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_total{endpoint="get_questions"',
+                      res.get_data(as_text=True))
+
     def test_post_new_question(self):
         # Test question, which is deleted by the teardown() function
         mock_data = json.dumps({
@@ -107,6 +138,29 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(num_questions_before + 1, num_questions_after)
 
+    def test_import_questions(self):
+        rows = [
+            {'question': 'Test question', 'answer': 'Test answer',
+             'category': 1, 'difficulty': 1},
+            {'question': 'Test question', 'category': 1, 'difficulty': 1}
+        ]
+        mock_data = '\n'.join(json.dumps(row) for row in rows)
+
+        res = self.client().post('/questions/import', data=mock_data,
+                                 content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 401)
+
+        num_questions_before = Question.query.count()
+        res = self.client().post('/questions/import', data=mock_data,
+                                 content_type='application/x-ndjson',
+                                 headers={'Authorization': self.admin_token})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'],
+                         [{'line': 2, 'error': 'missing answer'}])
+        self.assertEqual(num_questions_before + 1, Question.query.count())
+
     def test_search(self):
         # Add test question to search for
         test_question = Question(
@@ -178,6 +232,70 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['question'])
 
+    def test_search_answers(self):
+        test_question = Question(
+            question='Test question',
+            answer='Zanzibar',
+            category=1,
+            difficulty=1)
+        test_question.insert()
+        question_id = test_question.id
+
+        mock_data = json.dumps({'searchTerm': 'zanzi'})
+        res = self.client().post('/questions', data=mock_data,
+                                 content_type='application/json')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(question_id,
+                         [question['id'] for question in data['questions']])
+
+        mock_data = json.dumps({'searchTerm': 'zanzi', 'searchAnswers': True})
+        res = self.client().post('/questions', data=mock_data,
+                                 content_type='application/json')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(question_id,
+                      [question['id'] for question in data['questions']])
+
+        Question.query.get(question_id).delete()
+
+    def test_quiz_skips_previous_questions(self):
+        ids = [q.id for q in Question.query.filter_by(category=1).all()]
+        mock_data = json.dumps({
+            'quiz_category': {
+                'type': 'Science',
+                'id': 1
+            },
+            'previous_questions': ids[1:]
+        })
+        res = self.client().post('/quizzes', data=mock_data,
+                                 content_type='application/json')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], ids[0])
+
+    def test_quiz_session(self):
+        mock_data = json.dumps({'quiz_category': {'type': 'Science', 'id': 1}})
+        res = self.client().post('/quizzes/sessions', data=mock_data,
+                                 content_type='application/json')
+        session_id = json.loads(res.data)['session_id']
+        self.assertEqual(res.status_code, 200)
+
+        seen = []
+        while True:
+            res = self.client().post(
+                '/quizzes/sessions/' + session_id + '/next')
+            question = json.loads(res.data)['question']
+            if question is None:
+                break
+            self.assertEqual(question['category'], 1)
+            seen.append(question['id'])
+        self.assertTrue(seen)
+        self.assertEqual(len(seen), len(set(seen)))
+
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        self.assertEqual(res.status_code, 404)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+import os
+import random
+import re
+import tempfile
+import unittest
+
+from sqlalchemy import event, text
+
+from app import create_app
+from models import db, Question, Category, rebuild_category_stats
+
+# set to a Postgres URL to check the plans there, the default is a
+# throwaway SQLite file
+QUERY_PLAN_DATABASE_URL = os.getenv('QUERY_PLAN_DATABASE_URL')
+# synthetic questions seeded before the plans are checked
+QUERY_PLAN_QUESTIONS = int(os.getenv('QUERY_PLAN_QUESTIONS', 50000))
+
+
+def seed(count, batch_size=5000):
+    db.session.execute(text('DELETE FROM questions'))
+    db.session.execute(text('DELETE FROM categories'))
+    for type in ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+                 'Sports']:
+        db.session.add(Category(type))
+    db.session.flush()
+    categories = [category.id for category in Category.query]
+    for start in range(0, count, batch_size):
+        db.session.execute(Question.__table__.insert(), [{
+            'question': 'Synthetic question %d' % number,
+            'answer': 'Answer %d' % number,
+            'category': random.choice(categories),
+            'difficulty': random.randint(1, 5)
+        } for number in range(start, min(start + batch_size, count))])
+    db.session.commit()
+    rebuild_category_stats()
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+def explain(connection, statement, parameters):
+    '''returns the plan lines of a statement that scan `questions` without
+    an index'''
+    if connection.dialect.name == 'postgresql':
+        plan = connection.execute(
+            'EXPLAIN ' + statement, parameters).fetchall()
+        return [row[0] for row in plan
+                if re.search(r'Seq Scan on questions', row[0])]
+    # a plain scan walks the rowid b-tree, which is the primary key index
+    # in SQLite: it is only wrong when rows are filtered or sorted
+    plan = connection.execute(
+        'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    return [row[-1] for row in plan
+            if (re.match(r'SCAN (TABLE )?questions\b', row[-1]) and
+                'INDEX' not in row[-1] and 'WHERE' in statement) or
+            'TEMP B-TREE' in row[-1]]
+
+
+def is_full_read(statement):
+    # reads of the whole table by design: the quiz id index and the
+    # search index
+    return 'questions' in statement and 'WHERE' not in statement and \
+        'LIMIT' not in statement
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """This class checks that every endpoint reads questions by index"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database_file = None
+        database_url = QUERY_PLAN_DATABASE_URL
+        if database_url is None:
+            cls.database_file = tempfile.NamedTemporaryFile(suffix='.db')
+            database_url = 'sqlite:///' + cls.database_file.name
+        cls.app = create_app({'DATABASE_URL': database_url})
+        with cls.app.app_context():
+            db.create_all()
+            seed(QUERY_PLAN_QUESTIONS)
+            cls.category_id = Category.query.first().id
+            first_id = db.session.query(db.func.min(Question.id)).scalar()
+            cls.middle_id = first_id + QUERY_PLAN_QUESTIONS // 2
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.database_file is not None:
+            cls.database_file.close()
+
+    def setUp(self):
+        self.client = self.app.test_client
+        self.statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            self.statements.append((statement, parameters))
+
+        self.record = record
+        with self.app.app_context():
+            self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute', record)
+
+    def tearDown(self):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def assertUsesIndexes(self, method, url, **kwargs):
+        self.statements = []
+        res = getattr(self.client(), method)(url, **kwargs)
+        res.get_data()
+        self.assertEqual(res.status_code, 200)
+        statements = [(statement, parameters)
+                      for statement, parameters in self.statements
+                      if 'questions' in statement and
+                      statement.lstrip().upper().startswith('SELECT')]
+        self.assertTrue(statements)
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+        try:
+            with self.engine.connect() as connection:
+                for statement, parameters in statements:
+                    if is_full_read(statement):
+                        continue
+                    scans = explain(connection, statement, parameters)
+                    self.assertEqual(scans, [], statement)
+        finally:
+            event.listen(self.engine, 'before_cursor_execute', self.record)
+
+    def test_paginated_questions(self):
+        self.assertUsesIndexes('get', '/questions?page=50')
+        self.assertUsesIndexes('get', '/questions?after=%d' % self.middle_id)
+
+    def test_categorized_questions(self):
+        url = '/categories/%d/questions' % self.category_id
+        self.assertUsesIndexes('get', url)
+        self.assertUsesIndexes('get', url + '?page=20')
+        self.assertUsesIndexes('get', url + '?after=%d' % self.middle_id)
+
+    def test_quiz(self):
+        for category_id in [self.category_id, 0]:
+            self.assertUsesIndexes('post', '/quizzes', json={
+                'quiz_category': {'id': category_id},
+                'previous_questions': []
+            })
+
+    def test_counts_read_category_stats(self):
+        for url in ['/questions?page=2', '/categories/stats',
+                    '/categories/%d/questions?page=2' % self.category_id]:
+            self.statements = []
+            self.assertEqual(self.client().get(url).status_code, 200)
+            counts = [statement for statement, parameters in self.statements
+                      if re.search(r'count\(.*FROM questions', statement,
+                                   re.S)]
+            self.assertEqual(counts, [], url)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
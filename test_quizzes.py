@@ -0,0 +1,215 @@
+import math
+import random
+import time
+import unittest
+
+from app.quiz_sessions import MemorySessionBackend
+from models import (db, Question, Category, content_versions, draw_question,
+                    scan_question, unit_of_work, update_questions,
+                    delete_questions, QuestionIndex, question_index,
+                    insert_question, rebuild_category_stats)
+from sqlalchemy import event
+from test_support import SQLiteAppTestCase
+
+
+def chi_square_limit(degrees, z=3.09):
+    """Wilson-Hilferty approximation of the chi-square quantile, p=0.001"""
+    term = 2.0 / (9 * degrees)
+    return degrees * (1 - term + z * math.sqrt(term)) ** 3
+
+
+class QuizDrawTestCase(SQLiteAppTestCase):
+    """This class checks that quiz draws are uniform or weighted"""
+
+    draws = 6000
+
+    def setUp(self):
+        random.seed(0)
+        super().setUp()
+        for type in ['Science', 'Art', 'Geography']:
+            Category(type).insert()
+        db.session.execute(Question.__table__.insert(), [{
+            'question': 'Question %d' % number, 'answer': 'answer',
+            'category': number % 3 + 1, 'difficulty': number % 5 + 1
+        } for number in range(90)])
+        # gaps in the ids must not favour the questions after them
+        db.session.execute(Question.__table__.delete().where(
+            Question.id % 7 < 3))
+        db.session.commit()
+        content_versions.invalidate()
+        self.ids = [question.id for question in Question.query]
+
+    def assertDistribution(self, counts, expected):
+        statistic = sum((counts.get(key, 0) - share * self.draws) ** 2 /
+                        (share * self.draws)
+                        for key, share in expected.items())
+        self.assertLess(statistic, chi_square_limit(len(expected) - 1))
+
+    def test_uniform(self):
+        for strategy in ['sql', 'index']:
+            counts = {}
+            for _ in range(self.draws):
+                question = draw_question(0, strategy=strategy)
+                counts[question.id] = counts.get(question.id, 0) + 1
+            self.assertEqual(set(counts), set(self.ids))
+            self.assertDistribution(counts, {question_id: 1.0 / len(self.ids)
+                                        for question_id in self.ids})
+
+    def test_excluded_ids(self):
+        remaining = self.ids[:2]
+        for strategy in ['sql', 'index']:
+            for _ in range(20):
+                question = draw_question(0, self.ids[2:], strategy=strategy)
+                self.assertIn(question.id, remaining)
+            self.assertIsNone(draw_question(0, self.ids, strategy=strategy))
+
+    def test_difficulty_weights(self):
+        weights = {5: 3, 1: 0.5}
+        difficulties = dict(Question.query.with_entities(
+            Question.id, Question.difficulty))
+        totals = {question_id: weights.get(difficulties[question_id], 1)
+                  for question_id in self.ids}
+        expected = {question_id: weight / sum(totals.values())
+                    for question_id, weight in totals.items()}
+        for draw in [lambda: draw_question(0, weights=weights),
+                     lambda: scan_question(0, (), None, weights)]:
+            counts = {}
+            for _ in range(self.draws):
+                question = draw()
+                counts[question.id] = counts.get(question.id, 0) + 1
+            self.assertDistribution(counts, expected)
+
+    def test_sample_steps_over_excluded_ids(self):
+        buckets = [[1, 4, 6], [2, 3, 5, 7]]
+        exclude = {1, 3, 7, 8}
+        counts = {}
+        for _ in range(self.draws):
+            question_id = QuestionIndex.sample(buckets, exclude)
+            counts[question_id] = counts.get(question_id, 0) + 1
+        self.assertDistribution(counts, {question_id: 0.25
+                                         for question_id in (2, 4, 5, 6)})
+        self.assertIsNone(QuestionIndex.sample(buckets, range(1, 8)))
+
+
+class AdaptiveQuizTestCase(SQLiteAppTestCase):
+    """This class tests adaptive quiz sessions"""
+
+    def setUp(self):
+        super().setUp()
+        for type in ['Science', 'Art']:
+            Category(type).insert()
+        with unit_of_work():
+            for number in range(50):
+                Question('Question %d' % number, 'answer', number % 2 + 1,
+                         number % 5 + 1).insert()
+
+    def play(self, answers, category=1):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'id': category}, 'adaptive': True})
+        session_id = res.get_json()['session_id']
+        played, body = [], None
+        for correct in answers:
+            data = self.client().post(
+                '/quizzes/sessions/%s/next' % session_id,
+                json=body).get_json()
+            if data['question'] is None:
+                break
+            played.append(data['question'])
+            body = {'correct': correct}
+        return played
+
+    def test_difficulty_follows_the_score(self):
+        played = self.play([True] * 6 + [False] * 6)
+        self.assertEqual([question['difficulty'] for question in played],
+                         [3, 4, 4, 4, 5, 5, 5, 4, 3, 2, 2, 2])
+
+    def test_closest_band_when_exhausted(self):
+        played = self.play([True] * 30)
+        self.assertEqual(len(played), 25)
+        self.assertEqual(len({question['id'] for question in played}), 25)
+        self.assertEqual({question['category'] for question in played}, {1})
+        self.assertEqual([question['difficulty'] for question in played][-5:],
+                         [1] * 5)
+
+    def test_refresh_reads_changed_categories_only(self):
+        question_index.refresh()
+        art = question_index.buckets[2]
+        Question('Question 50', 'answer', 1, 3).insert()
+        question_index.refresh()
+        self.assertIs(question_index.buckets[2], art)
+        self.assertEqual(len(question_index.select(1, 3)[0]), 6)
+
+    def test_refresh_moves_written_questions_only(self):
+        question_index.refresh()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context,
+                   executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            new_id, _ = insert_question({'question': 'Question 50',
+                                         'answer': 'answer', 'category': 1,
+                                         'difficulty': 3})
+            # 2 is in category 2 at difficulty 2, 3 in category 1
+            update_questions([2], {'category': 1, 'difficulty': 5})
+            delete_questions([3])
+            content_versions.invalidate()
+            del statements[:]
+            question_index.refresh()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertFalse([statement for statement in statements
+                          if 'questions.category =' in statement])
+        self.assertIn(new_id, question_index.select(1, 3)[0])
+        self.assertIn(2, question_index.select(1, 5)[0])
+        self.assertNotIn(2, question_index.select(2, 2)[0])
+        self.assertNotIn(3, sum((list(ids) for ids in
+                                 question_index.select(0)), []))
+        # a write not logged, from a SQL script, has the category read
+        # again whole
+        db.session.execute(Question.__table__.insert().values(
+            question='Question 51', answer='answer', category=2,
+            difficulty=1))
+        rebuild_category_stats()
+        question_index.refresh()
+        self.assertEqual(len(question_index.select(2)), 5)
+        self.assertEqual(sum(len(ids) for ids in question_index.select(2)),
+                         Question.query.filter_by(category=2).count())
+
+
+class MemorySessionBackendTestCase(unittest.TestCase):
+    """This class tests the in-process quiz session backend"""
+
+    def test_used_ids(self):
+        backend = MemorySessionBackend(ttl=60, maxsize=10)
+        session = backend.create(1)
+        for question_id in (5, 2, 9, 2):
+            backend.add_used(session, question_id)
+        session = backend.get(session.id)
+        self.assertEqual(list(session.used), [2, 5, 9])
+        self.assertIn(5, session)
+        self.assertNotIn(3, session)
+
+    def test_adaptive_score(self):
+        backend = MemorySessionBackend(ttl=60, maxsize=10)
+        session = backend.create(1, adaptive=True)
+        self.assertEqual(session.difficulty(), 3)
+        self.assertFalse(backend.record_answer(session, True))
+        backend.add_used(session, 4)
+        self.assertTrue(backend.record_answer(session, True))
+        self.assertFalse(backend.record_answer(session, True))
+        self.assertEqual(session.difficulty(), 4)
+
+    def test_expiry_and_eviction(self):
+        backend = MemorySessionBackend(ttl=0, maxsize=1)
+        first = backend.create(1)
+        second = backend.create(2)
+        self.assertIsNone(backend.get(first.id))
+        time.sleep(0.01)
+        self.assertIsNone(backend.get(second.id))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
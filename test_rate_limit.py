@@ -0,0 +1,134 @@
+import unittest
+
+from app.auth.auth import token_cache
+from app.rate_limit import (AdmissionController, MemoryBuckets, Overloaded,
+                            RateLimiter)
+from models import Question, Category, TimedQueuePool
+from test_support import SQLiteAppTestCase
+
+
+class RateLimitTestCase(SQLiteAppTestCase):
+    """This class tests the rate limits and the admission control"""
+
+    config = {
+        'RATE_LIMITS': {'quizzes': (0.01, 2), 'search': (0.01, 1)},
+        'RATE_LIMIT_PROXIES': 1,
+        'ADMISSION_LIMITS': {'quizzes': 1, 'search': 1}
+    }
+
+    def setUp(self):
+        super().setUp()
+        Category('Science').insert()
+        Question('Question', 'answer', 1, 1).insert()
+
+    def play(self, address):
+        return self.client().post('/quizzes', json={
+            'quiz_category': {'id': 1}, 'previous_questions': []},
+            headers={'X-Forwarded-For': address})
+
+    def test_token_bucket(self):
+        now = [0.0]
+        buckets = MemoryBuckets(maxsize=10, clock=lambda: now[0])
+        self.assertEqual([buckets.take('a', 2, 3) for _ in range(3)],
+                         [0, 0, 0])
+        self.assertAlmostEqual(buckets.take('a', 2, 3), 0.5)
+        now[0] = 0.25
+        self.assertAlmostEqual(buckets.take('a', 2, 3), 0.25)
+        now[0] = 0.5
+        self.assertEqual(buckets.take('a', 2, 3), 0)
+        self.assertEqual(buckets.take('b', 2, 3), 0)
+
+    def test_quizzes_limited_per_client(self):
+        self.assertEqual([self.play('10.0.0.1').status_code
+                          for _ in range(3)], [200, 200, 429])
+        res = self.play('10.0.0.1')
+        self.assertEqual(res.get_json()['error'], 429)
+        self.assertEqual(res.headers['Retry-After'], '100')
+        # only the address the proxy appended counts
+        self.assertEqual(self.play('10.0.0.2, 10.0.0.1').status_code, 429)
+        self.assertEqual(self.play('10.0.0.1, 10.0.0.2').status_code, 200)
+
+    def test_quiz_sessions_limited(self):
+        # a client cannot create sessions until older ones are evicted
+        statuses = [self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'id': 1}},
+            headers={'X-Forwarded-For': '10.0.0.3'}).status_code
+            for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_search_limited_not_new_questions(self):
+        res = self.client().post('/questions', json={'searchTerm': 'q'})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post('/questions', json={'searchTerm': 'q'})
+        self.assertEqual(res.status_code, 429)
+        res = self.client().post('/questions', json={
+            'question': 'New', 'answer': 'answer', 'category': 1,
+            'difficulty': 1})
+        self.assertEqual(res.status_code, 200)
+
+    def test_client_key(self):
+        limiter = RateLimiter(MemoryBuckets(), {})
+        self.assertEqual(limiter.client('10.0.0.1', '10.0.0.2'),
+                         'ip:10.0.0.1')
+        self.assertEqual(limiter.client('10.0.0.1', None, 'Bearer invalid'),
+                         'ip:10.0.0.1')
+        # a proxy the limiter was not told about is reported once
+        limiter = RateLimiter(MemoryBuckets(), {})
+        with self.assertLogs('trivia.rate_limit', 'WARNING') as logs:
+            limiter.client('10.0.0.1', '10.0.0.2')
+            limiter.client('10.0.0.1', '10.0.0.3')
+        self.assertEqual(len(logs.output), 1)
+        # a token is only trusted once verified, and never verified here
+        token_cache.put('verified', {'sub': 'auth0|1'})
+        try:
+            self.assertEqual(limiter.client('10.0.0.1', None,
+                                            'Bearer verified'),
+                             'sub:auth0|1')
+        finally:
+            token_cache.clear()
+
+    def test_overloaded_route_answers_503(self):
+        with self.app.extensions['admission'].admit('quizzes'):
+            res = self.play('10.0.0.1')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(self.play('10.0.0.1').status_code, 200)
+
+    def test_streamed_search_admitted(self):
+        admission = self.app.extensions['admission']
+
+        def search(address):
+            return self.client().post(
+                '/questions?stream=true', json={'searchTerm': 'q'},
+                headers={'X-Forwarded-For': address})
+
+        with admission.admit('search'):
+            self.assertEqual(search('10.0.0.1').status_code, 503)
+        res = search('10.0.0.2')
+        self.assertEqual(res.get_json()['totalQuestions'], 1)
+        self.assertEqual(admission.in_flight['search'], 1)
+        res.close()
+        self.assertEqual(admission.in_flight['search'], 0)
+
+    def test_bound_follows_pool_wait(self):
+        admission = AdmissionController({'search': 2}, max_wait=0.05)
+        with admission.admit('search'):
+            with admission.admit('search'):
+                with self.assertRaises(Overloaded):
+                    with admission.admit('search'):
+                        pass
+            # waited for a connection
+            TimedQueuePool.thread_waits.seconds = \
+                TimedQueuePool.thread_wait() + 1
+        self.assertEqual(admission.bounds['search'], 1.5)
+        with admission.admit('search'):
+            with self.assertRaises(Overloaded):
+                with admission.admit('search'):
+                    pass
+        self.assertEqual(admission.bounds['search'], 2)
+        self.assertEqual(admission.in_flight['search'], 0)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import threading
+import time
+import unittest
+
+from app.response_cache import SharedTier
+from models import Question, Category
+from test_support import SQLiteAppTestCase
+
+
+class DictRedis:
+    """The Redis commands used by SharedTier, kept in a dict"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class ResponseCacheTestCase(SQLiteAppTestCase):
+    """This class tests the response cache of the listings"""
+
+    def setUp(self):
+        self.shared = SharedTier(DictRedis())
+        self.config = {'RESPONSE_CACHE_SHARED': self.shared}
+        super().setUp()
+        # two workers sharing a database and a Redis
+        self.apps = [self.app, self.create_app()]
+        for type in ['Science', 'Art']:
+            Category(type).insert()
+        for number in range(30):
+            Question('Question %d' % number, 'answer', number % 2 + 1,
+                     1).insert()
+
+    def lookups(self, worker):
+        return self.apps[worker].extensions['response_cache'].lookups
+
+    def get(self, worker, url):
+        res = self.apps[worker].test_client().get(url)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_local_and_shared_tiers(self):
+        first = self.get(0, '/questions?page=2')
+        self.assertEqual(self.get(0, '/questions?page=2'), first)
+        self.assertEqual(self.get(1, '/questions?page=2'), first)
+        self.assertEqual(self.lookups(0), {('local', 'miss'): 1,
+                                           ('local', 'hit'): 1,
+                                           ('shared', 'miss'): 1})
+        self.assertEqual(self.lookups(1), {('local', 'miss'): 1,
+                                           ('shared', 'hit'): 1})
+
+    def test_writes_invalidate_their_category(self):
+        art = self.get(0, '/categories/2/questions?page=1')
+        science = self.get(0, '/categories/1/questions?page=1')
+        Question('Question 30', 'answer', 2, 1).insert()
+        self.assertEqual(self.get(0, '/categories/1/questions?page=1'),
+                         science)
+        self.assertEqual(
+            self.get(0, '/categories/2/questions?page=1')['totalQuestions'],
+            art['totalQuestions'] + 1)
+        self.assertEqual(self.lookups(0)[('local', 'hit')], 1)
+
+    def test_streamed_listing_is_not_cached(self):
+        self.get(0, '/categories/1/questions')
+        self.assertEqual(self.lookups(0), {})
+
+    def test_single_flight(self):
+        cache = self.apps[0].extensions['response_cache']
+        renders = []
+
+        def render():
+            renders.append(1)
+            time.sleep(0.1)
+            return b'application/json\n{}'
+
+        values = []
+        threads = [threading.Thread(
+            target=lambda: values.append(cache.fetch('key', render)))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(set(values), {b'application/json\n{}'})
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
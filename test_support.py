@@ -0,0 +1,34 @@
+import tempfile
+import unittest
+
+import app
+from models import db, content_versions, question_index
+
+
+class SQLiteAppTestCase(unittest.TestCase):
+    """This class runs each test in an app on a throwaway SQLite file"""
+
+    # settings of the app, besides its database
+    config = {}
+
+    def setUp(self):
+        self.database_file = tempfile.NamedTemporaryFile(suffix='.db')
+        self.database_url = 'sqlite:///' + self.database_file.name
+        self.app = self.create_app()
+        self.client = self.app.test_client
+        self.context = self.app.app_context()
+        self.context.push()
+        # the index of the last test's database, whose category versions
+        # this one may not have
+        question_index.buckets = None
+        content_versions.invalidate()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.database_file.close()
+
+    def create_app(self):
+        """Another app on the same database, as another worker would be"""
+        return app.create_app(dict(self.config,
+                                   DATABASE_URL=self.database_url))